@@ -1,19 +1,48 @@
 import os
+import glob
 import subprocess
+import asyncio
 import base64
+import binascii
+import codecs
+import mmap
+import io
+import hashlib
+import sqlite3
+import array
+import math
 import json
+import concurrent.futures
+import logging
+import logging.handlers
 import re
 import colorama
+try:
+    import PIL.Image
+except ImportError:
+    PIL = None
 import time
 import datetime
+import threading
+import typing
+import sys
 import requests
+import urllib3
+import urllib.parse
+import charset_normalizer
 import validators
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 if __name__ == "__main__":
     SCRIPT_SETTINGS_PATH: str = "settings.json"
     SCRIPT_MODES: list[str] = [
         "chat",
         "autocomplete",
+        "batch",
+        "bench",
     ]
     PRINT_COLORS: dict[str, str] = {
         "success": colorama.Fore.LIGHTGREEN_EX,
@@ -23,12 +52,34 @@ if __name__ == "__main__":
         "model_prefix": colorama.Fore.LIGHTMAGENTA_EX,
         "special": colorama.Fore.LIGHTCYAN_EX,
     }
-    SERVER_CHECK_INTERVAL: float = 1.0
+    SERVER_CHECK_MIN_INTERVAL: float = 0.05
+    SERVER_CHECK_MAX_INTERVAL: float = 1.0
+    SERVER_CHECK_BACKOFF_FACTOR: float = 2.0
+    SERVER_LOG_READ_SIZE: int = 4096
+    SERVER_EXIT_DETECTION_TIMEOUT: float = 2.0
+    SERVER_SHUTDOWN_TIMEOUT: float = 10.0
     SERVER_STARTUP_BEHAVIOR_OPTIONS: list[str] = [
         "separate_process",
         "subprocess",
     ]
     TEXT_MODEL_SERVER_FILENAME: str = "llama-server.exe"
+    TEXT_MODEL_SERVER_START_TIMEOUT: float = 60.0
+    TEXT_MODEL_ROUTING_STRATEGIES: list[str] = [
+        "least_outstanding",
+        "slot_aware",
+    ]
+    TEXT_MODEL_BACKEND_RETRY_INTERVAL: float = 10.0
+    TEXT_MODEL_BACKEND_SLOTS_REFRESH_INTERVAL: float = 0.25
+    TEXT_MODEL_CHAT_AFFINITY_KEY: str = "chat"
+    TEXT_MODEL_SERVER_LOG_FILENAME: str = "llama-server.log"
+    TEXT_MODEL_SERVER_LOG_STAGES: list[tuple[re.Pattern, str]] = [
+        (re.compile(r"llama_model_loader: loaded meta data"), "reading model metadata"),
+        (re.compile(r"load_tensors: loading model tensors"), "loading model tensors"),
+        (re.compile(r"llama_context: constructing llama_context|llama_init_from_model"), "creating context"),
+        (re.compile(r"clip_model_loader|loading multimodal model"), "loading multimodal projector"),
+        (re.compile(r"model loaded"), "model loaded"),
+    ]
+    TEXT_MODEL_SERVER_LOG_READY_PATTERN: re.Pattern = re.compile(r"model loaded|server is listening on|all slots are idle")
     TEXT_MODEL_CHAT_SYSTEM_PROMPT_PATH: str = "chat_system_prompt.txt"
     TEXT_MODEL_CHAT_ROLES: list[str] = [
         "system",
@@ -47,6 +98,24 @@ if __name__ == "__main__":
         "q5_1",
     ]
     TEXT_MODEL_EXTENSION: str = ".gguf"
+    TEXT_MODEL_THOUGHT_START_TAG: str = "<think>"
+    TEXT_MODEL_THOUGHT_END_TAG: str = "</think>"
+    TEXT_MODEL_STREAMED_THOUGHTS_MODES: list[str] = [
+        "show",
+        "hide",
+        "collapse",
+    ]
+    TEXT_MODEL_CONTEXT_OVERFLOW_STRATEGIES: list[str] = [
+        "none",
+        "trim",
+        "summarize",
+    ]
+    TEXT_MODEL_CONTEXT_MESSAGE_OVERHEAD: int = 8 # Rough token cost of the chat template around each message.
+    TEXT_MODEL_CONTEXT_MEDIA_TOKEN_ESTIMATES: dict[str, int] = {
+        "image_url": 768,
+        "input_audio": 1024,
+    }
+    TEXT_MODEL_CONTEXT_SUMMARY_PROMPT: str = "Summarize the following conversation in a few short paragraphs. Keep names, facts, decisions and open questions; omit pleasantries."
     TEXT_MODEL_ATTACHMENT_GENERIC_URL_PATTERNS: list[str] = [
         r"https://github\.com/[^/]+/[^/]+/raw/",
         r"https://raw\.githubusercontent\.com/[^/]+/[^/]+/",
@@ -55,7 +124,8 @@ if __name__ == "__main__":
         r"https://huggingface\.co/[^/]+/[^/]+/raw/",
         r"https://pastebin\.com/raw/",
     ]
-    TEXT_MODEL_ATTACHMENT_GENERIC_FILENAMES: list[str] = [
+    TEXT_MODEL_ATTACHMENT_GENERIC_URL_PATTERN: re.Pattern = re.compile("|".join(TEXT_MODEL_ATTACHMENT_GENERIC_URL_PATTERNS))
+    TEXT_MODEL_ATTACHMENT_GENERIC_FILENAMES: set[str] = {
         "LICENSE",
         "CODEOWNERS",
         ".shellcheckrc",
@@ -84,8 +154,8 @@ if __name__ == "__main__":
         ".gitattributes",
         ".gitignore",
         ".gitmodules",
-    ]
-    TEXT_MODEL_ATTACHMENT_GENERIC_EXTENSIONS: list[str] = [
+    }
+    TEXT_MODEL_ATTACHMENT_GENERIC_EXTENSIONS: set[str] = {
         # Godot
         ".tscn",
         ".tres",
@@ -294,8 +364,8 @@ if __name__ == "__main__":
 
         # High-Level Shader Language
         ".hlsl",
-    ]
-    TEXT_MODEL_ATTACHMENT_IMAGE_EXTENSIONS: list[str] = [
+    }
+    TEXT_MODEL_ATTACHMENT_IMAGE_EXTENSIONS: set[str] = {
         ".jpg",
         ".jpeg",
         ".jpe",
@@ -311,13 +381,46 @@ if __name__ == "__main__":
         ".tiff",
         ".tif",
         ".webp",
-    ]
-    TEXT_MODEL_ATTACHMENT_AUDIO_EXTENSIONS: list[str] = [
+    }
+    TEXT_MODEL_ATTACHMENT_AUDIO_EXTENSIONS: set[str] = {
         ".wav",
         ".mp3",
+    }
+    ATTACHMENT_GLOB_CHARACTERS: str = "*?["
+    ATTACHMENT_GITIGNORE_FILENAME: str = ".gitignore"
+    ATTACHMENT_IGNORED_DIR_NAMES: set[str] = {
+        ".git",
+        ".hg",
+        ".svn",
+    }
+    ATTACHMENT_BINARY_SNIFF_SIZE: int = 8192
+    ATTACHMENT_URL_CHUNK_SIZE: int = 64 * 1024
+    ATTACHMENT_URL_CHARSET_PATTERN: re.Pattern = re.compile(rb"charset\s*=\s*[\"']?([\w.:-]+)", re.IGNORECASE)
+    ATTACHMENT_URL_CHARSET_SNIFF_SIZE: int = 1024 # Where an HTML <meta> charset is expected.
+    ATTACHMENT_BYTE_ORDER_MARKS: dict[bytes, str] = { # UTF-32 first, it starts like UTF-16.
+        codecs.BOM_UTF32_LE: "utf-32-le",
+        codecs.BOM_UTF32_BE: "utf-32-be",
+        codecs.BOM_UTF8: "utf-8",
+        codecs.BOM_UTF16_LE: "utf-16-le",
+        codecs.BOM_UTF16_BE: "utf-16-be",
+    }
+    ATTACHMENT_BLOB_REFERENCE_PREFIX: str = "attachment-blob:"
+    # Only whole "url"/"data" values match; json.dumps() escapes quotes in text.
+    ATTACHMENT_BLOB_REFERENCE_PATTERN: re.Pattern = re.compile(rb'(?:(?<="url": ")|(?<="data": "))attachment-blob:([0-9a-f]{64})(?=")')
+    ATTACHMENT_ENCODING_CHUNK_SIZE: int = 3 * 1024 * 1024 # Must be a multiple of 3 so that chunks can be base64-encoded independently.
+    ATTACHMENT_CACHE_INDEX_FILENAME: str = "index.json"
+    ATTACHMENT_CACHE_KINDS: list[str] = [
+        "text",
+        "image",
+        "audio",
     ]
     IMAGE_MODEL_SERVER_FILENAME: str = "koboldcpp.exe"
     IMAGE_MODEL_OUTPUT_DIR_NAME: str = "image_outputs/"
+    IMAGE_MODEL_OUTPUT_EXTENSION: str = ".png"
+    IMAGE_MODEL_SIDECAR_EXTENSION: str = ".json"
+    IMAGE_MODEL_PROMPT_SEPARATOR: str = "|"
+    IMAGE_MODEL_SEED_RANGE_PATTERN: re.Pattern = re.compile(r"(\d+)\s*-\s*(\d+)")
+    IMAGE_MODEL_MAX_QUEUED_IMAGES: int = 1000
     IMAGE_MODEL_HARDWARE_ACCELERATION_OPTIONS: list[str] = [
         "none",
         "cuda",
@@ -328,16 +431,91 @@ if __name__ == "__main__":
         ".safetensors",
         ".gguf",
     ]
-    IMAGE_MODEL_MAX_SERVER_CHECKS: int = 20
+    IMAGE_MODEL_SERVER_START_TIMEOUT: float = 20.0
+    IMAGE_MODEL_SERVER_LOG_FILENAME: str = "koboldcpp.log"
+    IMAGE_MODEL_SERVER_LOG_STAGES: list[tuple[re.Pattern, str]] = [
+        (re.compile(r"ImageGen Init - Load Model"), "loading image model"),
+        (re.compile(r"Load Image Model OK"), "image model loaded"),
+    ]
+    IMAGE_MODEL_SERVER_LOG_READY_PATTERN: re.Pattern = re.compile(r"Starting Kobold API on port|Please connect to custom endpoint")
     COMMAND_IMAGE_ALIAS: str = "/image"
     COMMAND_ATTACH_ALIAS: str = "/attach"
+    COMMAND_THOUGHTS_ALIAS: str = "/thoughts"
     COMMAND_HELP_ALIAS: str = "/help"
     COMMAND_EXIT_ALIAS: str = "/exit"
+    COMMAND_SAVE_ALIAS: str = "/save"
+    COMMAND_LOAD_ALIAS: str = "/load"
+    SESSION_EXTENSION: str = ".jsonl"
+    SESSION_SLOT_EXTENSION: str = ".bin"
+    SESSION_BLOB_DIR_NAME: str = "blobs/"
+    SESSION_NAME_PATTERN: re.Pattern = re.compile(r"[\w\-]+")
+    SESSION_RECORD_KINDS: list[str] = [
+        "message",
+        "state",
+    ]
+    SSE_DATA_PREFIX: bytes = b"data: "
+    SSE_ERROR_PREFIX: bytes = b"error: "
+    SSE_ERROR_OBJECT_PREFIX: bytes = b"{\"error\":"
+    SSE_DONE_PAYLOAD: bytes = b"[DONE]"
+    SSE_EVENT_TYPES: list[str] = [
+        "data",
+        "done",
+        "error",
+    ]
+    TELEMETRY_REQUEST_KINDS: list[str] = [
+        "chat",
+        "autocomplete",
+        "txt2img",
+    ]
+    TELEMETRY_SERVER_TIMING_KEYS: list[str] = [
+        "cache_n",
+        "prompt_n",
+        "prompt_ms",
+        "prompt_per_second",
+        "predicted_n",
+        "predicted_ms",
+        "predicted_per_second",
+        "draft_n",
+        "draft_n_accepted",
+    ]
+    # Fields that don't change the generated text.
+    RESPONSE_CACHE_IGNORED_PARAMETERS: list[str] = [
+        "model",
+        "messages",
+        "prompt",
+        "stream",
+        "cache_prompt",
+        "id_slot",
+    ]
+    RESPONSE_CACHE_MAX_EMBEDDING_CANDIDATES: int = 1000
+    RETRIEVAL_INDEX_FILENAME: str = "index.json"
+    RETRIEVAL_VECTORS_FILENAME: str = "vectors.npy"
+    RETRIEVAL_EMBEDDING_BATCH_SIZE: int = 32
+    RETRIEVAL_CHUNK_BOUNDARY_MODULUS: int = 8
+    BENCH_PROMPT_SENTENCE: str = "The quick brown fox jumps over the lazy dog while five boxing wizards jump quickly past the old stone bridge. "
+    BENCH_IMAGE_PROMPT: str = "a lighthouse on a rocky coast at sunset, detailed, high quality"
+    BENCH_SEED: int = 1234
+    # Metrics compared against the baseline and whether a higher value is better.
+    BENCH_COMPARED_METRICS: dict[str, bool] = {
+        "throughput_tokens_per_second": True,
+        "prompt_per_second": True,
+        "predicted_per_second": True,
+        "ttft_ms": False,
+        "total_ms": False,
+        "steps_per_second": True,
+    }
+    HTTP_CLIENT_BACKENDS: list[str] = [
+        "text_model_server",
+        "image_model_server",
+        "external",
+    ]
 
     script_settings: dict = {
         "script_mode": "chat",
         "server_startup_behavior": "subprocess",
         "text_model_init_settings": {
+            "server_dir_path": "",
+            "model_path": "",
             "server_port": 7820,
             "priority": 0,
             "use_flash_attention": True,
@@ -353,8 +531,46 @@ if __name__ == "__main__":
             "use_context_shift": True,
             "context_size": 8192,
             "disable_mmproj": False,
+            "disable_draft_model": False,
+            "draft_gpu_layers": 99,
+            "draft_max_tokens": 16,
+            "draft_min_tokens": 0,
+            "parallel_slots": 1,
+            "slot_save_path": "slot_saves/",
+        },
+        "text_model_backend_settings": {
+            "additional_server_urls": [],
+            "routing_strategy": "least_outstanding",
+            "use_session_affinity": True,
+            "embedding_server_url": "",
         },
         "disable_url_attachments": False,
+        "attachment_settings": {
+            "max_size_mb": 20,
+            "downscale_oversized_images": True,
+            "image_max_dimension": 2048,
+            "max_directory_files": 200,
+            "max_file_tokens": 8192,
+            "max_total_tokens": 32768,
+            "directory_read_threads": 8,
+            "url_connect_timeout": 5.0,
+            "url_read_timeout": 15.0,
+            "url_total_timeout": 60.0,
+            "url_max_size_mb": 8,
+            "url_max_concurrent_fetches": 4,
+        },
+        "attachment_cache_settings": {
+            "enabled": True,
+            "cache_dir": "attachment_cache/",
+            "max_size_mb": 512,
+        },
+        "retrieval_settings": {
+            "enabled": False,
+            "index_dir": "retrieval_index/",
+            "min_attachment_size_kb": 32,
+            "chunk_size": 1500,
+            "top_k": 8,
+        },
         "text_model_gen_settings": {
             "stream_responses": True,
             "temperature": 0.8,
@@ -371,9 +587,19 @@ if __name__ == "__main__":
             "dry_allowed_length": 2,
             "xtc_probability": 0.0,
             "xtc_threshold": 0.1,
+            "seed": -1,
             "chat_show_thoughts_in_nonstreaming_mode": True,
             "chat_include_thoughts_in_history": False,
+            "chat_streamed_thoughts_mode": "show",
             "autocomplete_max_tokens": 128,
+            "stream_flush_interval_ms": 33,
+            "stream_flush_size": 256,
+            "chat_context_overflow_strategy": "trim",
+            "chat_context_response_reserve": 1024,
+            "chat_context_trim_ratio": 0.75,
+            "chat_context_summary_max_tokens": 256,
+            "chat_stable_prompt_prefix": False,
+            "chat_slot_id": -1,
         },
         "enable_image_model_server_in_chat": False,
         "image_model_init_settings": {
@@ -390,8 +616,83 @@ if __name__ == "__main__":
             "seed": -1,
             "clip_skip": -1,
             "sampler_name": "Euler a",
+            "batch_size": 1,
+            "n_iter": 1,
         },
         "open_image_output_on_gen": False,
+        "http_client_settings": {
+            "pool_connections": 4,
+            "pool_max_size": 8,
+            "connect_timeout": 5.0,
+            "read_timeout": 600.0,
+            "show_request_latency": False,
+        },
+        "batch_settings": {
+            "input_path": "batch_input.jsonl",
+            "output_path": "batch_output.jsonl",
+            "max_concurrent_requests": 0,
+        },
+        "bench_settings": {
+            "text_modes": [
+                "chat",
+                "autocomplete",
+            ],
+            "stream_responses": [
+                False,
+                True,
+            ],
+            "prompt_lengths": [
+                128,
+                2048,
+            ],
+            "output_lengths": [
+                128,
+            ],
+            "concurrency_levels": [
+                1,
+                4,
+            ],
+            "repetitions": 3,
+            "image_steps": [
+                20,
+            ],
+            "image_widths": [
+                512,
+            ],
+            "image_heights": [
+                512,
+            ],
+            "results_path": "bench_results.json",
+            "baseline_path": "bench_baseline.json",
+            "update_baseline": False,
+            "regression_threshold": 0.1,
+        },
+        "response_cache_settings": {
+            "enabled": False,
+            "cache_path": "response_cache.sqlite3",
+            "ttl_hours": 168.0,
+            "max_entries": 10000,
+            "use_near_duplicates": False,
+            "similarity_threshold": 0.98,
+        },
+        "telemetry_settings": {
+            "show_inline": False,
+            "write_metrics_file": False,
+            "metrics_path": "metrics.jsonl",
+        },
+        "session_settings": {
+            "session_dir": "sessions/",
+            "save_slot_state": True,
+        },
+        "server_supervisor_settings": {
+            "restart_on_crash": True,
+            "max_restarts": 3,
+            "replay_history_on_restart": True,
+            "stop_servers_on_exit": True,
+            "log_dir": "server_logs/",
+            "log_max_size_mb": 10,
+            "log_backup_count": 3,
+        },
     }
     text_model_server_url: str = "http://localhost:"
     text_model_server_active: bool = False
@@ -401,12 +702,420 @@ if __name__ == "__main__":
         "audio": False,
     }
     text_model_message_history: list[dict] = []
+    text_model_last_thoughts: str = ""
+    text_model_context_size: int = 0
+    text_model_context_start_index: int = 0
+    text_model_context_summary: str = ""
+    text_model_context_summary_token_count: int = 0
+    text_model_context_summary_message: dict | None = None
+    text_model_token_count_cache: dict[int, tuple[dict, int]] = {}
+    text_model_message_fragment_cache: dict[int, tuple[dict, list[bytes]]] = {}
     image_model_server_url: str = "http://localhost:"
     image_model_server_active: bool = False
+    image_model_job_queue: asyncio.Queue
+    image_model_completed_jobs: list[dict] = []
+    image_model_pending_jobs: int = 0
+    text_model_turn_active: bool = False
+    text_model_history_lock: asyncio.Lock
+    input_queue: asyncio.Queue
+    current_input_prompt: str = ""
+    http_sessions: dict[str, requests.Session] = {}
+    http_request_latency: threading.local = threading.local()
+    telemetry_file_lock: threading.Lock = threading.Lock()
+    attachment_cache_index: dict | None = None
+    attachment_blobs: dict[str, bytes | bytearray] = {}
+    response_cache_connection: sqlite3.Connection | None = None
+    response_cache_lock: threading.Lock = threading.Lock()
+    retrieval_index: dict | None = None
+    retrieval_vectors: "numpy.ndarray | None" = None
+    retrieval_index_lock: threading.RLock = threading.RLock()
+    retrieval_source_keys: list[str] = []
+    attachment_cache_lock: threading.RLock = threading.RLock()
+    server_startup_progress_lock: threading.Lock = threading.Lock()
+    text_model_backend_lock: threading.Lock = threading.Lock()
+    current_session_name: str = ""
+    session_saved_message_count: int = 0
+    session_saved_last_message: dict | None = None
+
+    class TimedHTTPConnection(urllib3.connection.HTTPConnection):
+        def connect(self) -> None:
+            connect_start_time: float = time.perf_counter()
+            super().connect()
+            http_request_latency.connect_time = time.perf_counter() - connect_start_time
+
+    class TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+        def connect(self) -> None:
+            connect_start_time: float = time.perf_counter()
+            super().connect()
+            http_request_latency.connect_time = time.perf_counter() - connect_start_time
+
+    class TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+        ConnectionCls = TimedHTTPConnection
+
+    class TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+        ConnectionCls = TimedHTTPSConnection
+
+    class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs) -> None:
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {
+                "http": TimedHTTPConnectionPool,
+                "https": TimedHTTPSConnectionPool,
+            }
+
+    # Writes streamed text in batches, by size or by time, whichever comes first.
+    class StreamPrinter:
+        def __init__(self, flush_interval: float, flush_size: int) -> None:
+            self.flush_interval: float = flush_interval
+            self.flush_size: int = flush_size
+            self.pending_text: list[str] = []
+            self.pending_length: int = 0
+            self.lock: threading.Lock = threading.Lock()
+            self.closed: threading.Event = threading.Event()
+            self.flush_thread: threading.Thread | None = None
+            if flush_interval > 0.0:
+                self.flush_thread = threading.Thread(target=self.flush_periodically, daemon=True)
+                self.flush_thread.start()
+
+        def write(self, text: str) -> None:
+            with self.lock:
+                self.pending_text.append(text)
+                self.pending_length += len(text)
+                if self.flush_thread is None or self.pending_length >= self.flush_size:
+                    self.flush_pending_text()
+
+        def flush(self) -> None:
+            with self.lock:
+                self.flush_pending_text()
+
+        def flush_pending_text(self) -> None:
+            if self.pending_length > 0:
+                sys.stdout.write("".join(self.pending_text))
+                sys.stdout.flush()
+                self.pending_text.clear()
+                self.pending_length = 0
+
+        def flush_periodically(self) -> None:
+            while not self.closed.wait(self.flush_interval):
+                self.flush()
+
+        def close(self) -> None:
+            self.closed.set()
+            if self.flush_thread is not None:
+                self.flush_thread.join()
+            self.flush()
+
+    # Only a possible partial tag is held back; a leading </think> ends a thought begun in the prompt.
+    class ThoughtFilter:
+        def __init__(self) -> None:
+            self.is_in_thought: bool = False
+            self.is_after_thought: bool = False
+            self.has_seen_tag: bool = False
+            self.pending_text: str = ""
+            self.text_chunks: list[str] = []
+            self.thought_chunks: list[str] = []
+            self.thought_length: int = 0 # Of the current or last thought.
+
+        # Returns the (is_thought, text) segments of the chunk in order.
+        def feed(self, chunk: str) -> list[tuple[bool, str]]:
+            text: str = self.pending_text + chunk if self.pending_text != "" else chunk
+            self.pending_text = ""
+            segments: list[tuple[bool, str]] = []
+            position: int = 0
+            while position < len(text):
+                if self.is_after_thought:
+                    while position < len(text) and text[position] == "\n":
+                        position += 1
+                    if position == len(text):
+                        break
+                    self.is_after_thought = False
+
+                tags: tuple[str, ...] = (TEXT_MODEL_THOUGHT_END_TAG,) if self.is_in_thought else (TEXT_MODEL_THOUGHT_START_TAG,) if self.has_seen_tag else (TEXT_MODEL_THOUGHT_START_TAG, TEXT_MODEL_THOUGHT_END_TAG)
+                tag: str = ""
+                tag_start: int = -1
+                for _tag in tags:
+                    _tag_start: int = text.find(_tag, position)
+                    if _tag_start != -1 and (tag_start == -1 or _tag_start < tag_start):
+                        tag, tag_start = _tag, _tag_start
+                if tag_start == -1:
+                    held_length: int = 0
+                    for _tag in tags:
+                        tag_prefix_length: int = min(len(_tag) - 1, len(text) - position)
+                        while tag_prefix_length > held_length and not text.endswith(_tag[:tag_prefix_length]):
+                            tag_prefix_length -= 1
+                        held_length = max(held_length, tag_prefix_length)
+                    self.add_segment(segments, text[position:len(text) - held_length])
+                    self.pending_text = text[len(text) - held_length:]
+                    break
+
+                if tag == TEXT_MODEL_THOUGHT_END_TAG and not self.is_in_thought:
+                    self.is_in_thought = True
+                    self.thought_chunks, self.text_chunks = self.text_chunks, []
+                    self.thought_length = sum(len(thought_chunk) for thought_chunk in self.thought_chunks)
+                    segments.append((True, ""))
+                self.has_seen_tag = True
+                self.add_segment(segments, text[position:tag_start])
+                position = tag_start + len(tag)
+                self.is_in_thought = not self.is_in_thought
+                self.is_after_thought = not self.is_in_thought
+                if self.is_in_thought:
+                    self.thought_length = 0
+                segments.append((self.is_in_thought, ""))
+            return segments
+
+        # Releases a held back partial tag once the stream has ended.
+        def finish(self) -> list[tuple[bool, str]]:
+            segments: list[tuple[bool, str]] = []
+            self.add_segment(segments, self.pending_text)
+            self.pending_text = ""
+            return segments
+
+        def add_segment(self, segments: list[tuple[bool, str]], text: str) -> None:
+            if text == "":
+                return
+            if self.is_in_thought:
+                self.thought_chunks.append(text)
+                self.thought_length += len(text)
+            else:
+                self.text_chunks.append(text)
+            segments.append((self.is_in_thought, text))
+
+        def get_text(self) -> str:
+            return "".join(self.text_chunks)
+
+        def get_thoughts(self) -> str:
+            return "".join(self.thought_chunks)
+
+    # The counters are only changed while holding text_model_backend_lock.
+    class TextModelBackend:
+        def __init__(self, url: str) -> None:
+            self.url: str = url
+            self.is_healthy: bool = True
+            self.last_failure_time: float = 0.0
+            self.outstanding_requests: int = 0
+            self.idle_slot_count: int | None = None
+            self.slots_refresh_time: float = 0.0
+            self.requests_since_slots_refresh: int = 0
+
+    class RequestTelemetry:
+        def __init__(self, request_kind: str) -> None:
+            self.request_kind: str = request_kind
+            self.start_time: float = time.perf_counter()
+            self.token_times: list[float] = []
+            self.bytes_received: int = 0
+            self.server_timings: dict | None = None
+            self.encode_time: float | None = None
+            self.extra_fields: dict = {}
+
+        def record_token(self) -> None:
+            self.token_times.append(time.perf_counter())
+
+    # Log lines report load progress and wake the waiter to probe; probes back off.
+    class ServerStartupMonitor:
+        def __init__(self, server_name: str, server_process: subprocess.Popen | None, log_stages: list[tuple[re.Pattern, str]], log_ready_pattern: re.Pattern, probe: typing.Callable[[], bool], inactivity_timeout: float, server_logger: logging.Logger | None=None, exit_callback: typing.Callable[[subprocess.Popen], bool] | None=None) -> None:
+            self.server_name: str = server_name
+            self.server_process: subprocess.Popen | None = server_process
+            self.log_stages: list[tuple[re.Pattern, str]] = log_stages
+            self.log_ready_pattern: re.Pattern = log_ready_pattern
+            self.probe: typing.Callable[[], bool] = probe
+            self.inactivity_timeout: float = inactivity_timeout
+            self.server_logger: logging.Logger | None = server_logger
+            self.exit_callback: typing.Callable[[subprocess.Popen], bool] | None = exit_callback
+            self.stage: str = "starting"
+            self.is_ready: bool = False
+            self.is_cancelled: bool = False
+            self.start_time: float = time.perf_counter()
+            self.ready_time: float | None = None
+            self.last_activity_time: float = self.start_time
+            self.log_event: threading.Event = threading.Event()
+            self.log_thread: threading.Thread | None = None
+            if server_process is not None and server_process.stdout is not None:
+                self.log_thread = threading.Thread(target=self.read_log, daemon=True)
+                self.log_thread.start()
+
+        def get_elapsed_time(self) -> float:
+            return (self.ready_time if self.ready_time is not None else time.perf_counter()) - self.start_time
+
+        # Keeps draining the pipe so that the server never blocks on it.
+        def read_log(self) -> None:
+            log_buffer: bytes = b""
+            while True:
+                log_chunk: bytes = self.server_process.stdout.read1(SERVER_LOG_READ_SIZE)
+                if log_chunk == b"":
+                    break
+                self.last_activity_time = time.perf_counter()
+                log_lines: list[bytes] = (log_buffer + log_chunk).split(b"\n")
+                log_buffer = log_lines.pop()
+                for log_line in log_lines:
+                    self.process_log_line(log_line.decode("utf-8", errors="replace").rstrip())
+            if log_buffer != b"":
+                self.process_log_line(log_buffer.decode("utf-8", errors="replace").rstrip())
+            self.log_event.set()
+            if self.exit_callback is not None:
+                self.exit_callback(self.server_process)
+
+        def process_log_line(self, log_line: str) -> None:
+            if self.server_logger is not None:
+                self.server_logger.info(log_line)
+            for stage_pattern, stage_description in self.log_stages:
+                if stage_pattern.search(log_line) is not None:
+                    self.stage = stage_description
+                    print_server_startup_progress()
+                    break
+            if self.log_ready_pattern.search(log_line) is not None:
+                self.log_event.set()
+
+        def has_server_exited(self) -> bool:
+            return self.server_process is not None and self.server_process.poll() is not None
+
+        # Gives up when the process exits or stays silent for inactivity_timeout seconds.
+        def wait_until_ready(self) -> bool:
+            check_interval: float = SERVER_CHECK_MIN_INTERVAL
+            while True:
+                try:
+                    if self.probe():
+                        self.ready_time = time.perf_counter()
+                        self.stage = "online"
+                        self.is_ready = True
+                        new_print(f"{self.server_name} is online (ready in {"{:.2f}".format(self.get_elapsed_time())} s)", PRINT_COLORS["success"])
+                        return True
+                    self.last_activity_time = time.perf_counter()
+                except requests.exceptions.ConnectionError:
+                    pass
+                if self.is_cancelled or self.has_server_exited() or time.perf_counter() - self.last_activity_time > self.inactivity_timeout:
+                    self.stage = "failed"
+                    return False
+
+                if self.log_event.wait(check_interval):
+                    self.log_event.clear()
+                    check_interval = SERVER_CHECK_MIN_INTERVAL
+                else:
+                    check_interval = min(check_interval * SERVER_CHECK_BACKOFF_FACTOR, SERVER_CHECK_MAX_INTERVAL)
+
+        def cancel(self) -> None:
+            self.is_cancelled = True
+            self.log_event.set()
+
+    # Restarts a crashed server up to max_restarts times and logs to a rotating file.
+    class ServerProcessSupervisor:
+        def __init__(self, server_name: str, server_path: str, arguments: str, log_filename: str, log_stages: list[tuple[re.Pattern, str]], log_ready_pattern: re.Pattern, probe: typing.Callable[[], bool], inactivity_timeout: float, restart_callback: typing.Callable[[], None] | None=None) -> None:
+            self.server_name: str = server_name
+            self.server_path: str = server_path
+            self.arguments: str = arguments
+            self.log_stages: list[tuple[re.Pattern, str]] = log_stages
+            self.log_ready_pattern: re.Pattern = log_ready_pattern
+            self.probe: typing.Callable[[], bool] = probe
+            self.inactivity_timeout: float = inactivity_timeout
+            self.restart_callback: typing.Callable[[], None] | None = restart_callback
+            self.server_process: subprocess.Popen | None = None
+            self.handled_process: subprocess.Popen | None = None
+            self.startup_monitor: ServerStartupMonitor | None = None
+            self.restart_count: int = 0
+            self.is_stopping: bool = False
+            self.restart_lock: threading.Lock = threading.Lock()
+            self.server_logger: logging.Logger | None = None
+            if script_settings["server_startup_behavior"] == SERVER_STARTUP_BEHAVIOR_OPTIONS[1]:
+                os.makedirs(script_settings["server_supervisor_settings"]["log_dir"], exist_ok=True)
+                log_handler: logging.handlers.RotatingFileHandler = logging.handlers.RotatingFileHandler(f"{script_settings["server_supervisor_settings"]["log_dir"]}{log_filename}", maxBytes=script_settings["server_supervisor_settings"]["log_max_size_mb"] * 1024 * 1024, backupCount=script_settings["server_supervisor_settings"]["log_backup_count"], encoding="utf-8")
+                log_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+                self.server_logger = logging.getLogger(f"server_supervisor.{log_filename}")
+                self.server_logger.setLevel(logging.INFO)
+                self.server_logger.propagate = False
+                self.server_logger.addHandler(log_handler)
+
+        def start(self) -> ServerStartupMonitor:
+            self.server_process = start_server_process(self.server_path, self.arguments)
+            self.startup_monitor = ServerStartupMonitor(self.server_name, self.server_process, self.log_stages, self.log_ready_pattern, self.probe, self.inactivity_timeout, self.server_logger, self.handle_exit)
+            return self.startup_monitor
+
+        def is_running(self) -> bool:
+            return self.server_process is not None and self.server_process.poll() is None and self.startup_monitor.is_ready
+
+        # Called from the log thread and wait_for_restart(); the first caller handles it.
+        def handle_exit(self, exited_process: subprocess.Popen) -> bool:
+            with self.restart_lock:
+                if exited_process is not self.server_process or exited_process is self.handled_process:
+                    return self.is_running()
+                self.handled_process = exited_process
+                # A server that never became ready would only fail again.
+                if self.is_stopping or not self.startup_monitor.is_ready:
+                    return False
+
+                new_print(f"\n{self.server_name} exited unexpectedly (exit code {exited_process.wait()})", PRINT_COLORS["error"])
+                if not script_settings["server_supervisor_settings"]["restart_on_crash"] or self.restart_count >= script_settings["server_supervisor_settings"]["max_restarts"]:
+                    new_print(f"{self.server_name} won't be restarted", PRINT_COLORS["error"])
+                    return False
+                self.restart_count += 1
+                new_print(f"Restarting {self.server_name.lower()} ({self.restart_count}/{script_settings["server_supervisor_settings"]["max_restarts"]})", PRINT_COLORS["special"])
+                self.start()
+                if not self.startup_monitor.wait_until_ready():
+                    new_print(f"{self.server_name} couldn't be restarted", PRINT_COLORS["error"])
+                    return False
+                if self.restart_callback is not None:
+                    self.restart_callback()
+                if not text_model_turn_active and current_input_prompt != "":
+                    print(current_input_prompt, end="", flush=True)
+                return True
+
+        # Returns True once a crashed server was restarted and is ready.
+        def wait_for_restart(self) -> bool:
+            server_process: subprocess.Popen | None = self.server_process
+            if server_process is None:
+                return False
+            try:
+                server_process.wait(SERVER_EXIT_DETECTION_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                return False
+            return self.handle_exit(server_process)
+
+        def stop(self) -> None:
+            self.is_stopping = True
+            if self.startup_monitor is not None:
+                self.startup_monitor.cancel()
+            with self.restart_lock:
+                if self.server_process is not None and self.server_process.poll() is None:
+                    new_print(f"Stopping {self.server_name.lower()}", PRINT_COLORS["special"])
+                    self.server_process.terminate()
+                    try:
+                        self.server_process.wait(SERVER_SHUTDOWN_TIMEOUT)
+                    except subprocess.TimeoutExpired:
+                        self.server_process.kill()
+                        self.server_process.wait()
+                if self.startup_monitor is not None and self.startup_monitor.log_thread is not None:
+                    self.startup_monitor.log_thread.join(1.0)
+                if self.server_logger is not None:
+                    for log_handler in self.server_logger.handlers:
+                        log_handler.close()
 
     def new_print(string: str, string_color: str, end: str="\n") -> None:
         print(f"{string_color}{string}{colorama.Style.RESET_ALL}", end=end)
 
+    # One progress line for all servers that are starting.
+    def print_server_startup_progress() -> None:
+        with server_startup_progress_lock:
+            progress_string: str = " | ".join(f"{startup_monitor.server_name}: {startup_monitor.stage} ({"{:.1f}".format(startup_monitor.get_elapsed_time())} s)" for startup_monitor in server_startup_monitors)
+            new_print(progress_string, PRINT_COLORS["special"])
+
+    async def wait_for_server_startup() -> None:
+        try:
+            await asyncio.gather(*(asyncio.to_thread(startup_monitor.wait_until_ready) for startup_monitor in server_startup_monitors))
+        except asyncio.CancelledError: # Ctrl+C
+            for startup_monitor in server_startup_monitors:
+                startup_monitor.cancel()
+            raise
+
+    async def wait_for_server_restart(server_supervisor: ServerProcessSupervisor | None) -> bool:
+        if server_supervisor is None:
+            return False
+        return await asyncio.to_thread(server_supervisor.wait_for_restart)
+
+    def stop_managed_servers() -> None:
+        if not script_settings["server_supervisor_settings"]["stop_servers_on_exit"]:
+            return
+        for server_supervisor in (text_model_server_supervisor, image_model_server_supervisor):
+            if server_supervisor is not None:
+                server_supervisor.stop()
+
     def append_message(role: str, message: str, _file_path: str="") -> bool:
         if role not in TEXT_MODEL_CHAT_ROLES:
             new_print(f"Cannot add messages from role '{role}' to the context", PRINT_COLORS["error"])
@@ -417,45 +1126,60 @@ if __name__ == "__main__":
         filename: str = os.path.basename(_file_path)
         file_extension: str = get_path_extension(_file_path, False)
         does_file_exist: bool = os.path.exists(_file_path)
-        is_file_valid_url: bool = validators.url(_file_path)
-        is_file_generic_url: bool = is_generic_url(_file_path)
+        attachment_urls: list[str] = _file_path.split() if file_path_length > 0 and not does_file_exist and all(validators.url(_url) for _url in _file_path.split()) else []
+        is_file_valid_url: bool = len(attachment_urls) > 0
 
         if script_settings["disable_url_attachments"] and role == TEXT_MODEL_CHAT_ROLES[1] and is_file_valid_url:
             new_print("URL attachments are disabled", PRINT_COLORS["warning"])
             return append_message(role, message)
 
-        if (is_file_valid_url and is_file_generic_url) or filename in TEXT_MODEL_ATTACHMENT_GENERIC_FILENAMES or file_extension in TEXT_MODEL_ATTACHMENT_GENERIC_EXTENSIONS:
-            if not is_file_generic_url:
-                if not does_file_exist:
-                    new_print("File not found", PRINT_COLORS["warning"])
-                    return append_message(role, message)
+        if is_file_valid_url:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(attachment_urls), script_settings["attachment_settings"]["url_max_concurrent_fetches"])) as executor:
+                content_parts: list[dict] = [content_part for content_part in executor.map(get_url_content_part, attachment_urls) if content_part is not None]
+            if len(content_parts) == 0:
+                return append_message(role, message)
 
-                try:
-                    with open(_file_path, "rt") as _file:
-                        text_model_message_history.append({
-                            "role": role,
-                            "content": f"`{filename}`:\n\n```\n{_file.read()}\n```{f"\n\n{message}" if not is_message_empty else ""}",
-                        })
-                except UnicodeDecodeError:
-                    new_print("File is unreadable", PRINT_COLORS["warning"])
-                    return append_message(role, message)
-            else:
-                try:
-                    url_content_response: requests.Response = requests.get(_file_path)
-                    url_content_response.raise_for_status()
-                    text_model_message_history.append({
-                        "role": role,
-                        "content": f"`{_file_path}`:\n\n```\n{url_content_response.text}\n```{f"\n\n{message}" if not is_message_empty else ""}",
-                    })
-                except requests.HTTPError:
-                    new_print("URL not found", PRINT_COLORS["warning"])
-                    return append_message(role, message)
-                except requests.ConnectionError:
-                    new_print("Failed to resolve URL", PRINT_COLORS["warning"])
-                    return append_message(role, message)
+            url_attachment: str = "\n\n".join(content_part["text"] for content_part in content_parts if content_part["type"] == "text")
+            text_content: str = join_attachment_and_message(url_attachment, message) if url_attachment != "" else message
+            image_content_parts: list[dict] = [content_part for content_part in content_parts if content_part["type"] == "image_url"]
+            text_model_message_history.append({
+                "role": role,
+                "content": text_content if len(image_content_parts) == 0 else [
+                    {
+                        "type": "text",
+                        "text": text_content,
+                    },
+                    *image_content_parts,
+                ],
+            })
+            return True
+        elif os.path.isdir(_file_path) or (is_glob_pattern(_file_path) and not does_file_exist):
+            directory_attachment: str = get_directory_attachment(_file_path)
+            if directory_attachment == "":
+                new_print("No supported text files found", PRINT_COLORS["warning"])
+                return append_message(role, message)
+
+            text_model_message_history.append({
+                "role": role,
+                "content": join_attachment_and_message(directory_attachment, message),
+            })
+            return True
+        elif filename in TEXT_MODEL_ATTACHMENT_GENERIC_FILENAMES or file_extension in TEXT_MODEL_ATTACHMENT_GENERIC_EXTENSIONS:
+            if not does_file_exist:
+                new_print("File not found", PRINT_COLORS["warning"])
+                return append_message(role, message)
+
+            try:
+                text_model_message_history.append({
+                    "role": role,
+                    "content": join_attachment_and_message(get_retrievable_attachment(f"file:{os.path.abspath(_file_path)}", filename, get_file_attachment(ATTACHMENT_CACHE_KINDS[0], _file_path, render_text_file_attachment)[1].decode("utf-8")), message),
+                })
+            except UnicodeDecodeError:
+                new_print("File is unreadable", PRINT_COLORS["warning"])
+                return append_message(role, message)
             return True
         elif file_extension in TEXT_MODEL_ATTACHMENT_IMAGE_EXTENSIONS:
-            if not is_file_valid_url and not does_file_exist:
+            if not does_file_exist:
                 new_print("File not found", PRINT_COLORS["warning"])
                 return append_message(role, message)
 
@@ -463,6 +1187,11 @@ if __name__ == "__main__":
                 new_print(f"Vision is not enabled for '{text_model_id}'", PRINT_COLORS["warning"])
                 return append_message(role, message)
 
+            image_url: str | None = get_image_data(_file_path)
+            if image_url is None:
+                new_print("File exceeds the attachment size limit", PRINT_COLORS["warning"])
+                return append_message(role, message)
+
             text_model_message_history.append({
                 "role": role,
                 "content": [
@@ -473,7 +1202,7 @@ if __name__ == "__main__":
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": get_image_data(_file_path) if not is_file_valid_url else _file_path,
+                            "url": image_url,
                         },
                     },
                 ]
@@ -488,6 +1217,10 @@ if __name__ == "__main__":
                 new_print(f"Audio is not enabled for '{text_model_id}'", PRINT_COLORS["warning"])
                 return append_message(role, message)
 
+            if os.path.getsize(_file_path) > script_settings["attachment_settings"]["max_size_mb"] * 1024 * 1024:
+                new_print("File exceeds the attachment size limit", PRINT_COLORS["warning"])
+                return append_message(role, message)
+
             text_model_message_history.append({
                 "role": role,
                 "content": [
@@ -522,17 +1255,20 @@ if __name__ == "__main__":
                 return script_mode.capitalize()
         return "Unknown"
 
-    def poll_text_model_server_api() -> None:
-        text_model_health_response: requests.Response = requests.get(f"{text_model_server_url}/health")
-        if text_model_health_response.status_code == 200:
-            global text_model_server_active
-            text_model_server_active = True
-            new_print("Text model server is online", PRINT_COLORS["success"])
+    # llama-server answers /health with 503 while the model is loading.
+    def poll_text_model_server_api() -> bool:
+        global text_model_server_active
+        text_model_server_active = send_http_request(HTTP_CLIENT_BACKENDS[0], "GET", f"{text_model_server_url}/health").status_code == 200
+        return text_model_server_active
+
+    # Raises ConnectionError while KoboldCpp isn't listening.
+    def poll_image_model_server_api() -> bool:
+        image_model_info_response: requests.Response = send_http_request(HTTP_CLIENT_BACKENDS[1], "GET", f"{image_model_server_url}/sdapi/v1/sd-models")
+        return len(image_model_info_response.json()) > 0
 
     def is_image_model_server_online() -> bool:
         try:
-            image_model_info_response: requests.Response = requests.get(f"{image_model_server_url}/sdapi/v1/sd-models")
-            if len(image_model_info_response.json()) > 0:
+            if poll_image_model_server_api():
                 new_print("Image model server is online\n", PRINT_COLORS["success"])
                 return True
             return False
@@ -561,16 +1297,75 @@ if __name__ == "__main__":
             "dry_allowed_length": script_settings["text_model_gen_settings"]["dry_allowed_length"],
             "xtc_probability": script_settings["text_model_gen_settings"]["xtc_probability"],
             "xtc_threshold": script_settings["text_model_gen_settings"]["xtc_threshold"],
+            "seed": script_settings["text_model_gen_settings"]["seed"],
         }
 
     def process_text(text: str, return_with_thoughts: bool) -> str:
-        if return_with_thoughts or ("<think>" not in text and "</think>" not in text):
+        if return_with_thoughts or (TEXT_MODEL_THOUGHT_START_TAG not in text and TEXT_MODEL_THOUGHT_END_TAG not in text):
+            return text
+        return filter_thoughts(text).get_text()
+
+    def filter_thoughts(text: str) -> ThoughtFilter:
+        thought_filter: ThoughtFilter = ThoughtFilter()
+        thought_filter.feed(text)
+        thought_filter.finish()
+        return thought_filter
+
+    # Rendered identically every time so that re-attaching reproduces the same tokens.
+    def render_attachment_block(name: str, text: str) -> str:
+        text = text.replace("\r\n", "\n").replace("\r", "\n").rstrip()
+        fence: str = "```"
+        while fence in text:
+            fence += "`"
+        return f"`{name}`:\n\n{fence}\n{text}\n{fence}"
+
+    # Inverse of render_attachment_block().
+    def get_attachment_block_text(attachment_block: str) -> str:
+        return "\n".join(attachment_block.split("\n")[3:-1])
+
+    def join_attachment_and_message(attachment_block: str, message: str) -> str:
+        return f"{attachment_block}{f"\n\n{message}" if message.rstrip() != "" else ""}"
+
+    # Stable prefix mode keeps responses as generated to match the KV cache.
+    def process_model_message_for_history(text: str, thought_filter: ThoughtFilter | None=None) -> str:
+        if script_settings["text_model_gen_settings"]["chat_stable_prompt_prefix"] or script_settings["text_model_gen_settings"]["chat_include_thoughts_in_history"]:
             return text
+        if thought_filter is not None:
+            return thought_filter.get_text()
+        return process_text(text, False)
+
+    # Collapsed thoughts are shown as their length.
+    def write_streamed_segments(stream_printer: StreamPrinter, thought_filter: ThoughtFilter, segments: list[tuple[bool, str]], is_stream_finished: bool=False) -> None:
+        streamed_thoughts_mode: str = script_settings["text_model_gen_settings"]["chat_streamed_thoughts_mode"]
+        for is_thought, text in segments:
+            if not is_thought:
+                if text == "" and streamed_thoughts_mode == TEXT_MODEL_STREAMED_THOUGHTS_MODES[2]:
+                    stream_printer.write(f" {thought_filter.thought_length} characters]{colorama.Style.RESET_ALL}\n\n")
+                stream_printer.write(text)
+            elif text == "" and streamed_thoughts_mode == TEXT_MODEL_STREAMED_THOUGHTS_MODES[2]:
+                stream_printer.write(f"{PRINT_COLORS["special"]}[Thinking...")
+        # A response cut off inside a thought still closes the collapsed line.
+        if is_stream_finished and thought_filter.is_in_thought and streamed_thoughts_mode == TEXT_MODEL_STREAMED_THOUGHTS_MODES[2]:
+            stream_printer.write(f" {thought_filter.thought_length} characters]{colorama.Style.RESET_ALL}")
+
+    def construct_text_model_cache_parameters() -> dict:
+        if not script_settings["text_model_gen_settings"]["chat_stable_prompt_prefix"]:
+            return {}
+        return {
+            "cache_prompt": True,
+            "id_slot": max(script_settings["text_model_gen_settings"]["chat_slot_id"], 0),
+        }
 
-        text_buffer: str = ""
-        for pattern_match in re.findall(r"(<think>.*?</think>\n*)(.*?)(?=<think>|$)", text, re.DOTALL):
-            text_buffer += pattern_match[1]
-        return text_buffer
+    def report_prompt_cache_usage(timings: dict | None) -> None:
+        if timings is None or not script_settings["text_model_gen_settings"]["chat_stable_prompt_prefix"]:
+            return
+        new_print(f"Prompt tokens: {timings.get("cache_n", 0)} cached, {timings.get("prompt_n", 0)} evaluated", PRINT_COLORS["special"])
+
+    # Only reported when llama-server runs with a draft model.
+    def report_draft_acceptance(timings: dict | None) -> None:
+        if timings is None or timings.get("draft_n", 0) == 0:
+            return
+        new_print(f"Draft tokens: {timings["draft_n_accepted"]}/{timings["draft_n"]} accepted ({"{:.1f}".format(timings["draft_n_accepted"] / timings["draft_n"] * 100.0)}%)", PRINT_COLORS["special"])
 
     def strip_leading_and_trailing_quotes(text: str) -> str:
         return text.removeprefix("\"").removesuffix("\"")
@@ -580,21 +1375,2195 @@ if __name__ == "__main__":
         return path_extension if not omit_dot else path_extension[1:]
 
     def is_generic_url(url: str) -> bool:
-        for url_pattern in TEXT_MODEL_ATTACHMENT_GENERIC_URL_PATTERNS:
-            if re.search(url_pattern, url):
-                return True
-        return False
+        return TEXT_MODEL_ATTACHMENT_GENERIC_URL_PATTERN.search(url) is not None
 
-    def get_image_data(path: str) -> str:
-        with open(path, "rb") as _file:
-            return f"data:image/{get_path_extension(path, True)};base64,{base64.b64encode(_file.read()).decode()}"
+    # Returns None if the image is too large and can't be downscaled.
+    def get_image_data(path: str) -> str | None:
+        if os.path.getsize(path) <= script_settings["attachment_settings"]["max_size_mb"] * 1024 * 1024:
+            return store_attachment_blob(*get_file_attachment(ATTACHMENT_CACHE_KINDS[1], path, lambda _path: encode_file_base64(_path, f"data:image/{get_path_extension(_path, True)};base64,".encode())))
+        if not script_settings["attachment_settings"]["downscale_oversized_images"] or PIL is None:
+            return None
+        return store_attachment_blob(*get_file_attachment(ATTACHMENT_CACHE_KINDS[1], path, downscale_image, f"@{script_settings["attachment_settings"]["image_max_dimension"]}"))
 
     def get_audio_data(path: str) -> dict:
+        return {
+            "data": store_attachment_blob(*get_file_attachment(ATTACHMENT_CACHE_KINDS[2], path, lambda _path: encode_file_base64(_path, b""))),
+            "format": get_path_extension(path, True)
+        }
+
+    def render_text_file_attachment(path: str) -> bytes:
+        with open(path, "rt") as _file:
+            return render_attachment_block(os.path.basename(path), _file.read()).encode("utf-8")
+
+    def is_text_attachment_path(path: str) -> bool:
+        return os.path.basename(path) in TEXT_MODEL_ATTACHMENT_GENERIC_FILENAMES or get_path_extension(path, False) in TEXT_MODEL_ATTACHMENT_GENERIC_EXTENSIONS
+
+    def is_glob_pattern(path: str) -> bool:
+        return any(character in path for character in ATTACHMENT_GLOB_CHARACTERS)
+
+    # Patterns without a slash match at any depth, the others are anchored.
+    def get_gitignore_rules(dir_path: str) -> list[tuple[str, re.Pattern, bool, bool]]:
+        gitignore_rules: list[tuple[str, re.Pattern, bool, bool]] = []
+        try:
+            with open(os.path.join(dir_path, ATTACHMENT_GITIGNORE_FILENAME), "rt", encoding="utf-8") as _file:
+                gitignore_lines: list[str] = _file.read().splitlines()
+        except (OSError, UnicodeDecodeError):
+            return gitignore_rules
+
+        for gitignore_line in gitignore_lines:
+            pattern: str = gitignore_line.rstrip()
+            if pattern == "" or pattern.startswith("#"):
+                continue
+            is_negated: bool = pattern.startswith("!")
+            pattern = pattern.removeprefix("!").removeprefix("\\")
+            is_dir_only: bool = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            is_anchored: bool = "/" in pattern
+            pattern = pattern.removeprefix("/")
+            if pattern == "":
+                continue
+
+            pattern_regex: str = "" if is_anchored else "(?:.*/)?"
+            index: int = 0
+            while index < len(pattern):
+                if pattern.startswith("**/", index):
+                    pattern_regex += "(?:.*/)?"
+                    index += 3
+                elif pattern.startswith("**", index):
+                    pattern_regex += ".*"
+                    index += 2
+                elif pattern[index] == "*":
+                    pattern_regex += "[^/]*"
+                    index += 1
+                elif pattern[index] == "?":
+                    pattern_regex += "[^/]"
+                    index += 1
+                elif pattern[index] == "[" and "]" in pattern[index + 2:]:
+                    bracket_end: int = pattern.index("]", index + 2)
+                    bracket_content: str = pattern[index + 1:bracket_end]
+                    pattern_regex += f"[{f"^{bracket_content[1:]}" if bracket_content.startswith("!") else bracket_content}]"
+                    index = bracket_end + 1
+                else:
+                    pattern_regex += re.escape(pattern[index])
+                    index += 1
+            try:
+                gitignore_rules.append((dir_path, re.compile(pattern_regex), is_negated, is_dir_only))
+            except re.error:
+                continue
+        return gitignore_rules
+
+    # The last matching rule wins, like in git.
+    def is_path_gitignored(path: str, is_dir: bool, gitignore_rules: list[tuple[str, re.Pattern, bool, bool]]) -> bool:
+        is_ignored: bool = False
+        for base_dir_path, pattern, is_negated, is_dir_only in gitignore_rules:
+            if is_dir_only and not is_dir:
+                continue
+            if pattern.fullmatch(os.path.relpath(path, base_dir_path).replace(os.sep, "/")):
+                is_ignored = not is_negated
+        return is_ignored
+
+    # Skips .git and whatever the .gitignore files up to the repository root exclude.
+    def get_directory_attachment_paths(path: str) -> list[tuple[str, str]]:
+        glob_matches: set[str] | None = None
+        root_path: str = path
+        if is_glob_pattern(path):
+            glob_matches = {os.path.abspath(_path) for _path in glob.glob(path, recursive=True)}
+            path_parts: list[str] = re.split(r"[\\/]", path)
+            root_parts: list[str] = []
+            for path_part in path_parts[:-1]:
+                if is_glob_pattern(path_part):
+                    break
+                root_parts.append(path_part)
+            root_path = "/".join(root_parts) if len(root_parts) > 0 else "."
+            if root_path == "":
+                root_path = "/"
+
+        parent_gitignore_rules: list[tuple[str, re.Pattern, bool, bool]] = []
+        parent_dir_path: str = os.path.abspath(root_path)
+        while not os.path.isdir(os.path.join(parent_dir_path, ".git")) and os.path.dirname(parent_dir_path) != parent_dir_path:
+            parent_dir_path = os.path.dirname(parent_dir_path)
+            parent_gitignore_rules = get_gitignore_rules(parent_dir_path) + parent_gitignore_rules
+
+        attachment_paths: list[tuple[str, str]] = []
+        dir_gitignore_rules: dict[str, list[tuple[str, re.Pattern, bool, bool]]] = {
+            root_path: parent_gitignore_rules,
+        }
+        for dir_path, dir_names, filenames in os.walk(root_path):
+            gitignore_rules: list[tuple[str, re.Pattern, bool, bool]] = dir_gitignore_rules.pop(dir_path, []) + get_gitignore_rules(dir_path)
+            dir_names[:] = sorted(dir_name for dir_name in dir_names if dir_name not in ATTACHMENT_IGNORED_DIR_NAMES and not is_path_gitignored(os.path.join(dir_path, dir_name), True, gitignore_rules))
+            for dir_name in dir_names:
+                dir_gitignore_rules[os.path.join(dir_path, dir_name)] = gitignore_rules
+
+            for filename in sorted(filenames):
+                file_path: str = os.path.join(dir_path, filename)
+                if not is_text_attachment_path(file_path) or is_path_gitignored(file_path, False, gitignore_rules):
+                    continue
+                if glob_matches is not None and os.path.abspath(file_path) not in glob_matches:
+                    continue
+                attachment_paths.append((file_path, os.path.relpath(file_path, root_path).replace(os.sep, "/")))
+        return attachment_paths
+
+    # Binary files are rejected from their first bytes.
+    def read_text_attachment_file(path: str) -> str | None:
+        if os.path.getsize(path) > script_settings["attachment_settings"]["max_size_mb"] * 1024 * 1024:
+            return None
+        with open(path, "rb") as _file:
+            file_head: bytes = _file.read(ATTACHMENT_BINARY_SNIFF_SIZE)
+            if b"\0" in file_head:
+                return None
+            try:
+                codecs.getincrementaldecoder("utf-8")().decode(file_head, False)
+            except UnicodeDecodeError:
+                return None
+            file_data: bytes = file_head + _file.read()
+        try:
+            return file_data.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+
+    # Returns None if the file is not text.
+    def get_directory_attachment_block(path: str, name: str) -> tuple[str, int] | None:
+        try:
+            text: str | None = read_text_attachment_file(path)
+        except OSError:
+            return None
+        if text is None:
+            return None
+
+        attachment_block: str = get_retrievable_attachment(f"file:{os.path.abspath(path)}", name, render_attachment_block(name, text))
+        token_count: int = count_text_tokens(attachment_block)
+        if token_count > script_settings["attachment_settings"]["max_file_tokens"]:
+            text = text[:len(text) * script_settings["attachment_settings"]["max_file_tokens"] // token_count]
+            if "\n" in text:
+                text = text[:text.rindex("\n")]
+            attachment_block = render_attachment_block(f"{name} (truncated)", text)
+            token_count = count_text_tokens(attachment_block)
+        return attachment_block, token_count
+
+    # Stops once max_total_tokens is reached.
+    def get_directory_attachment(path: str) -> str:
+        attachment_paths: list[tuple[str, str]] = get_directory_attachment_paths(path)
+        if len(attachment_paths) > script_settings["attachment_settings"]["max_directory_files"]:
+            new_print(f"Found {len(attachment_paths)} files, attaching the first {script_settings["attachment_settings"]["max_directory_files"]}", PRINT_COLORS["warning"])
+            attachment_paths = attachment_paths[:script_settings["attachment_settings"]["max_directory_files"]]
+
+        get_attachment_cache_index()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=script_settings["attachment_settings"]["directory_read_threads"]) as executor:
+            attachment_results: list[tuple[str, int] | None] = list(executor.map(lambda attachment_path: get_directory_attachment_block(*attachment_path), attachment_paths))
+
+        text_attachment_results: list[tuple[str, int]] = [attachment_result for attachment_result in attachment_results if attachment_result is not None]
+        if len(text_attachment_results) < len(attachment_results):
+            new_print(f"Skipped {len(attachment_results) - len(text_attachment_results)} binary, unreadable or oversized files", PRINT_COLORS["warning"])
+
+        attachment_blocks: list[str] = []
+        total_token_count: int = 0
+        for attachment_block, token_count in text_attachment_results:
+            if total_token_count + token_count > script_settings["attachment_settings"]["max_total_tokens"]:
+                new_print(f"Reached the limit of {script_settings["attachment_settings"]["max_total_tokens"]} tokens, {len(text_attachment_results) - len(attachment_blocks)} files were left out", PRINT_COLORS["warning"])
+                break
+            attachment_blocks.append(attachment_block)
+            total_token_count += token_count
+
+        if len(attachment_blocks) > 0:
+            new_print(f"Attached {len(attachment_blocks)} files ({total_token_count} tokens)", PRINT_COLORS["special"])
+        return "\n\n".join(attachment_blocks)
+
+    # Encodes chunk by chunk from a memory map into one preallocated buffer.
+    def encode_file_base64(path: str, prefix: bytes) -> bytearray:
+        file_size: int = os.path.getsize(path)
+        encoded_data: bytearray = bytearray(len(prefix) + 4 * ((file_size + 2) // 3))
+        encoded_data[:len(prefix)] = prefix
+        if file_size == 0:
+            return encoded_data
+
+        write_offset: int = len(prefix)
+        with open(path, "rb") as _file, mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            for read_offset in range(0, file_size, ATTACHMENT_ENCODING_CHUNK_SIZE):
+                encoded_chunk: bytes = binascii.b2a_base64(mapped_file[read_offset:read_offset + ATTACHMENT_ENCODING_CHUNK_SIZE], newline=False)
+                encoded_data[write_offset:write_offset + len(encoded_chunk)] = encoded_chunk
+                write_offset += len(encoded_chunk)
+        return encoded_data
+
+    def downscale_image(path: str) -> bytes:
+        with PIL.Image.open(path) as image:
+            image.thumbnail((script_settings["attachment_settings"]["image_max_dimension"], script_settings["attachment_settings"]["image_max_dimension"]))
+            image_buffer: io.BytesIO = io.BytesIO()
+            image.convert("RGB").save(image_buffer, "JPEG", quality=90)
+        return b"data:image/jpeg;base64," + base64.b64encode(image_buffer.getbuffer())
+
+    # The history only holds a reference; encode_request_body() splices the data in.
+    def store_attachment_blob(blob_id: str, data: bytes | bytearray) -> str:
+        if blob_id not in attachment_blobs:
+            attachment_blobs[blob_id] = data
+        return f"{ATTACHMENT_BLOB_REFERENCE_PREFIX}{blob_id}"
+
+    # Messages are never modified once appended, so each is serialized once; odd parts hold blob ids.
+    def get_message_fragment_parts(message: dict) -> list[bytes]:
+        message_id: int = id(message)
+        if message_id in text_model_message_fragment_cache and text_model_message_fragment_cache[message_id][0] is message:
+            return text_model_message_fragment_cache[message_id][1]
+
+        fragment_parts: list[bytes] = ATTACHMENT_BLOB_REFERENCE_PATTERN.split(json.dumps(message).encode())
+
+        if len(text_model_message_fragment_cache) > 2 * len(text_model_message_history) + 16:
+            live_message_ids: set[int] = {id(_message) for _message in text_model_message_history}
+            if text_model_context_summary_message is not None:
+                live_message_ids.add(id(text_model_context_summary_message))
+            for cached_message_id in list(text_model_message_fragment_cache.keys()):
+                if cached_message_id not in live_message_ids:
+                    del text_model_message_fragment_cache[cached_message_id]
+        text_model_message_fragment_cache[message_id] = (message, fragment_parts)
+        return fragment_parts
+
+    def encode_request_body(payload: dict, messages: list[dict]) -> bytes:
+        body_parts: list[bytes | bytearray] = [json.dumps(payload).encode()[:-1], b', "messages": [']
+        for message_index, message in enumerate(messages):
+            if message_index > 0:
+                body_parts.append(b", ")
+            for part_index, fragment_part in enumerate(get_message_fragment_parts(message)):
+                body_parts.append(attachment_blobs.get(fragment_part.decode(), ATTACHMENT_BLOB_REFERENCE_PREFIX.encode() + fragment_part) if part_index % 2 == 1 else fragment_part)
+        body_parts.append(b"]}")
+        return b"".join(body_parts)
+
+    def get_attachment_cache_index() -> dict:
+        global attachment_cache_index
+        if attachment_cache_index is None:
+            attachment_cache_index = {
+                "sources": {},
+                "entries": {},
+            }
+            try:
+                with open(f"{script_settings["attachment_cache_settings"]["cache_dir"]}{ATTACHMENT_CACHE_INDEX_FILENAME}", "rt", encoding="utf-8") as _file:
+                    saved_index: dict = json.load(_file)
+                    if isinstance(saved_index.get("sources"), dict) and isinstance(saved_index.get("entries"), dict):
+                        attachment_cache_index = saved_index
+            except (FileNotFoundError, UnicodeDecodeError, json.JSONDecodeError):
+                pass
+        return attachment_cache_index
+
+    def save_attachment_cache_index() -> None:
+        os.makedirs(script_settings["attachment_cache_settings"]["cache_dir"], exist_ok=True)
+        with open(f"{script_settings["attachment_cache_settings"]["cache_dir"]}{ATTACHMENT_CACHE_INDEX_FILENAME}", "wt", encoding="utf-8") as _file:
+            json.dump(get_attachment_cache_index(), _file)
+
+    # Keyed by content hash and rendering, so the same bytes from another path hit too.
+    def get_attachment_cache_entry_key(kind: str, name: str, content_hash: str) -> str:
+        return hashlib.sha256(f"{kind}\0{name}\0{content_hash}".encode()).hexdigest()
+
+    def read_attachment_cache(entry_key: str) -> bytes | None:
+        if not script_settings["attachment_cache_settings"]["enabled"]:
+            return None
+
+        with attachment_cache_lock:
+            cache_entries: dict = get_attachment_cache_index()["entries"]
+            if entry_key not in cache_entries:
+                return None
+            try:
+                with open(f"{script_settings["attachment_cache_settings"]["cache_dir"]}{entry_key}", "rb") as _file:
+                    cached_data: bytes = _file.read()
+            except FileNotFoundError:
+                del cache_entries[entry_key]
+                return None
+            cache_entries[entry_key]["last_access"] = time.time()
+            save_attachment_cache_index()
+            return cached_data
+
+    def write_attachment_cache(entry_key: str, content_hash: str, data: bytes | bytearray) -> None:
+        if not script_settings["attachment_cache_settings"]["enabled"]:
+            return
+
+        with attachment_cache_lock:
+            os.makedirs(script_settings["attachment_cache_settings"]["cache_dir"], exist_ok=True)
+            with open(f"{script_settings["attachment_cache_settings"]["cache_dir"]}{entry_key}", "wb") as _file:
+                _file.write(data)
+            cache_index: dict = get_attachment_cache_index()
+            cache_index["entries"][entry_key] = {
+                "content_hash": content_hash,
+                "size": len(data),
+                "last_access": time.time(),
+            }
+
+            # Evict the least recently used entries until the cache fits its size budget again.
+            max_cache_size: int = script_settings["attachment_cache_settings"]["max_size_mb"] * 1024 * 1024
+            cache_size: int = sum(cache_entry["size"] for cache_entry in cache_index["entries"].values())
+            for cached_entry_key, cache_entry in sorted(cache_index["entries"].items(), key=lambda item: item[1]["last_access"]):
+                if cache_size <= max_cache_size:
+                    break
+                try:
+                    os.remove(f"{script_settings["attachment_cache_settings"]["cache_dir"]}{cached_entry_key}")
+                except OSError:
+                    continue
+                cache_size -= cache_entry["size"]
+                del cache_index["entries"][cached_entry_key]
+            live_content_hashes: set[str] = {cache_entry["content_hash"] for cache_entry in cache_index["entries"].values()}
+            for source_key in [source_key for source_key, source in cache_index["sources"].items() if source["content_hash"] not in live_content_hashes]:
+                del cache_index["sources"][source_key]
+            save_attachment_cache_index()
+
+    def set_attachment_cache_source(source_key: str, source: dict) -> None:
+        if script_settings["attachment_cache_settings"]["enabled"]:
+            with attachment_cache_lock:
+                get_attachment_cache_index()["sources"][source_key] = source
+                save_attachment_cache_index()
+
+    # Files with the same path, size and mtime are served without being read.
+    def get_file_attachment(kind: str, path: str, render_attachment: typing.Callable[[str], bytes | bytearray], variant: str="") -> tuple[str, bytes | bytearray]:
+        name: str = f"{os.path.basename(path)}{variant}"
+        file_stat: os.stat_result = os.stat(path)
+        source_key: str = f"file:{os.path.abspath(path)}:{file_stat.st_size}:{file_stat.st_mtime_ns}"
+        source: dict | None = get_attachment_cache_index()["sources"].get(source_key) if script_settings["attachment_cache_settings"]["enabled"] else None
+        if source is not None:
+            entry_key: str = get_attachment_cache_entry_key(kind, name, source["content_hash"])
+            cached_data: bytes | None = read_attachment_cache(entry_key)
+            if cached_data is not None:
+                return entry_key, cached_data
+
         with open(path, "rb") as _file:
+            content_hash: str = hashlib.file_digest(_file, "sha256").hexdigest()
+        entry_key: str = get_attachment_cache_entry_key(kind, name, content_hash)
+        rendered_attachment: bytes | bytearray | None = read_attachment_cache(entry_key)
+        if rendered_attachment is None:
+            rendered_attachment = render_attachment(path)
+            write_attachment_cache(entry_key, content_hash, rendered_attachment)
+        set_attachment_cache_source(source_key, {
+            "content_hash": content_hash,
+        })
+        return entry_key, rendered_attachment
+
+    # URLs are revalidated with a conditional GET.
+    def get_url_attachment(url: str) -> str:
+        source_key: str = f"url:{url}"
+        source: dict | None = get_attachment_cache_index()["sources"].get(source_key) if script_settings["attachment_cache_settings"]["enabled"] else None
+        request_headers: dict[str, str] = {}
+        if source is not None:
+            if source.get("etag") is not None:
+                request_headers["If-None-Match"] = source["etag"]
+            if source.get("last_modified") is not None:
+                request_headers["If-Modified-Since"] = source["last_modified"]
+
+        url_content_response, url_content = fetch_url_content(url, request_headers, script_settings["attachment_settings"]["url_max_size_mb"])
+        if url_content_response.status_code == 304 and source is not None:
+            cached_data: bytes | None = read_attachment_cache(get_attachment_cache_entry_key(ATTACHMENT_CACHE_KINDS[0], url, source["content_hash"]))
+            if cached_data is not None:
+                return cached_data.decode("utf-8")
+            url_content_response, url_content = fetch_url_content(url, {}, script_settings["attachment_settings"]["url_max_size_mb"])
+
+        content_hash: str = hashlib.sha256(url_content).hexdigest()
+        entry_key: str = get_attachment_cache_entry_key(ATTACHMENT_CACHE_KINDS[0], url, content_hash)
+        cached_data: bytes | None = read_attachment_cache(entry_key)
+        if cached_data is not None:
+            rendered_attachment: str = cached_data.decode("utf-8")
+        else:
+            rendered_attachment: str = render_attachment_block(url, decode_url_content(url_content, url_content_response.headers.get("Content-Type", "")))
+            write_attachment_cache(entry_key, content_hash, rendered_attachment.encode("utf-8"))
+        set_attachment_cache_source(source_key, {
+            "content_hash": content_hash,
+            "etag": url_content_response.headers.get("ETag"),
+            "last_modified": url_content_response.headers.get("Last-Modified"),
+        })
+        return rendered_attachment
+
+    # Gives up past url_max_size_mb or url_total_timeout.
+    def fetch_url_content(url: str, request_headers: dict[str, str], max_size_mb: int) -> tuple[requests.Response, bytes]:
+        max_size: int = max_size_mb * 1024 * 1024
+        download_deadline: float = time.perf_counter() + script_settings["attachment_settings"]["url_total_timeout"]
+        with send_http_request(HTTP_CLIENT_BACKENDS[2], "GET", url, headers=request_headers, stream=True) as url_content_response:
+            url_content_response.raise_for_status()
+            content_length: str = url_content_response.headers.get("Content-Length", "")
+            if content_length.isdigit() and int(content_length) > max_size:
+                raise ValueError("URL exceeds the attachment size limit")
+
+            # read1() returns as soon as data arrives, so trickling bytes can't miss the deadline.
+            url_content: bytearray = bytearray()
+            while True:
+                try:
+                    chunk: bytes = url_content_response.raw.read1(ATTACHMENT_URL_CHUNK_SIZE, decode_content=True)
+                except urllib3.exceptions.ReadTimeoutError as error:
+                    raise requests.Timeout(error)
+                except urllib3.exceptions.HTTPError as error:
+                    raise requests.ConnectionError(error)
+                if len(chunk) == 0:
+                    break
+                url_content += chunk
+                if len(url_content) > max_size:
+                    raise ValueError("URL exceeds the attachment size limit")
+                if time.perf_counter() > download_deadline:
+                    raise requests.Timeout("URL download exceeded url_total_timeout")
+        return url_content_response, bytes(url_content)
+
+    # BOM, then Content-Type or <meta>, then UTF-8, then charset_normalizer.
+    def decode_url_content(url_content: bytes, content_type: str) -> str:
+        for byte_order_mark, encoding in ATTACHMENT_BYTE_ORDER_MARKS.items():
+            if url_content.startswith(byte_order_mark):
+                return url_content[len(byte_order_mark):].decode(encoding, errors="replace")
+
+        encodings: list[str] = []
+        for charset_source in (content_type.encode("latin-1", errors="replace"), url_content[:ATTACHMENT_URL_CHARSET_SNIFF_SIZE]):
+            charset_match: re.Match | None = ATTACHMENT_URL_CHARSET_PATTERN.search(charset_source)
+            if charset_match is not None:
+                encodings.append(charset_match.group(1).decode("ascii"))
+        encodings.append("utf-8")
+        for encoding in encodings:
+            try:
+                return url_content.decode(encoding)
+            except (LookupError, UnicodeDecodeError):
+                continue
+
+        best_match: charset_normalizer.CharsetMatch | None = charset_normalizer.from_bytes(url_content).best()
+        return str(best_match) if best_match is not None else url_content.decode("utf-8", errors="replace")
+
+    # Downloaded so that the image size limit applies.
+    def get_url_image_data(url: str) -> str:
+        url_content_response, url_content = fetch_url_content(url, {}, script_settings["attachment_settings"]["max_size_mb"])
+        content_type: str = url_content_response.headers.get("Content-Type", "").split(";")[0].strip()
+        if not content_type.startswith("image/"):
+            content_type = f"image/{get_path_extension(urllib.parse.urlparse(url).path, True)}"
+        return store_attachment_blob(get_attachment_cache_entry_key(ATTACHMENT_CACHE_KINDS[1], url, hashlib.sha256(url_content).hexdigest()), f"data:{content_type};base64,".encode() + base64.b64encode(url_content))
+
+    # Returns None after printing why the URL was skipped.
+    def get_url_content_part(url: str) -> dict | None:
+        try:
+            if get_path_extension(urllib.parse.urlparse(url).path, False) in TEXT_MODEL_ATTACHMENT_IMAGE_EXTENSIONS:
+                if not text_model_modalities["vision"]:
+                    new_print(f"Vision is not enabled for '{text_model_id}'", PRINT_COLORS["warning"])
+                    return None
+                return {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": get_url_image_data(url),
+                    },
+                }
+            if is_generic_url(url):
+                return {
+                    "type": "text",
+                    "text": get_retrievable_attachment(f"url:{url}", url, get_url_attachment(url)),
+                }
+            new_print(f"URL is unsupported: {url}", PRINT_COLORS["warning"])
+        except UnicodeDecodeError:
+            new_print(f"URL is unreadable: {url}", PRINT_COLORS["warning"])
+        except ValueError:
+            new_print(f"URL exceeds the attachment size limit: {url}", PRINT_COLORS["warning"])
+        except requests.HTTPError:
+            new_print(f"URL not found: {url}", PRINT_COLORS["warning"])
+        except requests.Timeout:
+            new_print(f"URL timed out: {url}", PRINT_COLORS["warning"])
+        except requests.ConnectionError:
+            new_print(f"Failed to resolve URL: {url}", PRINT_COLORS["warning"])
+        except requests.RequestException:
+            new_print(f"Failed to download URL: {url}", PRINT_COLORS["warning"])
+        return None
+
+    def get_http_session(backend: str) -> requests.Session:
+        if backend not in http_sessions:
+            adapter: TimedHTTPAdapter = TimedHTTPAdapter(
+                pool_connections=script_settings["http_client_settings"]["pool_connections"],
+                pool_maxsize=max(script_settings["http_client_settings"]["pool_max_size"], script_settings["text_model_init_settings"]["parallel_slots"], script_settings["attachment_settings"]["url_max_concurrent_fetches"]),
+            )
+            session: requests.Session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            http_sessions[backend] = session
+        return http_sessions[backend]
+
+    # External URLs get the short attachment timeouts.
+    def get_http_timeout(backend: str) -> tuple[float | None, float | None]:
+        if backend == HTTP_CLIENT_BACKENDS[2]:
+            return script_settings["attachment_settings"]["url_connect_timeout"], script_settings["attachment_settings"]["url_read_timeout"]
+        connect_timeout: float = script_settings["http_client_settings"]["connect_timeout"]
+        read_timeout: float = script_settings["http_client_settings"]["read_timeout"]
+        return connect_timeout if connect_timeout > 0.0 else None, read_timeout if read_timeout > 0.0 else None
+
+    # Connect time is only measured when a new connection has to be opened.
+    def send_http_request(backend: str, method: str, url: str, **kwargs) -> requests.Response:
+        http_request_latency.connect_time = 0.0
+        request_start_time: float = time.perf_counter()
+        response: requests.Response = get_http_session(backend).request(method, url, timeout=get_http_timeout(backend), **kwargs)
+        response.latency = {
+            "start_time": request_start_time,
+            "connect": http_request_latency.connect_time,
+            "ttfb": response.elapsed.total_seconds(),
+        }
+        return response
+
+    def refresh_text_model_backend_slots(backend: TextModelBackend) -> None:
+        idle_slot_count: int | None = None
+        try:
+            slots_response: requests.Response = send_http_request(HTTP_CLIENT_BACKENDS[0], "GET", f"{backend.url}/slots")
+            if slots_response.status_code == 200:
+                idle_slot_count = sum(1 for slot in slots_response.json() if not slot.get("is_processing", False))
+        except requests.exceptions.ConnectionError:
+            pass
+        with text_model_backend_lock:
+            backend.idle_slot_count = idle_slot_count
+            backend.slots_refresh_time = time.perf_counter()
+            backend.requests_since_slots_refresh = 0
+
+    # A conversation stays on the backend holding its KV cache while it's healthy.
+    def select_text_model_backend(affinity_key: str | None, excluded_backends: list[TextModelBackend]) -> TextModelBackend | None:
+        current_time: float = time.perf_counter()
+        candidate_backends: list[TextModelBackend] = [backend for backend in text_model_backends if backend not in excluded_backends and (backend.is_healthy or current_time - backend.last_failure_time > TEXT_MODEL_BACKEND_RETRY_INTERVAL)]
+        if len(candidate_backends) == 0:
+            candidate_backends = [backend for backend in text_model_backends if backend not in excluded_backends]
+        if len(candidate_backends) == 0:
+            return None
+
+        is_affinity_used: bool = affinity_key is not None and script_settings["text_model_backend_settings"]["use_session_affinity"]
+        selected_backend: TextModelBackend | None = text_model_backend_affinity.get(affinity_key) if is_affinity_used else None
+        if selected_backend not in candidate_backends:
+            selected_backend = None
+        if selected_backend is None and len(candidate_backends) > 1 and script_settings["text_model_backend_settings"]["routing_strategy"] == TEXT_MODEL_ROUTING_STRATEGIES[1]:
+            for backend in candidate_backends:
+                if current_time - backend.slots_refresh_time > TEXT_MODEL_BACKEND_SLOTS_REFRESH_INTERVAL:
+                    refresh_text_model_backend_slots(backend)
+
+        with text_model_backend_lock:
+            if selected_backend is None:
+                if script_settings["text_model_backend_settings"]["routing_strategy"] == TEXT_MODEL_ROUTING_STRATEGIES[1]:
+                    selected_backend = max(candidate_backends, key=lambda backend: backend.idle_slot_count - backend.requests_since_slots_refresh if backend.idle_slot_count is not None else -backend.outstanding_requests)
+                else:
+                    selected_backend = min(candidate_backends, key=lambda backend: backend.outstanding_requests)
+            selected_backend.outstanding_requests += 1
+            selected_backend.requests_since_slots_refresh += 1
+            if is_affinity_used:
+                text_model_backend_affinity[affinity_key] = selected_backend
+        return selected_backend
+
+    # Call once a streamed response has been closed.
+    def release_text_model_backend(response: requests.Response) -> None:
+        with text_model_backend_lock:
+            if response.text_model_backend is not None:
+                response.text_model_backend.outstanding_requests -= 1
+                response.text_model_backend = None
+
+    # Fails over to the next backend when one can't be reached.
+    def send_text_model_request(method: str, path: str, affinity_key: str | None=None, **kwargs) -> requests.Response:
+        failed_backends: list[TextModelBackend] = []
+        while True:
+            backend: TextModelBackend | None = select_text_model_backend(affinity_key, failed_backends)
+            if backend is None:
+                raise requests.exceptions.ConnectionError("No text model server is reachable")
+            try:
+                response: requests.Response = send_http_request(HTTP_CLIENT_BACKENDS[0], method, f"{backend.url}{path}", **kwargs)
+            except requests.exceptions.ConnectionError:
+                with text_model_backend_lock:
+                    backend.outstanding_requests -= 1
+                    backend.is_healthy = False
+                    backend.last_failure_time = time.perf_counter()
+                    for key in [key for key, value in text_model_backend_affinity.items() if value is backend]:
+                        del text_model_backend_affinity[key]
+                failed_backends.append(backend)
+                if len(failed_backends) < len(text_model_backends):
+                    new_print(f"Text model server {backend.url} can't be reached, trying another one", PRINT_COLORS["warning"])
+                continue
+            except requests.exceptions.RequestException:
+                with text_model_backend_lock:
+                    backend.outstanding_requests -= 1
+                raise
+
+            backend.is_healthy = True
+            response.text_model_backend = backend
+            if not kwargs.get("stream", False):
+                release_text_model_backend(response)
+            return response
+
+    # Call once the response body has been consumed.
+    def report_http_request_latency(response: requests.Response) -> dict[str, float]:
+        latency: dict[str, float] = {
+            "connect": response.latency["connect"],
+            "ttfb": response.latency["ttfb"],
+            "total": time.perf_counter() - response.latency["start_time"],
+        }
+        if script_settings["http_client_settings"]["show_request_latency"]:
+            new_print(f"Connect: {"{:.1f}".format(latency["connect"] * 1000.0)} ms, TTFB: {"{:.1f}".format(latency["ttfb"] * 1000.0)} ms, Total: {"{:.1f}".format(latency["total"] * 1000.0)} ms", PRINT_COLORS["special"])
+        return latency
+
+    def close_http_sessions() -> None:
+        for session in http_sessions.values():
+            session.close()
+        http_sessions.clear()
+
+    def create_stream_printer() -> StreamPrinter:
+        return StreamPrinter(script_settings["text_model_gen_settings"]["stream_flush_interval_ms"] / 1000.0, script_settings["text_model_gen_settings"]["stream_flush_size"])
+
+    def parse_sse_line(line_buffer: bytearray, line_start: int, line_end: int) -> tuple[str, dict | None] | None:
+        if line_end > line_start and line_buffer[line_end - 1] == 13: # CRLF line endings.
+            line_end -= 1
+        if line_buffer.startswith(SSE_DATA_PREFIX, line_start, line_end):
+            payload_start: int = line_start + len(SSE_DATA_PREFIX)
+            if line_buffer.startswith(SSE_DONE_PAYLOAD, payload_start, line_end):
+                return SSE_EVENT_TYPES[1], None
+            return SSE_EVENT_TYPES[0], json.loads(line_buffer[payload_start:line_end])
+        elif line_buffer.startswith(SSE_ERROR_PREFIX, line_start, line_end):
+            return SSE_EVENT_TYPES[2], json.loads(line_buffer[line_start + len(SSE_ERROR_PREFIX):line_end])
+        elif line_buffer.startswith(SSE_ERROR_OBJECT_PREFIX, line_start, line_end):
+            return SSE_EVENT_TYPES[2], json.loads(line_buffer[line_start:line_end])["error"]
+        return None
+
+    # Lines are split as bytes, so characters split across chunks are decoded whole.
+    def iter_sse_events(response: requests.Response, telemetry: RequestTelemetry | None=None) -> typing.Iterator[tuple[str, dict | None]]:
+        line_buffer: bytearray = bytearray()
+        for chunk in response.iter_content(chunk_size=None):
+            if telemetry is not None:
+                telemetry.bytes_received += len(chunk)
+            line_buffer += chunk
+            line_start: int = 0
+            line_end: int = line_buffer.find(b"\n")
+            while line_end != -1:
+                event: tuple[str, dict | None] | None = parse_sse_line(line_buffer, line_start, line_end)
+                if event is not None:
+                    yield event
+                line_start = line_end + 1
+                line_end = line_buffer.find(b"\n", line_start)
+            del line_buffer[:line_start]
+
+        # Error bodies of failed requests are not newline-terminated.
+        if len(line_buffer) > 0:
+            event: tuple[str, dict | None] | None = parse_sse_line(line_buffer, 0, len(line_buffer))
+            if event is not None:
+                yield event
+
+    def count_text_tokens(text: str) -> int:
+        if text == "":
+            return 0
+        tokenize_response: requests.Response = send_text_model_request("POST", "/tokenize", json={
+            "content": text,
+            "add_special": False,
+        })
+        tokenize_response_data: dict = tokenize_response.json()
+        if "tokens" not in tokenize_response_data:
+            return len(text) // 4
+        return len(tokenize_response_data["tokens"])
+
+    # Messages are never edited once appended, so counts are cached per message.
+    def count_message_tokens(message: dict) -> int:
+        message_id: int = id(message)
+        if message_id in text_model_token_count_cache and text_model_token_count_cache[message_id][0] is message:
+            return text_model_token_count_cache[message_id][1]
+
+        token_count: int = TEXT_MODEL_CONTEXT_MESSAGE_OVERHEAD
+        if isinstance(message["content"], str):
+            token_count += count_text_tokens(message["content"])
+        else:
+            for content_part in message["content"]:
+                if content_part["type"] == "text":
+                    token_count += count_text_tokens(content_part["text"])
+                else:
+                    token_count += TEXT_MODEL_CONTEXT_MEDIA_TOKEN_ESTIMATES.get(content_part["type"], 0)
+
+        if len(text_model_token_count_cache) > 2 * len(text_model_message_history) + 16:
+            live_message_ids: set[int] = {id(_message) for _message in text_model_message_history}
+            for cached_message_id in list(text_model_token_count_cache.keys()):
+                if cached_message_id not in live_message_ids:
+                    del text_model_token_count_cache[cached_message_id]
+        text_model_token_count_cache[message_id] = (message, token_count)
+        return token_count
+
+    def get_message_text(message: dict) -> str:
+        if isinstance(message["content"], str):
+            return message["content"]
+        text_buffer: str = ""
+        for content_part in message["content"]:
+            if content_part["type"] == "text":
+                text_buffer += content_part["text"]
+        return text_buffer
+
+    def summarize_messages(messages: list[dict]) -> str:
+        transcript: str = f"Earlier summary:\n{text_model_context_summary}\n\n" if text_model_context_summary != "" else ""
+        for message in messages:
+            transcript += f"{message["role"].upper()}: {get_message_text(message)}\n\n"
+        summary_response: requests.Response = send_text_model_request("POST", "/v1/chat/completions", json={
+            "model": text_model_id,
+            "messages": [
+                {
+                    "role": TEXT_MODEL_CHAT_ROLES[0],
+                    "content": TEXT_MODEL_CONTEXT_SUMMARY_PROMPT,
+                },
+                {
+                    "role": TEXT_MODEL_CHAT_ROLES[1],
+                    "content": transcript.rstrip(),
+                },
+            ],
+            "stream": False,
+            "max_tokens": script_settings["text_model_gen_settings"]["chat_context_summary_max_tokens"],
+            "temperature": 0.0,
+        })
+        summary_response_data: dict = summary_response.json()
+        if "error" in summary_response_data:
+            return text_model_context_summary
+        return process_text(summary_response_data["choices"][0]["message"]["content"], False).strip()
+
+    # On overflow the window start jumps to a low-water mark so the prompt prefix stays cached.
+    def build_text_model_context_window() -> list[dict]:
+        global text_model_context_start_index
+        global text_model_context_summary
+        global text_model_context_summary_token_count
+        global text_model_context_summary_message
+
+        overflow_strategy: str = script_settings["text_model_gen_settings"]["chat_context_overflow_strategy"]
+        if overflow_strategy == TEXT_MODEL_CONTEXT_OVERFLOW_STRATEGIES[0]:
+            return text_model_message_history
+
+        pinned_message_count: int = 0
+        while pinned_message_count < len(text_model_message_history) and text_model_message_history[pinned_message_count]["role"] == TEXT_MODEL_CHAT_ROLES[0]:
+            pinned_message_count += 1
+        text_model_context_start_index = clamp_int(text_model_context_start_index, pinned_message_count, max(len(text_model_message_history) - 1, pinned_message_count))
+
+        token_budget: int = (text_model_context_size if text_model_context_size > 0 else script_settings["text_model_init_settings"]["context_size"]) - script_settings["text_model_gen_settings"]["chat_context_response_reserve"]
+        token_count: int = text_model_context_summary_token_count
+        for message in text_model_message_history[:pinned_message_count] + text_model_message_history[text_model_context_start_index:]:
+            token_count += count_message_tokens(message)
+
+        if token_count > token_budget:
+            token_target: int = int(token_budget * script_settings["text_model_gen_settings"]["chat_context_trim_ratio"])
+            dropped_messages: list[dict] = []
+            last_message_index: int = len(text_model_message_history) - 1
+            while text_model_context_start_index < last_message_index and (token_count > token_target or text_model_message_history[text_model_context_start_index]["role"] != TEXT_MODEL_CHAT_ROLES[1]):
+                token_count -= count_message_tokens(text_model_message_history[text_model_context_start_index])
+                dropped_messages.append(text_model_message_history[text_model_context_start_index])
+                text_model_context_start_index += 1
+
+            if len(dropped_messages) > 0:
+                if overflow_strategy == TEXT_MODEL_CONTEXT_OVERFLOW_STRATEGIES[2]:
+                    new_print(f"Summarizing {len(dropped_messages)} older messages to fit the context", PRINT_COLORS["special"])
+                    text_model_context_summary = summarize_messages(dropped_messages)
+                    text_model_context_summary_token_count = count_text_tokens(text_model_context_summary)
+                else:
+                    new_print(f"Trimmed {len(dropped_messages)} older messages to fit the context", PRINT_COLORS["special"])
+
+        context_window: list[dict] = text_model_message_history[:pinned_message_count]
+        if text_model_context_summary != "":
+            summary_content: str = f"Summary of the earlier conversation:\n\n{text_model_context_summary}"
+            merges_pinned_message: bool = pinned_message_count > 0 and isinstance(context_window[-1]["content"], str)
+            if merges_pinned_message:
+                summary_content = f"{context_window[-1]["content"]}\n\n{summary_content}"
+            # Reused while unchanged so that its fragment stays cached.
+            if text_model_context_summary_message is None or text_model_context_summary_message["content"] != summary_content:
+                text_model_context_summary_message = {
+                    "role": TEXT_MODEL_CHAT_ROLES[0],
+                    "content": summary_content,
+                }
+            if merges_pinned_message:
+                context_window[-1] = text_model_context_summary_message
+            else:
+                context_window.append(text_model_context_summary_message)
+        return context_window + text_model_message_history[text_model_context_start_index:]
+
+    # Prefills the KV cache after a restart or a load without a slot snapshot.
+    def replay_text_model_history() -> None:
+        if len(text_model_message_history) == 0:
+            return
+        context_window: list[dict] = build_text_model_context_window()
+        payload: dict = {
+            "model": text_model_id,
+            "stream": False,
+            "n_predict": 0,
+        }
+        for key, value in construct_text_model_cache_parameters().items():
+            payload[key] = value
+        try:
+            send_text_model_request("POST", "/v1/chat/completions", TEXT_MODEL_CHAT_AFFINITY_KEY, data=encode_request_body(payload, context_window), headers={"Content-Type": "application/json"})
+            new_print(f"Replayed {len(context_window)} messages into the text model server", PRINT_COLORS["success"])
+        except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout):
+            new_print("Couldn't replay the chat history into the text model server", PRINT_COLORS["warning"])
+
+    def get_message_blob_ids(message: dict) -> list[str]:
+        fragment_parts: list[bytes] = get_message_fragment_parts(message)
+        return [fragment_parts[index].decode() for index in range(1, len(fragment_parts), 2)]
+
+    # Requires llama-server's --slot-save-path; returns None on failure.
+    def send_slot_action(action: str, session_name: str) -> dict | None:
+        slot_id: int = max(script_settings["text_model_gen_settings"]["chat_slot_id"], 0)
+        slot_response: requests.Response = send_text_model_request("POST", f"/slots/{slot_id}?action={action}", TEXT_MODEL_CHAT_AFFINITY_KEY, json={
+            "filename": f"{session_name}{SESSION_SLOT_EXTENSION}",
+        })
+        slot_response_data: dict = slot_response.json()
+        if slot_response.status_code != 200 or "error" in slot_response_data:
+            return None
+        return slot_response_data
+
+    # Saving the current session again only appends the new messages.
+    def save_session(session_name: str) -> None:
+        global current_session_name
+        global session_saved_message_count
+        global session_saved_last_message
+
+        save_start_time: float = time.perf_counter()
+        session_dir: str = script_settings["session_settings"]["session_dir"]
+        session_path: str = f"{session_dir}{session_name}{SESSION_EXTENSION}"
+        os.makedirs(f"{session_dir}{SESSION_BLOB_DIR_NAME}", exist_ok=True)
+
+        messages: list[dict] = list(text_model_message_history)
+        slot_response_data: dict | None = None
+        if script_settings["session_settings"]["save_slot_state"]:
+            slot_response_data = send_slot_action("save", session_name)
+            if slot_response_data is None:
+                new_print("Text model server didn't save its KV cache (it has to be started with --slot-save-path)", PRINT_COLORS["warning"])
+
+        # Failed turns pop a message, so the count alone isn't enough.
+        is_appending: bool = session_name == current_session_name and os.path.exists(session_path) and session_saved_message_count <= len(messages) and (session_saved_message_count == 0 or messages[session_saved_message_count - 1] is session_saved_last_message)
+        first_message_index: int = session_saved_message_count if is_appending else 0
+        session_state_record: dict = {
+            "kind": SESSION_RECORD_KINDS[1],
+            "context_start_index": text_model_context_start_index,
+            "context_summary": text_model_context_summary,
+            "context_summary_token_count": text_model_context_summary_token_count,
+            "has_slot_state": slot_response_data is not None,
+            "retrieval_sources": retrieval_source_keys,
+        }
+        with open(session_path, "at" if is_appending else "wt", encoding="utf-8") as _file:
+            for message in messages[first_message_index:]:
+                for blob_id in get_message_blob_ids(message):
+                    blob_path: str = f"{session_dir}{SESSION_BLOB_DIR_NAME}{blob_id}"
+                    if blob_id in attachment_blobs and not os.path.exists(blob_path):
+                        with open(blob_path, "wb") as blob_file:
+                            blob_file.write(attachment_blobs[blob_id])
+                _file.write(f"{json.dumps({"kind": SESSION_RECORD_KINDS[0], "message": message})}\n")
+            _file.write(f"{json.dumps(session_state_record)}\n")
+
+        current_session_name = session_name
+        session_saved_message_count = len(messages)
+        session_saved_last_message = messages[-1] if len(messages) > 0 else None
+        save_string: str = f"Saved session '{session_name}' ({len(messages) - first_message_index} new messages"
+        if slot_response_data is not None:
+            save_string += f", {slot_response_data["n_saved"]} cached tokens"
+        new_print(f"{save_string}) in {"{:.0f}".format((time.perf_counter() - save_start_time) * 1000.0)} ms", PRINT_COLORS["success"])
+
+    # Restores the slot snapshot if there is one, otherwise replays the history.
+    def load_session(session_name: str) -> None:
+        global text_model_context_start_index
+        global text_model_context_summary
+        global text_model_context_summary_token_count
+        global current_session_name
+        global session_saved_message_count
+        global session_saved_last_message
+
+        load_start_time: float = time.perf_counter()
+        session_dir: str = script_settings["session_settings"]["session_dir"]
+        session_path: str = f"{session_dir}{session_name}{SESSION_EXTENSION}"
+        if not os.path.exists(session_path):
+            new_print(f"Session '{session_name}' does not exist", PRINT_COLORS["error"])
+            return
+
+        messages: list[dict] = []
+        session_state: dict = {}
+        with open(session_path, "rt", encoding="utf-8") as _file:
+            for line in _file:
+                try:
+                    session_record: dict = json.loads(line)
+                except json.JSONDecodeError:
+                    # A save that was interrupted can leave a partial last line behind.
+                    continue
+                if session_record.get("kind") == SESSION_RECORD_KINDS[0]:
+                    messages.append(session_record["message"])
+                elif session_record.get("kind") == SESSION_RECORD_KINDS[1]:
+                    session_state = session_record
+
+        for message in messages:
+            for blob_id in get_message_blob_ids(message):
+                if blob_id in attachment_blobs:
+                    continue
+                try:
+                    with open(f"{session_dir}{SESSION_BLOB_DIR_NAME}{blob_id}", "rb") as _file:
+                        attachment_blobs[blob_id] = _file.read()
+                except FileNotFoundError:
+                    new_print(f"Session '{session_name}' is missing an attachment and can't be loaded", PRINT_COLORS["error"])
+                    return
+
+        text_model_message_history[:] = messages
+        text_model_context_start_index = session_state.get("context_start_index", 0)
+        text_model_context_summary = session_state.get("context_summary", "")
+        text_model_context_summary_token_count = session_state.get("context_summary_token_count", 0)
+        retrieval_source_keys[:] = session_state.get("retrieval_sources", [])
+        current_session_name = session_name
+        session_saved_message_count = len(messages)
+        session_saved_last_message = messages[-1] if len(messages) > 0 else None
+        new_print(f"Loaded session '{session_name}' ({len(messages)} messages) in {"{:.0f}".format((time.perf_counter() - load_start_time) * 1000.0)} ms", PRINT_COLORS["success"])
+
+        slot_response_data: dict | None = send_slot_action("restore", session_name) if session_state.get("has_slot_state", False) else None
+        if slot_response_data is not None:
+            new_print(f"Restored {slot_response_data["n_restored"]} cached tokens in {"{:.0f}".format(slot_response_data["timings"]["restore_ms"])} ms", PRINT_COLORS["success"])
+        else:
+            replay_text_model_history()
+
+    def get_response_cache_connection() -> sqlite3.Connection:
+        global response_cache_connection
+        if response_cache_connection is None:
+            response_cache_connection = sqlite3.connect(script_settings["response_cache_settings"]["cache_path"], check_same_thread=False)
+            response_cache_connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, parameters_key TEXT NOT NULL, content TEXT NOT NULL, timings TEXT, embedding BLOB, created REAL NOT NULL, last_used REAL NOT NULL)")
+            response_cache_connection.execute("CREATE INDEX IF NOT EXISTS responses_by_last_used ON responses (last_used)")
+            response_cache_connection.execute("CREATE INDEX IF NOT EXISTS responses_by_parameters ON responses (parameters_key, last_used)")
+            response_cache_connection.commit()
+        return response_cache_connection
+
+    # Only greedy decoding or a fixed seed is reproducible.
+    def is_response_cacheable(payload: dict) -> bool:
+        return script_settings["response_cache_settings"]["enabled"] and (payload.get("temperature", 1.0) <= 0.0 or payload.get("seed", -1) != -1)
+
+    # The second key groups near-duplicates by model and sampling parameters.
+    def get_response_cache_keys(request_kind: str, payload: dict, request_input: list[dict] | str) -> tuple[str, str]:
+        parameters: dict = {key: value for key, value in payload.items() if key not in RESPONSE_CACHE_IGNORED_PARAMETERS}
+        parameters_key: str = hashlib.sha256(json.dumps([text_model_id, request_kind, parameters], sort_keys=True).encode()).hexdigest()
+        return hashlib.sha256(f"{parameters_key}{json.dumps(request_input, sort_keys=True)}".encode()).hexdigest(), parameters_key
+
+    # Returns None without an embedding server or numpy; per-token embeddings are averaged.
+    def get_text_embeddings(texts: list[str]) -> "numpy.ndarray | None":
+        if script_settings["text_model_backend_settings"]["embedding_server_url"] == "" or numpy is None:
+            return None
+        try:
+            embedding_response: requests.Response = send_http_request(HTTP_CLIENT_BACKENDS[0], "POST", f"{script_settings["text_model_backend_settings"]["embedding_server_url"]}/embedding", json={
+                "content": texts,
+            })
+            embedding_response_data: dict | list = embedding_response.json()
+        except requests.exceptions.RequestException:
+            return None
+        if not isinstance(embedding_response_data, list) or len(embedding_response_data) != len(texts):
+            return None
+        embeddings: list[numpy.ndarray] = []
+        for embedding_result in sorted(embedding_response_data, key=lambda _value: _value["index"]):
+            embedding: numpy.ndarray = numpy.asarray(embedding_result["embedding"], dtype=numpy.float32)
+            embeddings.append(embedding.mean(axis=0) if embedding.ndim == 2 else embedding)
+        embedding_matrix: numpy.ndarray = numpy.stack(embeddings)
+        return embedding_matrix / numpy.maximum(numpy.linalg.norm(embedding_matrix, axis=1, keepdims=True), 1e-12)
+
+    def get_text_embedding(text: str) -> array.array | None:
+        text_embeddings: numpy.ndarray | None = get_text_embeddings([text])
+        if text_embeddings is None:
+            return None
+        text_embedding: array.array = array.array("f")
+        text_embedding.frombytes(text_embeddings[0].tobytes())
+        return text_embedding
+
+    # The request embedding is only computed when the exact lookup misses.
+    def read_response_cache(cache_keys: tuple[str, str], embedding_text: str) -> tuple[dict | None, array.array | None]:
+        minimum_created_time: float = time.time() - script_settings["response_cache_settings"]["ttl_hours"] * 3600.0
+        with response_cache_lock:
+            response_cache: sqlite3.Connection = get_response_cache_connection()
+            cache_row: tuple | None = response_cache.execute("SELECT content, timings FROM responses WHERE key = ? AND created >= ?", (cache_keys[0], minimum_created_time)).fetchone()
+            if cache_row is not None:
+                response_cache.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), cache_keys[0]))
+                response_cache.commit()
+                return {
+                    "content": cache_row[0],
+                    "timings": json.loads(cache_row[1]) if cache_row[1] is not None else None,
+                    "similarity": 1.0,
+                }, None
+        if not script_settings["response_cache_settings"]["use_near_duplicates"]:
+            return None, None
+
+        request_embedding: array.array | None = get_text_embedding(embedding_text)
+        if request_embedding is None:
+            return None, None
+        best_similarity: float = -1.0
+        best_cache_row: tuple | None = None
+        with response_cache_lock:
+            for cache_row in response_cache.execute("SELECT key, content, timings, embedding FROM responses WHERE parameters_key = ? AND embedding IS NOT NULL AND created >= ? ORDER BY last_used DESC LIMIT ?", (cache_keys[1], minimum_created_time, RESPONSE_CACHE_MAX_EMBEDDING_CANDIDATES)):
+                cached_embedding: array.array = array.array("f")
+                cached_embedding.frombytes(cache_row[3])
+                if len(cached_embedding) != len(request_embedding):
+                    continue
+                similarity: float = math.sumprod(request_embedding, cached_embedding)
+                if similarity > best_similarity:
+                    best_similarity = similarity
+                    best_cache_row = cache_row
+            if best_cache_row is None or best_similarity < script_settings["response_cache_settings"]["similarity_threshold"]:
+                return None, request_embedding
+            response_cache.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), best_cache_row[0]))
+            response_cache.commit()
+        return {
+            "content": best_cache_row[1],
+            "timings": json.loads(best_cache_row[2]) if best_cache_row[2] is not None else None,
+            "similarity": best_similarity,
+        }, request_embedding
+
+    # Expired entries first, then the least recently used beyond max_entries.
+    def write_response_cache(cache_keys: tuple[str, str], content: str, timings: dict | None, request_embedding: array.array | None) -> None:
+        current_time: float = time.time()
+        with response_cache_lock:
+            response_cache: sqlite3.Connection = get_response_cache_connection()
+            response_cache.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)", (cache_keys[0], cache_keys[1], content, json.dumps(timings) if timings is not None else None, request_embedding.tobytes() if request_embedding is not None else None, current_time, current_time))
+            response_cache.execute("DELETE FROM responses WHERE created < ?", (current_time - script_settings["response_cache_settings"]["ttl_hours"] * 3600.0,))
+            response_cache.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (script_settings["response_cache_settings"]["max_entries"],))
+            response_cache.commit()
+
+    def report_response_cache_result(cached_response: dict | None) -> None:
+        if cached_response is None:
+            new_print("Response cache miss", PRINT_COLORS["special"])
+        elif cached_response["similarity"] < 1.0:
+            new_print(f"Response cache hit ({"{:.2f}".format(cached_response["similarity"] * 100.0)}% similar prompt)", PRINT_COLORS["special"])
+        else:
+            new_print("Response cache hit", PRINT_COLORS["special"])
+
+    def get_retrieval_index() -> dict:
+        global retrieval_index
+        global retrieval_vectors
+        if retrieval_index is None:
+            try:
+                with open(f"{script_settings["retrieval_settings"]["index_dir"]}{RETRIEVAL_INDEX_FILENAME}", "rt", encoding="utf-8") as _file:
+                    retrieval_index = json.load(_file)
+                retrieval_vectors = numpy.load(f"{script_settings["retrieval_settings"]["index_dir"]}{RETRIEVAL_VECTORS_FILENAME}")
+                if len(retrieval_vectors) != len(retrieval_index["hashes"]):
+                    raise ValueError("Retrieval index and vectors don't match")
+            except (FileNotFoundError, UnicodeDecodeError, json.JSONDecodeError, ValueError, KeyError):
+                retrieval_index = {
+                    "hashes": [],
+                    "chunk_texts": {},
+                    "sources": {},
+                }
+                retrieval_vectors = None
+        return retrieval_index
+
+    # Vectors that no source refers to anymore are dropped.
+    def save_retrieval_index() -> None:
+        global retrieval_vectors
+        referenced_hashes: set[str] = {chunk["hash"] for source in retrieval_index["sources"].values() for chunk in source["chunks"]}
+        if len(referenced_hashes) < len(retrieval_index["hashes"]):
+            kept_rows: list[int] = [row for row, chunk_hash in enumerate(retrieval_index["hashes"]) if chunk_hash in referenced_hashes]
+            retrieval_index["hashes"] = [retrieval_index["hashes"][row] for row in kept_rows]
+            retrieval_index["chunk_texts"] = {chunk_hash: retrieval_index["chunk_texts"][chunk_hash] for chunk_hash in retrieval_index["hashes"]}
+            retrieval_vectors = retrieval_vectors[kept_rows] if retrieval_vectors is not None else None
+
+        os.makedirs(script_settings["retrieval_settings"]["index_dir"], exist_ok=True)
+        if retrieval_vectors is not None:
+            numpy.save(f"{script_settings["retrieval_settings"]["index_dir"]}{RETRIEVAL_VECTORS_FILENAME}", retrieval_vectors)
+        with open(f"{script_settings["retrieval_settings"]["index_dir"]}{RETRIEVAL_INDEX_FILENAME}", "wt", encoding="utf-8") as _file:
+            json.dump(retrieval_index, _file)
+
+    # Content-defined boundaries, so an edit only changes the chunks around it.
+    def split_retrieval_chunks(text: str) -> list[dict]:
+        chunk_size: int = script_settings["retrieval_settings"]["chunk_size"]
+        chunks: list[dict] = []
+        chunk_lines: list[str] = []
+        chunk_length: int = 0
+        chunk_start_line: int = 1
+        for line_number, line in enumerate(text.split("\n"), 1):
+            for line_start in range(0, max(len(line), 1), chunk_size):
+                line_part: str = line[line_start:line_start + chunk_size]
+                if chunk_length + len(line_part) + 1 > chunk_size and len(chunk_lines) > 0:
+                    chunks.append(create_retrieval_chunk(chunk_lines, chunk_start_line, line_number - 1 if line_start == 0 else line_number))
+                    chunk_lines = []
+                    chunk_length = 0
+                if len(chunk_lines) == 0:
+                    chunk_start_line = line_number
+                chunk_lines.append(line_part)
+                chunk_length += len(line_part) + 1
+            if chunk_length >= chunk_size // 4 and binascii.crc32(line.encode("utf-8")) % RETRIEVAL_CHUNK_BOUNDARY_MODULUS == 0:
+                chunks.append(create_retrieval_chunk(chunk_lines, chunk_start_line, line_number))
+                chunk_lines = []
+                chunk_length = 0
+        if len(chunk_lines) > 0:
+            chunks.append(create_retrieval_chunk(chunk_lines, chunk_start_line, chunk_start_line + len(chunk_lines) - 1))
+        return [chunk for chunk in chunks if chunk["text"].strip() != ""]
+
+    def create_retrieval_chunk(chunk_lines: list[str], start_line: int, end_line: int) -> dict:
+        chunk_text: str = "\n".join(chunk_lines)
+        return {
+            "hash": hashlib.sha256(chunk_text.encode("utf-8")).hexdigest(),
+            "text": chunk_text,
+            "start_line": start_line,
+            "end_line": max(end_line, start_line),
+        }
+
+    # Returns the chunk count and how many were embedded, or None on failure.
+    def index_retrieval_source(source_key: str, name: str, text: str) -> tuple[int, int] | None:
+        global retrieval_index
+        global retrieval_vectors
+        chunks: list[dict] = split_retrieval_chunks(text)
+        with retrieval_index_lock:
+            get_retrieval_index()
+            indexed_hashes: set[str] = set(retrieval_index["hashes"])
+            new_chunks: dict[str, str] = {}
+            for chunk in chunks:
+                if chunk["hash"] not in indexed_hashes:
+                    new_chunks[chunk["hash"]] = chunk["text"]
+
+            new_chunk_hashes: list[str] = list(new_chunks.keys())
+            for batch_start in range(0, len(new_chunk_hashes), RETRIEVAL_EMBEDDING_BATCH_SIZE):
+                batch_hashes: list[str] = new_chunk_hashes[batch_start:batch_start + RETRIEVAL_EMBEDDING_BATCH_SIZE]
+                batch_vectors: numpy.ndarray | None = get_text_embeddings([new_chunks[chunk_hash] for chunk_hash in batch_hashes])
+                if batch_vectors is None:
+                    return None
+                # The embedding model changed since the index was built.
+                if retrieval_vectors is not None and retrieval_vectors.shape[1] != batch_vectors.shape[1]:
+                    new_print("Embedding model changed, rebuilding the retrieval index", PRINT_COLORS["warning"])
+                    retrieval_index = {
+                        "hashes": [],
+                        "chunk_texts": {},
+                        "sources": {},
+                    }
+                    retrieval_vectors = None
+                    return index_retrieval_source(source_key, name, text)
+                retrieval_vectors = batch_vectors if retrieval_vectors is None else numpy.concatenate((retrieval_vectors, batch_vectors))
+                for chunk_hash in batch_hashes:
+                    retrieval_index["hashes"].append(chunk_hash)
+                    retrieval_index["chunk_texts"][chunk_hash] = new_chunks[chunk_hash]
+
+            retrieval_index["sources"][source_key] = {
+                "name": name,
+                "chunks": [{
+                    "hash": chunk["hash"],
+                    "start_line": chunk["start_line"],
+                    "end_line": chunk["end_line"],
+                } for chunk in chunks],
+            }
+            save_retrieval_index()
+        return len(chunks), len(new_chunk_hashes)
+
+    # Falls back to the whole attachment without an embedding server.
+    def get_retrievable_attachment(source_key: str, name: str, attachment_block: str) -> str:
+        if not script_settings["retrieval_settings"]["enabled"] or len(attachment_block) < script_settings["retrieval_settings"]["min_attachment_size_kb"] * 1024:
+            return attachment_block
+        if script_settings["text_model_backend_settings"]["embedding_server_url"] == "":
+            new_print("Retrieval requires text_model_backend_settings.embedding_server_url, attaching the whole file", PRINT_COLORS["warning"])
+            return attachment_block
+
+        index_result: tuple[int, int] | None = index_retrieval_source(source_key, name, get_attachment_block_text(attachment_block))
+        if index_result is None:
+            new_print("Embedding server failed, attaching the whole file", PRINT_COLORS["warning"])
+            return attachment_block
+        new_print(f"Indexed `{name}`: {index_result[0]} chunks, {index_result[1]} embedded", PRINT_COLORS["special"])
+        if source_key not in retrieval_source_keys:
+            retrieval_source_keys.append(source_key)
+        return f"`{name}` is attached ({index_result[0]} indexed chunks); the excerpts relevant to each message are included with it."
+
+    # Prepends the most similar chunks to a copy of the last user message.
+    def inject_retrieved_chunks(context_window: list[dict]) -> list[dict]:
+        user_message_index: int = len(context_window) - 1
+        while user_message_index >= 0 and context_window[user_message_index]["role"] != TEXT_MODEL_CHAT_ROLES[1]:
+            user_message_index -= 1
+        if user_message_index < 0:
+            return context_window
+
+        with retrieval_index_lock:
+            get_retrieval_index()
+            candidates: list[tuple[int, str, dict]] = []
+            hash_rows: dict[str, int] = {chunk_hash: row for row, chunk_hash in enumerate(retrieval_index["hashes"])}
+            for source_order, source_key in enumerate(retrieval_source_keys):
+                source: dict | None = retrieval_index["sources"].get(source_key)
+                if source is None:
+                    continue
+                for chunk in source["chunks"]:
+                    if chunk["hash"] in hash_rows:
+                        candidates.append((source_order, source["name"], chunk))
+            if len(candidates) == 0 or retrieval_vectors is None:
+                return context_window
+
+            query_vectors: numpy.ndarray | None = get_text_embeddings([get_message_text(context_window[user_message_index])])
+            if query_vectors is None:
+                new_print("Embedding server failed, sending the message without attachment excerpts", PRINT_COLORS["warning"])
+                return context_window
+            if query_vectors.shape[1] != retrieval_vectors.shape[1]:
+                return context_window
+            similarities: numpy.ndarray = retrieval_vectors[[hash_rows[candidate[2]["hash"]] for candidate in candidates]] @ query_vectors[0]
+            top_candidates: list[tuple[int, str, dict]] = [candidates[index] for index in numpy.argsort(-similarities)[:script_settings["retrieval_settings"]["top_k"]]]
+            top_candidates.sort(key=lambda _value: (_value[0], _value[2]["start_line"]))
+            excerpts: str = "\n\n".join(render_attachment_block(f"{candidate[1]} (lines {candidate[2]["start_line"]}-{candidate[2]["end_line"]})", retrieval_index["chunk_texts"][candidate[2]["hash"]]) for candidate in top_candidates)
+
+        user_message: dict = context_window[user_message_index]
+        if isinstance(user_message["content"], str):
+            user_message_content: str | list = join_attachment_and_message(excerpts, user_message["content"])
+        else:
+            user_message_content: str | list = [{
+                "type": "text",
+                "text": excerpts,
+            }] + user_message["content"]
+        return context_window[:user_message_index] + [{
+            "role": user_message["role"],
+            "content": user_message_content,
+        }] + context_window[user_message_index + 1:]
+
+    # Runs in a worker thread.
+    def send_chat_message() -> bool:
+        global text_model_last_thoughts
+        try:
+            context_window: list[dict] = build_text_model_context_window()
+            if len(retrieval_source_keys) > 0:
+                context_window = inject_retrieved_chunks(context_window)
+            payload: dict = {
+                "model": text_model_id,
+                "stream": script_settings["text_model_gen_settings"]["stream_responses"],
+            }
+            for key, value in construct_text_model_gen_parameters().items():
+                payload[key] = value
+            for key, value in construct_text_model_cache_parameters().items():
+                payload[key] = value
+
+            new_print("\nMODEL: ", PRINT_COLORS["model_prefix"], "")
+            response_cache_keys: tuple[str, str] | None = None
+            request_embedding: array.array | None = None
+            if is_response_cacheable(payload):
+                response_cache_keys = get_response_cache_keys(TELEMETRY_REQUEST_KINDS[0], payload, context_window)
+                cached_response, request_embedding = read_response_cache(response_cache_keys, "\n".join(get_message_text(_message) for _message in context_window))
+                if cached_response is not None:
+                    thought_filter: ThoughtFilter = filter_thoughts(cached_response["content"])
+                    text_model_last_thoughts = thought_filter.get_thoughts()
+                    if append_message(TEXT_MODEL_CHAT_ROLES[2], process_model_message_for_history(cached_response["content"], thought_filter)):
+                        print(f"{cached_response["content"] if script_settings["text_model_gen_settings"]["chat_show_thoughts_in_nonstreaming_mode"] else thought_filter.get_text()}\n")
+                    report_response_cache_result(cached_response)
+                    return True
+
+            telemetry: RequestTelemetry = RequestTelemetry(TELEMETRY_REQUEST_KINDS[0])
+            request_body: bytes = encode_request_body(payload, context_window)
+            telemetry.encode_time = time.perf_counter() - telemetry.start_time
+            chat_response: requests.Response = send_text_model_request("POST", "/v1/chat/completions", TEXT_MODEL_CHAT_AFFINITY_KEY, data=request_body, headers={"Content-Type": "application/json"}, stream=script_settings["text_model_gen_settings"]["stream_responses"])
+            if not script_settings["text_model_gen_settings"]["stream_responses"]:
+                chat_response_data: dict = chat_response.json()
+                telemetry.bytes_received = len(chat_response.content)
+                telemetry.server_timings = chat_response_data.get("timings")
+                if "error" not in chat_response_data:
+                    model_message: str = chat_response_data["choices"][0]["message"]["content"]
+                    thought_filter: ThoughtFilter = filter_thoughts(model_message)
+                    text_model_last_thoughts = thought_filter.get_thoughts()
+                    if append_message(TEXT_MODEL_CHAT_ROLES[2], process_model_message_for_history(model_message, thought_filter)):
+                        print(f"{model_message if script_settings["text_model_gen_settings"]["chat_show_thoughts_in_nonstreaming_mode"] else thought_filter.get_text()}\n")
+                    if response_cache_keys is not None:
+                        write_response_cache(response_cache_keys, model_message, chat_response_data.get("timings"), request_embedding)
+                else:
+                    match chat_response_data["error"]["message"]:
+                        case "the request exceeds the available context size. try increasing the context size or enable context shift":
+                            print("Your message exceeds the available context size. Try increasing the context size or enable Context Shift.", end="")
+                        case "Failed to load image or audio file":
+                            print("This file is not encodable.", end="")
+                        case _:
+                            print("An error occurred.", end="")
+                    print(" This message won't be added to the context.\n")
+                    text_model_message_history.pop()
+                report_prompt_cache_usage(chat_response_data.get("timings"))
+                report_draft_acceptance(chat_response_data.get("timings"))
+                if response_cache_keys is not None:
+                    report_response_cache_result(None)
+                finish_request_telemetry(telemetry, chat_response)
+            else:
+                model_message_chunks: list[str] = []
+                response_timings: dict | None = None
+                is_response_complete: bool = True
+                is_showing_thoughts: bool = script_settings["text_model_gen_settings"]["chat_streamed_thoughts_mode"] == TEXT_MODEL_STREAMED_THOUGHTS_MODES[0]
+                thought_filter: ThoughtFilter = ThoughtFilter()
+                stream_printer: StreamPrinter = create_stream_printer()
+                try:
+                    for event_type, event_data in iter_sse_events(chat_response, telemetry):
+                        if event_type == SSE_EVENT_TYPES[0]:
+                            response_timings = event_data.get("timings", response_timings)
+                            if len(event_data.get("choices", [])) > 0:
+                                chunk: str | None = event_data["choices"][0]["delta"].get("content", "")
+                                if chunk is not None:
+                                    telemetry.record_token()
+                                    model_message_chunks.append(chunk)
+                                    thought_segments: list[tuple[bool, str]] = thought_filter.feed(chunk)
+                                    if is_showing_thoughts:
+                                        stream_printer.write(chunk)
+                                    else:
+                                        write_streamed_segments(stream_printer, thought_filter, thought_segments)
+                        elif event_type == SSE_EVENT_TYPES[2]:
+                            stream_printer.flush()
+                            match event_data["message"]:
+                                case "the request exceeds the available context size. try increasing the context size or enable context shift":
+                                    new_print("Your message exceeds the available context size. Try increasing the context size or enable Context Shift.", PRINT_COLORS["error"], "")
+                                case "Failed to load image or audio file":
+                                    new_print("This file is not encodable.", PRINT_COLORS["error"], "")
+                                case _:
+                                    new_print("An error occurred.", PRINT_COLORS["error"], "")
+                            print(" This message won't be added to the context.", end="")
+                            text_model_message_history.pop()
+                            is_response_complete = False
+                            break
+                finally:
+                    thought_segments: list[tuple[bool, str]] = thought_filter.finish()
+                    if not is_showing_thoughts:
+                        write_streamed_segments(stream_printer, thought_filter, thought_segments, True)
+                    stream_printer.close()
+                    chat_response.close()
+                    release_text_model_backend(chat_response)
+                model_message_buffer: str = "".join(model_message_chunks)
+                text_model_last_thoughts = thought_filter.get_thoughts()
+                if model_message_buffer != "":
+                    append_message(TEXT_MODEL_CHAT_ROLES[2], process_model_message_for_history(model_message_buffer, thought_filter))
+                print("\n")
+                report_prompt_cache_usage(response_timings)
+                report_draft_acceptance(response_timings)
+                if response_cache_keys is not None and is_response_complete:
+                    write_response_cache(response_cache_keys, model_message_buffer, response_timings, request_embedding)
+                    report_response_cache_result(None)
+                telemetry.server_timings = response_timings
+                finish_request_telemetry(telemetry, chat_response)
+        except requests.exceptions.ConnectionError:
+            new_print("Text model server was closed", PRINT_COLORS["error"])
+            return False
+        except requests.exceptions.ReadTimeout:
+            new_print("Text model server timed out. This message won't be added to the context.\n", PRINT_COLORS["error"])
+            text_model_message_history.pop()
+        except requests.exceptions.ChunkedEncodingError:
+            new_print("\nText model server was closed", PRINT_COLORS["error"])
+            return False
+        return True
+
+    # Runs in a worker thread, see send_chat_message().
+    def send_autocomplete_prompt(prompt: str) -> bool:
+        try:
+            payload: dict = {
+                "model": text_model_id,
+                "prompt": prompt,
+                "stream": script_settings["text_model_gen_settings"]["stream_responses"],
+                "n_predict": script_settings["text_model_gen_settings"]["autocomplete_max_tokens"],
+            }
+            for key, value in construct_text_model_gen_parameters().items():
+                payload[key] = value
+            for key, value in construct_text_model_cache_parameters().items():
+                payload[key] = value
+
+            response_cache_keys: tuple[str, str] | None = None
+            request_embedding: array.array | None = None
+            if is_response_cacheable(payload):
+                response_cache_keys = get_response_cache_keys(TELEMETRY_REQUEST_KINDS[1], payload, prompt)
+                cached_response, request_embedding = read_response_cache(response_cache_keys, prompt)
+                if cached_response is not None:
+                    new_print(f"{prompt}{cached_response["content"]}\n", PRINT_COLORS["model_prefix"])
+                    report_response_cache_result(cached_response)
+                    return True
+
+            telemetry: RequestTelemetry = RequestTelemetry(TELEMETRY_REQUEST_KINDS[1])
+            text_response: requests.Response = send_text_model_request("POST", "/completion", json=payload, stream=script_settings["text_model_gen_settings"]["stream_responses"])
+            if not script_settings["text_model_gen_settings"]["stream_responses"]:
+                text_response_data: dict = text_response.json()
+                telemetry.bytes_received = len(text_response.content)
+                telemetry.server_timings = text_response_data.get("timings")
+                if "error" not in text_response_data:
+                    new_print(f"{prompt}{text_response_data["content"]}\n", PRINT_COLORS["model_prefix"])
+                    if response_cache_keys is not None:
+                        write_response_cache(response_cache_keys, text_response_data["content"], text_response_data.get("timings"), request_embedding)
+                        report_response_cache_result(None)
+                else:
+                    match text_response_data["error"]["message"]:
+                        case "the request exceeds the available context size. try increasing the context size or enable context shift":
+                            new_print("Your prompt exceeds the available context size. Try increasing the context size or enable Context Shift.\n", PRINT_COLORS["error"])
+                        case _:
+                            new_print("An error occurred.\n", PRINT_COLORS["error"])
+                report_prompt_cache_usage(text_response_data.get("timings"))
+                report_draft_acceptance(text_response_data.get("timings"))
+                finish_request_telemetry(telemetry, text_response)
+            else:
+                was_prompt_printed: bool = False
+                response_timings: dict | None = None
+                response_chunks: list[str] = []
+                is_response_complete: bool = True
+                stream_printer: StreamPrinter = create_stream_printer()
+                try:
+                    for event_type, event_data in iter_sse_events(text_response, telemetry):
+                        if event_type == SSE_EVENT_TYPES[0]:
+                            response_timings = event_data.get("timings", response_timings)
+                            if not was_prompt_printed:
+                                was_prompt_printed = True
+                                stream_printer.write(f"{PRINT_COLORS["model_prefix"]}{prompt}")
+                            if event_data["content"] != "":
+                                telemetry.record_token()
+                                response_chunks.append(event_data["content"])
+                            stream_printer.write(event_data["content"])
+                        elif event_type == SSE_EVENT_TYPES[2]:
+                            stream_printer.flush()
+                            match event_data["message"]:
+                                case "the request exceeds the available context size. try increasing the context size or enable context shift":
+                                    new_print("Your prompt exceeds the available context size. Try increasing the context size or enable Context Shift.", PRINT_COLORS["error"], "")
+                                case _:
+                                    new_print("An error occurred.", PRINT_COLORS["error"], "")
+                            is_response_complete = False
+                            break
+                finally:
+                    stream_printer.close()
+                    text_response.close()
+                    release_text_model_backend(text_response)
+                print("\n")
+                report_prompt_cache_usage(response_timings)
+                report_draft_acceptance(response_timings)
+                if response_cache_keys is not None and is_response_complete:
+                    write_response_cache(response_cache_keys, "".join(response_chunks), response_timings, request_embedding)
+                    report_response_cache_result(None)
+                telemetry.server_timings = response_timings
+                finish_request_telemetry(telemetry, text_response)
+        except requests.exceptions.ConnectionError:
+            print("Text model server was closed")
+            return False
+        except requests.exceptions.ReadTimeout:
+            new_print("Text model server timed out\n", PRINT_COLORS["error"])
+        except requests.exceptions.ChunkedEncodingError:
+            print("\nText model server was closed")
+            return False
+        return True
+
+    # Returns None for invalid seeds or ranges over IMAGE_MODEL_MAX_QUEUED_IMAGES.
+    def parse_image_seeds(text: str) -> list[int] | None:
+        image_seeds: list[int] = []
+        for seed_string in text.split(","):
+            seed_string = seed_string.strip()
+            if seed_string == "":
+                continue
+            seed_range_match: re.Match | None = IMAGE_MODEL_SEED_RANGE_PATTERN.fullmatch(seed_string)
+            if seed_range_match is not None:
+                first_seed: int = int(seed_range_match.group(1))
+                last_seed: int = int(seed_range_match.group(2))
+                if last_seed < first_seed or last_seed - first_seed >= IMAGE_MODEL_MAX_QUEUED_IMAGES:
+                    return None
+                image_seeds += range(first_seed, last_seed + 1)
+            else:
+                try:
+                    image_seeds.append(int(seed_string))
+                except ValueError:
+                    return None
+        return image_seeds
+
+    # The seed advances by batch_size between iterations.
+    def create_image_model_jobs(positive_prompts: list[str], negative_prompt: str, image_seeds: list[int]) -> list[dict]:
+        image_jobs: list[dict] = []
+        for positive_prompt in positive_prompts:
+            for image_seed in image_seeds:
+                for iteration in range(script_settings["image_model_gen_settings"]["n_iter"]):
+                    image_jobs.append({
+                        "positive_prompt": positive_prompt,
+                        "negative_prompt": negative_prompt,
+                        "seed": image_seed + iteration * script_settings["image_model_gen_settings"]["batch_size"] if image_seed != -1 else -1,
+                    })
+        return image_jobs
+
+    # Exclusive mode gives images saved in the same millisecond different names.
+    def write_image_output(image_data: str, image_metadata: dict) -> str:
+        image_output_name: str = f"{IMAGE_MODEL_OUTPUT_DIR_NAME}{datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S_%f")[:-3]}"
+        name_suffix: int = 0
+        while True:
+            image_output_path: str = f"{image_output_name}{f"_{name_suffix}" if name_suffix > 0 else ""}{IMAGE_MODEL_OUTPUT_EXTENSION}"
+            try:
+                with open(image_output_path, "xb") as _file:
+                    _file.write(base64.b64decode(image_data))
+                break
+            except FileExistsError:
+                name_suffix += 1
+        with open(f"{image_output_path.removesuffix(IMAGE_MODEL_OUTPUT_EXTENSION)}{IMAGE_MODEL_SIDECAR_EXTENSION}", "wt", encoding="utf-8") as _file:
+            json.dump(image_metadata, _file, indent=4)
+        return image_output_path
+
+    # Each image gets a JSON sidecar with its prompt, seed and parameters.
+    def generate_image(image_job: dict) -> list[str]:
+        payload: dict = {
+            "prompt": image_job["positive_prompt"],
+            "negative_prompt": image_job["negative_prompt"],
+        }
+        for key, value in script_settings["image_model_gen_settings"].items():
+            payload[key] = value
+        payload["seed"] = image_job["seed"]
+        payload["n_iter"] = 1 # Iterations are queued as separate jobs, see create_image_model_jobs().
+        telemetry: RequestTelemetry = RequestTelemetry(TELEMETRY_REQUEST_KINDS[2])
+        image_response: requests.Response = send_http_request(HTTP_CLIENT_BACKENDS[1], "POST", f"{image_model_server_url}/sdapi/v1/txt2img", json=payload)
+        telemetry.bytes_received = len(image_response.content)
+        telemetry.extra_fields = {
+            "steps": payload["steps"],
+            "width": payload["width"],
+            "height": payload["height"],
+            "batch_size": payload["batch_size"],
+        }
+        finish_request_telemetry(telemetry, image_response)
+        generation_time: float = time.perf_counter() - telemetry.start_time
+
+        # A seed of -1 is randomized by the server.
+        image_response_data: dict = image_response.json()
+        image_seeds: list[int] = []
+        if isinstance(image_response_data.get("info"), str) and image_response_data["info"] != "":
+            try:
+                image_seeds = json.loads(image_response_data["info"]).get("all_seeds", [])
+            except json.JSONDecodeError:
+                pass
+        image_metadata: list[dict] = []
+        for index in range(len(image_response_data["images"])):
+            image_metadata.append({
+                "prompt": payload["prompt"],
+                "negative_prompt": payload["negative_prompt"],
+                "seed": image_seeds[index] if index < len(image_seeds) else (payload["seed"] + index if payload["seed"] != -1 else -1),
+                "batch_index": index,
+                "parameters": payload,
+                "generation_time": round(generation_time, 3),
+                "created": datetime.datetime.now().isoformat(timespec="milliseconds"),
+            })
+
+        os.makedirs(IMAGE_MODEL_OUTPUT_DIR_NAME, exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(image_metadata), 1)) as executor:
+            image_output_paths: list[str] = list(executor.map(write_image_output, image_response_data["images"], image_metadata))
+        if script_settings["open_image_output_on_gen"]:
+            for image_output_path in image_output_paths:
+                os.startfile(os.path.abspath(image_output_path))
+        return image_output_paths
+
+    # Finished jobs are only attached while no chat turn is in flight.
+    async def process_image_model_jobs() -> None:
+        global image_model_server_active
+        global image_model_pending_jobs
+        while True:
+            image_job: dict = await image_model_job_queue.get()
+            image_generation_start_time: float = time.time()
+            # Every job is marked as done so that a bad job can't stall the queue.
+            try:
+                while True:
+                    try:
+                        image_job["output_paths"] = await asyncio.to_thread(generate_image, image_job)
+                        image_job["generation_time"] = time.time() - image_generation_start_time
+                    except requests.exceptions.ConnectionError:
+                        if await wait_for_server_restart(image_model_server_supervisor):
+                            continue
+                        image_model_server_active = False
+                        image_job["error"] = "Image model server was closed"
+                    except requests.exceptions.ReadTimeout:
+                        image_job["error"] = "Image model server timed out"
+                    except Exception as error:
+                        image_job["error"] = f"Image job {image_job["job_number"]}/{image_job["job_count"]} failed: {error}"
+                    break
+            finally:
+                if "output_paths" not in image_job and "error" not in image_job:
+                    image_job["error"] = "Image job was cancelled"
+                image_model_completed_jobs.append(image_job)
+                image_model_pending_jobs -= 1
+                image_model_job_queue.task_done()
+
+            # When busy, the main loop attaches the job before the next prompt.
+            if not text_model_turn_active and not text_model_history_lock.locked():
+                async with text_model_history_lock:
+                    print()
+                    await asyncio.to_thread(attach_completed_image_jobs)
+                    if current_input_prompt != "":
+                        print(current_input_prompt, end="", flush=True)
+
+    def attach_completed_image_jobs() -> None:
+        while len(image_model_completed_jobs) > 0:
+            image_job: dict = image_model_completed_jobs.pop(0)
+            if "error" in image_job:
+                new_print(image_job["error"], PRINT_COLORS["error"])
+                continue
+
+            # Only a single generated image is added to the context.
+            if not image_job["attach_to_history"] or len(image_job["output_paths"]) != 1:
+                new_print(f"Image job {image_job["job_number"]}/{image_job["job_count"]} finished in {"{:.2f}".format(image_job["generation_time"])} seconds: {", ".join(image_job["output_paths"])}", PRINT_COLORS["success"])
+                continue
+
+            model_message: str = f"Generated in {"{:.2f}".format(image_job["generation_time"])} seconds."
+            if text_model_modalities["vision"]:
+                if image_job["negative_prompt"] == "":
+                    append_message(TEXT_MODEL_CHAT_ROLES[1], f"**Prompt:** {image_job["positive_prompt"]}\n\nGenerate an image using the provided prompt.")
+                else:
+                    append_message(TEXT_MODEL_CHAT_ROLES[1], f"**Positive Prompt:** {image_job["positive_prompt"]}\n**Negative Prompt:** {image_job["negative_prompt"]}\n\nGenerate an image using the provided positive prompt and negative prompt.")
+                if append_message(TEXT_MODEL_CHAT_ROLES[2], model_message, image_job["output_paths"][0]):
+                    print(f"{PRINT_COLORS["model_prefix"]}MODEL: {colorama.Style.RESET_ALL}{model_message}\n")
+            else:
+                print(f"{PRINT_COLORS["model_prefix"]}MODEL: {colorama.Style.RESET_ALL}{model_message} This message won't be added to the context as I cannot see images.\n")
+
+    # Lines typed while a response streams are queued.
+    def read_stdin_lines(event_loop: asyncio.AbstractEventLoop) -> None:
+        while True:
+            line: str = sys.stdin.readline()
+            try:
+                event_loop.call_soon_threadsafe(input_queue.put_nowait, line)
+            except RuntimeError: # The event loop was closed after /exit.
+                break
+            if line == "":
+                break
+
+    async def read_input(prompt: str) -> str:
+        global current_input_prompt
+        current_input_prompt = prompt
+        print(prompt, end="", flush=True)
+        line: str = await input_queue.get()
+        current_input_prompt = ""
+        if line == "":
+            raise EOFError
+        return line.removesuffix("\n")
+
+    async def run_text_model_turn(function: typing.Callable[..., bool], *args) -> bool:
+        global text_model_turn_active
+        text_model_turn_active = True
+        try:
+            # After a crash and restart the turn is sent again.
+            while not await asyncio.to_thread(function, *args):
+                if not await wait_for_server_restart(text_model_server_supervisor):
+                    return False
+                new_print("Sending the message again", PRINT_COLORS["special"])
+            return True
+        finally:
+            text_model_turn_active = False
+
+    async def run_main_loop() -> None:
+        global input_queue
+        global text_model_history_lock
+        global image_model_job_queue
+        global image_model_pending_jobs
+        input_queue = asyncio.Queue()
+        text_model_history_lock = asyncio.Lock()
+        image_model_job_queue = asyncio.Queue()
+        threading.Thread(target=read_stdin_lines, args=(asyncio.get_running_loop(),), daemon=True).start()
+        image_model_job_worker: asyncio.Task = asyncio.create_task(process_image_model_jobs())
+
+        try:
+            while True:
+                if script_settings["script_mode"] == SCRIPT_MODES[0]: # Chat Mode
+                    async with text_model_history_lock:
+                        await asyncio.to_thread(attach_completed_image_jobs)
+                    user_message: str = await read_input(f"{PRINT_COLORS["user_prefix"]}USER: {colorama.Style.RESET_ALL}")
+                    command: str = user_message.strip()
+
+                    if command == COMMAND_IMAGE_ALIAS:
+                        if not image_model_server_active:
+                            new_print("Image model server is offline", PRINT_COLORS["error"])
+                            continue
+
+                        image_positive_prompts: list[str] = [_value.strip() for _value in (await read_input(f"Enter a positive prompt (separate several prompts with '{IMAGE_MODEL_PROMPT_SEPARATOR}'): ")).split(IMAGE_MODEL_PROMPT_SEPARATOR) if _value.strip() != ""]
+                        if len(image_positive_prompts) == 0:
+                            new_print("Cannot generate images with an empty positive prompt", PRINT_COLORS["error"])
+                            continue
+                        image_negative_prompt: str = (await read_input("Enter a negative prompt (optional): ")).strip()
+                        image_seeds: list[int] | None = parse_image_seeds(await read_input("Enter a seed, a seed range like 1-30 or several seeds separated by ',' (optional): "))
+                        if image_seeds is None:
+                            new_print(f"Seeds must be integers or ranges of at most {IMAGE_MODEL_MAX_QUEUED_IMAGES} seeds", PRINT_COLORS["error"])
+                            continue
+                        if len(image_seeds) == 0:
+                            image_seeds = [script_settings["image_model_gen_settings"]["seed"]]
+
+                        image_jobs: list[dict] = create_image_model_jobs(image_positive_prompts, image_negative_prompt, image_seeds)
+                        image_count: int = len(image_jobs) * script_settings["image_model_gen_settings"]["batch_size"]
+                        if image_count > IMAGE_MODEL_MAX_QUEUED_IMAGES:
+                            new_print(f"Cannot queue more than {IMAGE_MODEL_MAX_QUEUED_IMAGES} images at once", PRINT_COLORS["error"])
+                            continue
+                        for job_number, image_job in enumerate(image_jobs, 1):
+                            image_job["job_number"] = job_number
+                            image_job["job_count"] = len(image_jobs)
+                            image_job["attach_to_history"] = image_count == 1
+                            image_model_job_queue.put_nowait(image_job)
+                        image_model_pending_jobs += len(image_jobs)
+                        if image_count == 1:
+                            new_print(f"Generating in the background ({image_model_pending_jobs} pending)...", PRINT_COLORS["success"])
+                        else:
+                            new_print(f"Generating {image_count} images in {len(image_jobs)} jobs in the background ({image_model_pending_jobs} pending)...", PRINT_COLORS["success"])
+                    elif command in (COMMAND_SAVE_ALIAS, COMMAND_LOAD_ALIAS):
+                        session_name: str = (await read_input(f"Enter a session name{f" ({current_session_name})" if current_session_name != "" else ""}: ")).strip()
+                        if session_name == "":
+                            session_name = current_session_name
+                        if SESSION_NAME_PATTERN.fullmatch(session_name) is None:
+                            new_print("Session names can only contain letters, digits, '_' and '-'", PRINT_COLORS["error"])
+                            continue
+                        try:
+                            await asyncio.to_thread(save_session if command == COMMAND_SAVE_ALIAS else load_session, session_name)
+                        except requests.exceptions.ConnectionError:
+                            new_print("Text model server was closed", PRINT_COLORS["error"])
+                    elif command == COMMAND_THOUGHTS_ALIAS:
+                        if text_model_last_thoughts.strip() == "":
+                            new_print("The last response has no thoughts", PRINT_COLORS["warning"])
+                        else:
+                            new_print(text_model_last_thoughts.strip(), PRINT_COLORS["special"])
+                    elif command == COMMAND_HELP_ALIAS:
+                        new_print(f"{COMMAND_IMAGE_ALIAS} - Generate images in the background; accepts several prompts and seed ranges (requires the image model server to be online).", PRINT_COLORS["special"])
+                        new_print(f"{COMMAND_ATTACH_ALIAS} - Attach a file, directory, glob pattern or URL to your message (command must be at the end of your message).", PRINT_COLORS["special"])
+                        new_print(f"{COMMAND_SAVE_ALIAS} - Save the conversation and the text model server's KV cache as a session.", PRINT_COLORS["special"])
+                        new_print(f"{COMMAND_LOAD_ALIAS} - Load a saved session.", PRINT_COLORS["special"])
+                        new_print(f"{COMMAND_THOUGHTS_ALIAS} - Display the thoughts of the last response.", PRINT_COLORS["special"])
+                        new_print(f"{COMMAND_HELP_ALIAS} - Display all commands.", PRINT_COLORS["special"])
+                        new_print(f"{COMMAND_EXIT_ALIAS} - Exit the application.", PRINT_COLORS["special"])
+                    elif command == COMMAND_EXIT_ALIAS:
+                        break
+                    else:
+                        file_path: str = ""
+
+                        if command.endswith(COMMAND_ATTACH_ALIAS):
+                            file_path = strip_leading_and_trailing_quotes(await read_input("Enter a file path, directory, glob pattern or URL: "))
+                            user_message = user_message.removesuffix(COMMAND_ATTACH_ALIAS).rstrip()
+
+                        # Attaching can fetch URLs, so it runs on a worker thread.
+                        async with text_model_history_lock:
+                            if await asyncio.to_thread(append_message, TEXT_MODEL_CHAT_ROLES[1], user_message, file_path):
+                                if not await run_text_model_turn(send_chat_message):
+                                    break
+                            else:
+                                new_print("Cannot send empty messages", PRINT_COLORS["error"])
+                elif script_settings["script_mode"] == SCRIPT_MODES[1]: # Autocomplete Mode
+                    prompt: str = await read_input(f"{PRINT_COLORS["user_prefix"]}> {colorama.Style.RESET_ALL}")
+                    if not await run_text_model_turn(send_autocomplete_prompt, prompt):
+                        break
+        except EOFError:
+            pass
+
+        if image_model_pending_jobs > 0:
+            new_print("Waiting for background image jobs to finish...", PRINT_COLORS["special"])
+            await image_model_job_queue.join()
+            await asyncio.to_thread(attach_completed_image_jobs)
+        image_model_job_worker.cancel()
+
+    def get_percentile(sorted_values: list[float], percentile: float) -> float:
+        return sorted_values[min(int(len(sorted_values) * percentile), len(sorted_values) - 1)]
+
+    # Call once the response has been fully consumed.
+    def finish_request_telemetry(telemetry: RequestTelemetry, response: requests.Response) -> dict:
+        latency: dict[str, float] = report_http_request_latency(response)
+
+        metrics_record: dict = {
+            "timestamp": datetime.datetime.now().isoformat(timespec="milliseconds"),
+            "kind": telemetry.request_kind,
+            "model": text_model_id if telemetry.request_kind != TELEMETRY_REQUEST_KINDS[2] else "",
+            "connect_ms": round(latency["connect"] * 1000.0, 2),
+            "ttfb_ms": round(latency["ttfb"] * 1000.0, 2),
+            "total_ms": round(latency["total"] * 1000.0, 2),
+            "ttft_ms": round((telemetry.token_times[0] - telemetry.start_time) * 1000.0, 2) if len(telemetry.token_times) > 0 else None,
+            "streamed_tokens": len(telemetry.token_times),
+            "itl_p50_ms": None,
+            "itl_p90_ms": None,
+            "itl_p99_ms": None,
+            "encode_ms": round(telemetry.encode_time * 1000.0, 3) if telemetry.encode_time is not None else None,
+            "bytes_sent": len(response.request.body) if response.request.body is not None else 0,
+            "bytes_received": telemetry.bytes_received,
+        }
+        if len(telemetry.token_times) > 1:
+            inter_token_latencies: list[float] = sorted(telemetry.token_times[index] - telemetry.token_times[index - 1] for index in range(1, len(telemetry.token_times)))
+            metrics_record["itl_p50_ms"] = round(get_percentile(inter_token_latencies, 0.5) * 1000.0, 2)
+            metrics_record["itl_p90_ms"] = round(get_percentile(inter_token_latencies, 0.9) * 1000.0, 2)
+            metrics_record["itl_p99_ms"] = round(get_percentile(inter_token_latencies, 0.99) * 1000.0, 2)
+        for key in TELEMETRY_SERVER_TIMING_KEYS:
+            metrics_record[key] = telemetry.server_timings.get(key) if telemetry.server_timings is not None else None
+        metrics_record["draft_acceptance_rate"] = round(metrics_record["draft_n_accepted"] / metrics_record["draft_n"], 4) if metrics_record["draft_n"] else None
+        for key, value in telemetry.extra_fields.items():
+            metrics_record[key] = value
+
+        if script_settings["telemetry_settings"]["show_inline"]:
+            metrics_string: str = f"Total: {"{:.0f}".format(metrics_record["total_ms"])} ms"
+            if metrics_record["ttft_ms"] is not None:
+                metrics_string += f", TTFT: {"{:.0f}".format(metrics_record["ttft_ms"])} ms"
+            if metrics_record["itl_p50_ms"] is not None:
+                metrics_string += f", ITL p50/p90/p99: {"{:.1f}".format(metrics_record["itl_p50_ms"])}/{"{:.1f}".format(metrics_record["itl_p90_ms"])}/{"{:.1f}".format(metrics_record["itl_p99_ms"])} ms"
+            if metrics_record["prompt_per_second"] is not None:
+                metrics_string += f", Prompt: {metrics_record["prompt_n"]} tokens at {"{:.1f}".format(metrics_record["prompt_per_second"])} t/s"
+            if metrics_record["predicted_per_second"] is not None:
+                metrics_string += f", Generation: {metrics_record["predicted_n"]} tokens at {"{:.1f}".format(metrics_record["predicted_per_second"])} t/s"
+            if metrics_record["draft_acceptance_rate"] is not None:
+                metrics_string += f", Draft acceptance: {"{:.1f}".format(metrics_record["draft_acceptance_rate"] * 100.0)}%"
+            metrics_string += f", Sent: {"{:.1f}".format(metrics_record["bytes_sent"] / 1024.0)} KiB"
+            if metrics_record["encode_ms"] is not None:
+                metrics_string += f" (encoded in {"{:.2f}".format(metrics_record["encode_ms"])} ms)"
+            metrics_string += f", Received: {"{:.1f}".format(metrics_record["bytes_received"] / 1024.0)} KiB"
+            new_print(metrics_string, PRINT_COLORS["special"])
+
+        if script_settings["telemetry_settings"]["write_metrics_file"]:
+            with telemetry_file_lock:
+                with open(script_settings["telemetry_settings"]["metrics_path"], "at", encoding="utf-8") as _file:
+                    _file.write(f"{json.dumps(metrics_record)}\n")
+        return metrics_record
+
+    # Jobs with an error-free result in the output file are skipped when resuming.
+    def is_batch_job_valid(batch_job: dict) -> bool:
+        if batch_job["mode"] == SCRIPT_MODES[0] and "messages" in batch_job:
+            return isinstance(batch_job["messages"], list) and len(batch_job["messages"]) > 0 and all(isinstance(_message, dict) and "role" in _message and "content" in _message for _message in batch_job["messages"])
+        return batch_job["mode"] in SCRIPT_MODES[:2] and isinstance(batch_job.get("prompt"), str)
+
+    def load_batch_jobs(input_path: str, output_path: str) -> list[dict]:
+        completed_job_ids: set[str] = set()
+        if os.path.exists(output_path):
+            with open(output_path, "rt", encoding="utf-8") as _file:
+                for line in _file:
+                    try:
+                        batch_result: dict = json.loads(line)
+                    except json.JSONDecodeError: # Partially written line from an interrupted run.
+                        continue
+                    if isinstance(batch_result, dict) and batch_result.get("error") is None and batch_result.get("id") is not None:
+                        completed_job_ids.add(str(batch_result.get("id")))
+
+            # Don't glue the next result to a partially written line.
+            with open(output_path, "rb") as _file:
+                _file.seek(0, os.SEEK_END)
+                if _file.tell() > 0:
+                    _file.seek(-1, os.SEEK_END)
+                    if _file.read(1) != b"\n":
+                        with open(output_path, "at", encoding="utf-8") as output_file:
+                            output_file.write("\n")
+
+        batch_jobs: list[dict] = []
+        with open(input_path, "rt", encoding="utf-8") as _file:
+            for line_number, line in enumerate(_file, 1):
+                if line.strip() == "":
+                    continue
+                try:
+                    batch_job: dict = json.loads(line)
+                except json.JSONDecodeError:
+                    new_print(f"Malformed batch job on line {line_number}", PRINT_COLORS["warning"])
+                    continue
+                if not isinstance(batch_job, dict):
+                    new_print(f"Malformed batch job on line {line_number}", PRINT_COLORS["warning"])
+                    continue
+                batch_job["id"] = str(batch_job.get("id", f"line-{line_number}"))
+                batch_job["mode"] = batch_job.get("mode", SCRIPT_MODES[0])
+                if not is_batch_job_valid(batch_job):
+                    new_print(f"Malformed batch job on line {line_number}", PRINT_COLORS["warning"])
+                    continue
+                if batch_job["id"] not in completed_job_ids:
+                    batch_jobs.append(batch_job)
+        return batch_jobs
+
+    # Several of these run at once to fill llama-server's parallel slots.
+    def run_batch_job(batch_job: dict) -> dict:
+        batch_job_start_time: float = time.perf_counter()
+        batch_result: dict = {
+            "id": batch_job["id"],
+            "mode": batch_job["mode"],
+            "content": None,
+            "timings": None,
+            "cached": False,
+            "error": None,
+        }
+        try:
+            if batch_job["mode"] == SCRIPT_MODES[0]:
+                messages: list[dict] = batch_job["messages"] if "messages" in batch_job else [{
+                    "role": TEXT_MODEL_CHAT_ROLES[1],
+                    "content": batch_job["prompt"],
+                }]
+                if len(text_model_message_history) > 0 and messages[0]["role"] != TEXT_MODEL_CHAT_ROLES[0]:
+                    messages = text_model_message_history[:1] + messages
+                payload: dict = {
+                    "model": text_model_id,
+                    "messages": messages,
+                    "stream": False,
+                    "cache_prompt": True,
+                }
+                endpoint: str = "/v1/chat/completions"
+            else:
+                payload: dict = {
+                    "model": text_model_id,
+                    "prompt": batch_job["prompt"],
+                    "stream": False,
+                    "cache_prompt": True,
+                    "n_predict": script_settings["text_model_gen_settings"]["autocomplete_max_tokens"],
+                }
+                endpoint: str = "/completion"
+            for key, value in construct_text_model_gen_parameters().items():
+                payload[key] = value
+            for key, value in batch_job.get("parameters", {}).items():
+                payload[key] = value
+
+            response_cache_keys: tuple[str, str] | None = None
+            request_embedding: array.array | None = None
+            if is_response_cacheable(payload):
+                response_cache_keys = get_response_cache_keys(TELEMETRY_REQUEST_KINDS[0] if batch_job["mode"] == SCRIPT_MODES[0] else TELEMETRY_REQUEST_KINDS[1], payload, payload["messages"] if batch_job["mode"] == SCRIPT_MODES[0] else payload["prompt"])
+                cached_response, request_embedding = read_response_cache(response_cache_keys, "\n".join(get_message_text(_message) for _message in payload["messages"]) if batch_job["mode"] == SCRIPT_MODES[0] else payload["prompt"])
+                if cached_response is not None:
+                    batch_result["content"] = cached_response["content"]
+                    batch_result["timings"] = cached_response["timings"]
+                    batch_result["cached"] = True
+                    batch_result["elapsed_ms"] = round((time.perf_counter() - batch_job_start_time) * 1000.0, 2)
+                    return batch_result
+
+            telemetry: RequestTelemetry = RequestTelemetry(TELEMETRY_REQUEST_KINDS[0] if batch_job["mode"] == SCRIPT_MODES[0] else TELEMETRY_REQUEST_KINDS[1])
+            batch_response: requests.Response = send_text_model_request("POST", endpoint, json=payload)
+            batch_response_data: dict = batch_response.json()
+            telemetry.bytes_received = len(batch_response.content)
+            telemetry.server_timings = batch_response_data.get("timings")
+            if "error" in batch_response_data:
+                batch_result["error"] = batch_response_data["error"]["message"]
+            elif batch_job["mode"] == SCRIPT_MODES[0]:
+                batch_result["content"] = batch_response_data["choices"][0]["message"]["content"]
+            else:
+                batch_result["content"] = batch_response_data["content"]
+            batch_result["timings"] = batch_response_data.get("timings")
+            if response_cache_keys is not None and batch_result["error"] is None:
+                write_response_cache(response_cache_keys, batch_result["content"], batch_result["timings"], request_embedding)
+            finish_request_telemetry(telemetry, batch_response)
+        except requests.exceptions.ConnectionError:
+            raise
+        except Exception as exception: # Only this job fails.
+            batch_result["error"] = str(exception)
+        batch_result["elapsed_ms"] = round((time.perf_counter() - batch_job_start_time) * 1000.0, 2)
+        return batch_result
+
+    async def run_batch_mode() -> None:
+        input_path: str = script_settings["batch_settings"]["input_path"]
+        output_path: str = script_settings["batch_settings"]["output_path"]
+        if len(sys.argv) > 2:
+            input_path = sys.argv[2]
+        if len(sys.argv) > 3:
+            output_path = sys.argv[3]
+        if not os.path.exists(input_path):
+            new_print(f"Batch input file '{input_path}' not found", PRINT_COLORS["error"])
+            return
+
+        batch_jobs: list[dict] = load_batch_jobs(input_path, output_path)
+        max_concurrent_requests: int = script_settings["batch_settings"]["max_concurrent_requests"]
+        if max_concurrent_requests == 0:
+            max_concurrent_requests = script_settings["text_model_init_settings"]["parallel_slots"] * len(text_model_backends)
+        new_print(f"Running {len(batch_jobs)} batch jobs with {max_concurrent_requests} concurrent requests", PRINT_COLORS["special"])
+
+        batch_semaphore: asyncio.Semaphore = asyncio.Semaphore(max_concurrent_requests)
+        batch_start_time: float = time.perf_counter()
+        batch_progress: dict[str, int] = {
+            "completed": 0,
+            "failed": 0,
+        }
+        is_server_closed: bool = False
+
+        with open(output_path, "at", encoding="utf-8") as output_file:
+            async def process_batch_job(batch_job: dict) -> None:
+                nonlocal is_server_closed
+                async with batch_semaphore:
+                    if is_server_closed:
+                        return
+                    batch_result: dict | None = None
+                    while batch_result is None:
+                        try:
+                            batch_result = await asyncio.to_thread(run_batch_job, batch_job)
+                        except requests.exceptions.ConnectionError:
+                            if await wait_for_server_restart(text_model_server_supervisor):
+                                continue
+                            # Leave the remaining jobs for the next run instead of recording them all as failures.
+                            is_server_closed = True
+                            return
+
+                if batch_result["error"] is not None:
+                    batch_progress["failed"] += 1
+                else:
+                    batch_progress["completed"] += 1
+                output_file.write(f"{json.dumps(batch_result)}\n")
+                output_file.flush()
+
+                jobs_per_second: float = (batch_progress["completed"] + batch_progress["failed"]) / max(time.perf_counter() - batch_start_time, 0.001)
+                print(f"\rBatch: {batch_progress["completed"]}/{len(batch_jobs)} completed, {batch_progress["failed"]} failed, {"{:.2f}".format(jobs_per_second)} jobs/s", end="", flush=True)
+
+            await asyncio.gather(*(process_batch_job(batch_job) for batch_job in batch_jobs))
+        print()
+
+        if is_server_closed:
+            new_print("Text model server was closed; run Batch Mode again to resume", PRINT_COLORS["error"])
+        else:
+            new_print(f"Batch finished in {"{:.2f}".format(time.perf_counter() - batch_start_time)} seconds", PRINT_COLORS["success"])
+
+    # EOS is ignored so that exactly output_length tokens are generated.
+    def run_bench_text_request(text_mode: str, stream: bool, prompt: str, output_length: int) -> dict:
+        payload: dict = {
+            "model": text_model_id,
+            "stream": stream,
+            "cache_prompt": False,
+            "ignore_eos": True,
+        }
+        for key, value in construct_text_model_gen_parameters().items():
+            payload[key] = value
+        payload["seed"] = BENCH_SEED
+
+        bench_error: str | None = None
+        try:
+            if text_mode == SCRIPT_MODES[0]:
+                payload["max_tokens"] = output_length
+                telemetry: RequestTelemetry = RequestTelemetry(TELEMETRY_REQUEST_KINDS[0])
+                request_body: bytes = encode_request_body(payload, [{
+                    "role": TEXT_MODEL_CHAT_ROLES[1],
+                    "content": prompt,
+                }])
+                telemetry.encode_time = time.perf_counter() - telemetry.start_time
+                bench_response: requests.Response = send_text_model_request("POST", "/v1/chat/completions", data=request_body, headers={"Content-Type": "application/json"}, stream=stream)
+            else:
+                payload["prompt"] = prompt
+                payload["n_predict"] = output_length
+                telemetry: RequestTelemetry = RequestTelemetry(TELEMETRY_REQUEST_KINDS[1])
+                bench_response: requests.Response = send_text_model_request("POST", "/completion", json=payload, stream=stream)
+            if not stream:
+                bench_response_data: dict = bench_response.json()
+                telemetry.bytes_received = len(bench_response.content)
+                telemetry.server_timings = bench_response_data.get("timings")
+                if "error" in bench_response_data:
+                    bench_error = bench_response_data["error"]["message"]
+            else:
+                try:
+                    for event_type, event_data in iter_sse_events(bench_response, telemetry):
+                        if event_type == SSE_EVENT_TYPES[0]:
+                            telemetry.server_timings = event_data.get("timings", telemetry.server_timings)
+                            if text_mode == SCRIPT_MODES[0]:
+                                if len(event_data.get("choices", [])) > 0 and event_data["choices"][0]["delta"].get("content") is not None:
+                                    telemetry.record_token()
+                            elif event_data["content"] != "":
+                                telemetry.record_token()
+                        elif event_type == SSE_EVENT_TYPES[2]:
+                            bench_error = event_data["message"]
+                            break
+                finally:
+                    bench_response.close()
+                    release_text_model_backend(bench_response)
+        except requests.exceptions.ConnectionError:
+            raise
+        except requests.exceptions.RequestException as exception:
+            # Timeouts and responses that were cut off count as failed requests.
+            return {
+                "error": str(exception),
+            }
+        metrics_record: dict = finish_request_telemetry(telemetry, bench_response)
+        metrics_record["error"] = bench_error
+        return metrics_record
+
+    # Runs in a worker thread, see run_bench_text_request(). The generated image is discarded.
+    def run_bench_image_request(steps: int, width: int, height: int) -> dict:
+        payload: dict = {
+            "prompt": BENCH_IMAGE_PROMPT,
+            "negative_prompt": "",
+        }
+        for key, value in script_settings["image_model_gen_settings"].items():
+            payload[key] = value
+        payload["steps"] = steps
+        payload["width"] = width
+        payload["height"] = height
+        payload["seed"] = BENCH_SEED
+        payload["batch_size"] = 1
+        payload["n_iter"] = 1
+        telemetry: RequestTelemetry = RequestTelemetry(TELEMETRY_REQUEST_KINDS[2])
+        try:
+            image_response: requests.Response = send_http_request(HTTP_CLIENT_BACKENDS[1], "POST", f"{image_model_server_url}/sdapi/v1/txt2img", json=payload)
+            telemetry.bytes_received = len(image_response.content)
+        except requests.exceptions.RequestException as exception:
+            # Losing the optional image model server doesn't end the run.
             return {
-                "data": base64.b64encode(_file.read()).decode(),
-                "format": get_path_extension(path, True)
+                "error": str(exception),
             }
+        telemetry.extra_fields = {
+            "steps": steps,
+            "width": width,
+            "height": height,
+        }
+        metrics_record: dict = finish_request_telemetry(telemetry, image_response)
+        metrics_record["error"] = None if image_response.status_code == 200 else f"HTTP {image_response.status_code}"
+        return metrics_record
+
+    def get_bench_median(metrics_records: list[dict], key: str) -> float | None:
+        values: list[float] = sorted(metrics_record[key] for metrics_record in metrics_records if metrics_record["error"] is None and metrics_record.get(key) is not None)
+        return round(get_percentile(values, 0.5), 2) if len(values) > 0 else None
+
+    # Throughput is generated tokens divided by the wall time of the rounds.
+    async def run_bench_cell(run_bench_request: typing.Callable[..., dict], concurrency_level: int, *args) -> dict:
+        metrics_records: list[dict] = []
+        bench_cell_time: float = 0.0
+        for _ in range(script_settings["bench_settings"]["repetitions"]):
+            bench_round_start_time: float = time.perf_counter()
+            metrics_records += await asyncio.gather(*(asyncio.to_thread(run_bench_request, *args) for _ in range(concurrency_level)))
+            bench_cell_time += time.perf_counter() - bench_round_start_time
+
+        bench_cell_result: dict = {
+            "requests": len(metrics_records),
+            "errors": sum(1 for metrics_record in metrics_records if metrics_record["error"] is not None),
+            "total_ms": get_bench_median(metrics_records, "total_ms"),
+            "ttft_ms": get_bench_median(metrics_records, "ttft_ms"),
+        }
+        if run_bench_request is run_bench_text_request:
+            bench_cell_result["prompt_n"] = get_bench_median(metrics_records, "prompt_n")
+            bench_cell_result["prompt_per_second"] = get_bench_median(metrics_records, "prompt_per_second")
+            bench_cell_result["predicted_per_second"] = get_bench_median(metrics_records, "predicted_per_second")
+            bench_cell_result["throughput_tokens_per_second"] = round(sum(metrics_record["predicted_n"] or 0 for metrics_record in metrics_records if metrics_record["error"] is None) / bench_cell_time, 2)
+        else:
+            steps: float | None = get_bench_median(metrics_records, "steps")
+            bench_cell_result["steps_per_second"] = round(steps / (bench_cell_result["total_ms"] / 1000.0), 2) if steps is not None and bench_cell_result["total_ms"] else None
+        return bench_cell_result
+
+    def print_bench_cell_result(bench_cell_key: str, bench_cell_result: dict) -> None:
+        bench_cell_string: str = f"{bench_cell_key}: {"{:.0f}".format(bench_cell_result["total_ms"] or 0.0)} ms"
+        if bench_cell_result["ttft_ms"] is not None:
+            bench_cell_string += f", TTFT: {"{:.0f}".format(bench_cell_result["ttft_ms"])} ms"
+        if bench_cell_result.get("prompt_per_second") is not None:
+            bench_cell_string += f", Prompt: {"{:.1f}".format(bench_cell_result["prompt_per_second"])} t/s"
+        if bench_cell_result.get("throughput_tokens_per_second") is not None:
+            bench_cell_string += f", Throughput: {"{:.1f}".format(bench_cell_result["throughput_tokens_per_second"])} t/s"
+        if bench_cell_result.get("steps_per_second") is not None:
+            bench_cell_string += f", {"{:.2f}".format(bench_cell_result["steps_per_second"])} steps/s"
+        if bench_cell_result["errors"] > 0:
+            new_print(f"{bench_cell_string}, {bench_cell_result["errors"]}/{bench_cell_result["requests"]} failed", PRINT_COLORS["warning"])
+        else:
+            print(bench_cell_string)
+
+    # Returns the metrics that got worse by more than regression_threshold.
+    def compare_bench_results(bench_results: dict, baseline_results: dict) -> list[dict]:
+        bench_regressions: list[dict] = []
+        for bench_cell_key, bench_cell_result in bench_results.items():
+            if bench_cell_key not in baseline_results:
+                continue
+            for metric_name, is_higher_better in BENCH_COMPARED_METRICS.items():
+                current_value: float | None = bench_cell_result.get(metric_name)
+                baseline_value: float | None = baseline_results[bench_cell_key].get(metric_name)
+                if current_value is None or not baseline_value:
+                    continue
+                relative_change: float = (current_value - baseline_value) / baseline_value
+                comparison_string: str = f"{bench_cell_key} {metric_name}: {baseline_value} -> {current_value} ({"{:+.1f}".format(relative_change * 100.0)}%)"
+                if (relative_change < -script_settings["bench_settings"]["regression_threshold"]) if is_higher_better else (relative_change > script_settings["bench_settings"]["regression_threshold"]):
+                    new_print(comparison_string, PRINT_COLORS["error"])
+                    bench_regressions.append({
+                        "cell": bench_cell_key,
+                        "metric": metric_name,
+                        "baseline": baseline_value,
+                        "current": current_value,
+                        "change": round(relative_change, 4),
+                    })
+                elif abs(relative_change) > script_settings["bench_settings"]["regression_threshold"]:
+                    new_print(comparison_string, PRINT_COLORS["success"])
+        return bench_regressions
+
+    # The prompt cache is disabled and the seed is fixed so that runs are comparable.
+    async def run_bench_mode() -> None:
+        bench_settings: dict = script_settings["bench_settings"]
+        bench_results: dict[str, dict] = {}
+        bench_start_time: float = time.perf_counter()
+        try:
+            sentence_token_count: int = max(await asyncio.to_thread(count_text_tokens, BENCH_PROMPT_SENTENCE), 1)
+            warmup_record: dict = await asyncio.to_thread(run_bench_text_request, SCRIPT_MODES[1], False, BENCH_PROMPT_SENTENCE, 1)
+            if warmup_record["error"] is not None:
+                new_print(f"Warmup request failed: {warmup_record["error"]}", PRINT_COLORS["warning"])
+
+            for text_mode in bench_settings["text_modes"]:
+                for stream in bench_settings["stream_responses"]:
+                    for prompt_length in bench_settings["prompt_lengths"]:
+                        prompt: str = BENCH_PROMPT_SENTENCE * max(prompt_length // sentence_token_count, 1)
+                        for output_length in bench_settings["output_lengths"]:
+                            for concurrency_level in bench_settings["concurrency_levels"]:
+                                bench_cell_key: str = f"{text_mode}/{"stream" if stream else "nonstream"}/p{prompt_length}/o{output_length}/c{concurrency_level}"
+                                bench_results[bench_cell_key] = await run_bench_cell(run_bench_text_request, concurrency_level, text_mode, stream, prompt, output_length)
+                                print_bench_cell_result(bench_cell_key, bench_results[bench_cell_key])
+        except requests.exceptions.ConnectionError:
+            new_print("Text model server was closed", PRINT_COLORS["error"])
+            return
+
+        if image_model_server_active:
+            try:
+                for steps in bench_settings["image_steps"]:
+                    for width in bench_settings["image_widths"]:
+                        for height in bench_settings["image_heights"]:
+                            bench_cell_key: str = f"{TELEMETRY_REQUEST_KINDS[2]}/s{steps}/{width}x{height}"
+                            bench_results[bench_cell_key] = await run_bench_cell(run_bench_image_request, 1, steps, width, height)
+                            print_bench_cell_result(bench_cell_key, bench_results[bench_cell_key])
+            except requests.exceptions.ConnectionError:
+                new_print("Image model server was closed", PRINT_COLORS["error"])
+        elif len(bench_settings["image_steps"]) > 0:
+            new_print("Image model server is offline, skipping the txt2img benchmark", PRINT_COLORS["warning"])
+        new_print(f"Benchmark finished in {"{:.2f}".format(time.perf_counter() - bench_start_time)} seconds", PRINT_COLORS["success"])
+
+        bench_document: dict = {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "model": text_model_id,
+            "text_model_init_settings": script_settings["text_model_init_settings"],
+            "text_model_gen_settings": script_settings["text_model_gen_settings"],
+            "image_model_gen_settings": script_settings["image_model_gen_settings"],
+            "results": bench_results,
+            "regressions": [],
+        }
+        baseline_path: str = bench_settings["baseline_path"]
+        if os.path.exists(baseline_path) and not bench_settings["update_baseline"]:
+            try:
+                with open(baseline_path, "rt", encoding="utf-8") as _file:
+                    baseline_document: dict = json.load(_file)
+                new_print(f"\nComparing with the baseline from {baseline_document.get("timestamp", "an unknown date")} ({baseline_document.get("model", "unknown model")})", PRINT_COLORS["special"])
+                bench_document["regressions"] = compare_bench_results(bench_results, baseline_document.get("results", {}))
+                if len(bench_document["regressions"]) > 0:
+                    new_print(f"{len(bench_document["regressions"])} metrics regressed by more than {"{:.0f}".format(bench_settings["regression_threshold"] * 100.0)}%", PRINT_COLORS["error"])
+                else:
+                    new_print("No regressions", PRINT_COLORS["success"])
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                new_print("Malformed benchmark baseline", PRINT_COLORS["warning"])
+        else:
+            with open(baseline_path, "wt", encoding="utf-8") as _file:
+                json.dump(bench_document, _file, indent=4)
+            new_print(f"Saved the results as the baseline in '{baseline_path}'", PRINT_COLORS["success"])
+
+        with open(bench_settings["results_path"], "wt", encoding="utf-8") as _file:
+            json.dump(bench_document, _file, indent=4)
+
+    def start_server_process(server_path: str, arguments: str) -> subprocess.Popen | None:
+        if script_settings["server_startup_behavior"] == SERVER_STARTUP_BEHAVIOR_OPTIONS[0]:
+            os.startfile(server_path, arguments=arguments)
+            return None
+        return subprocess.Popen(f"{server_path} {arguments}", stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
     def construct_arguments(_arguments: list[str]) -> str:
         argument_buffer: str = ""
@@ -647,6 +3616,9 @@ if __name__ == "__main__":
             script_settings["text_model_init_settings"]["server_port"] = clamp_int(script_settings["text_model_init_settings"]["server_port"], 1000, 9999)
             script_settings["text_model_init_settings"]["priority"] = clamp_int(script_settings["text_model_init_settings"]["priority"], 0, 3)
             script_settings["text_model_init_settings"]["gpu_layers"] = max(script_settings["text_model_init_settings"]["gpu_layers"], 0)
+            script_settings["text_model_init_settings"]["draft_gpu_layers"] = max(script_settings["text_model_init_settings"]["draft_gpu_layers"], 0)
+            script_settings["text_model_init_settings"]["draft_max_tokens"] = clamp_int(script_settings["text_model_init_settings"]["draft_max_tokens"], 1, 128)
+            script_settings["text_model_init_settings"]["draft_min_tokens"] = clamp_int(script_settings["text_model_init_settings"]["draft_min_tokens"], 0, script_settings["text_model_init_settings"]["draft_max_tokens"])
             script_settings["text_model_init_settings"]["logical_max_batch_size"] = max(script_settings["text_model_init_settings"]["logical_max_batch_size"], 16)
             script_settings["text_model_init_settings"]["physical_max_batch_size"] = max(script_settings["text_model_init_settings"]["physical_max_batch_size"], 4)
             if script_settings["text_model_init_settings"]["cache_type_k"] not in TEXT_MODEL_CACHE_TYPES:
@@ -655,6 +3627,9 @@ if __name__ == "__main__":
                 script_settings["text_model_init_settings"]["cache_type_v"] = TEXT_MODEL_CACHE_TYPES[1]
             script_settings["text_model_init_settings"]["cache_reuse_size"] = max(script_settings["text_model_init_settings"]["cache_reuse_size"], 0)
             script_settings["text_model_init_settings"]["context_size"] = max(script_settings["text_model_init_settings"]["context_size"], 256)
+            script_settings["text_model_init_settings"]["parallel_slots"] = clamp_int(script_settings["text_model_init_settings"]["parallel_slots"], 1, 64)
+            if script_settings["text_model_init_settings"]["slot_save_path"] != "" and not script_settings["text_model_init_settings"]["slot_save_path"].endswith(("/", "\\")):
+                script_settings["text_model_init_settings"]["slot_save_path"] += "/"
 
             # Validate text_model_gen_settings.
             script_settings["text_model_gen_settings"]["temperature"] = clamp_float(script_settings["text_model_gen_settings"]["temperature"], 0.0, 2.0)
@@ -671,14 +3646,108 @@ if __name__ == "__main__":
             script_settings["text_model_gen_settings"]["dry_allowed_length"] = clamp_int(script_settings["text_model_gen_settings"]["dry_allowed_length"], 0, 100)
             script_settings["text_model_gen_settings"]["xtc_probability"] = clamp_float(script_settings["text_model_gen_settings"]["xtc_probability"], 0.0, 1.0)
             script_settings["text_model_gen_settings"]["xtc_threshold"] = clamp_float(script_settings["text_model_gen_settings"]["xtc_threshold"], 0.0, 1.0)
+            script_settings["text_model_gen_settings"]["seed"] = clamp_int(script_settings["text_model_gen_settings"]["seed"], -1, 4294967295)
             script_settings["text_model_gen_settings"]["autocomplete_max_tokens"] = clamp_int(script_settings["text_model_gen_settings"]["autocomplete_max_tokens"], 16, 1024)
+            script_settings["text_model_gen_settings"]["stream_flush_interval_ms"] = clamp_int(script_settings["text_model_gen_settings"]["stream_flush_interval_ms"], 0, 1000)
+            script_settings["text_model_gen_settings"]["stream_flush_size"] = max(script_settings["text_model_gen_settings"]["stream_flush_size"], 1)
+            if script_settings["text_model_gen_settings"]["chat_streamed_thoughts_mode"] not in TEXT_MODEL_STREAMED_THOUGHTS_MODES:
+                script_settings["text_model_gen_settings"]["chat_streamed_thoughts_mode"] = TEXT_MODEL_STREAMED_THOUGHTS_MODES[0]
+            if script_settings["text_model_gen_settings"]["chat_context_overflow_strategy"] not in TEXT_MODEL_CONTEXT_OVERFLOW_STRATEGIES:
+                script_settings["text_model_gen_settings"]["chat_context_overflow_strategy"] = TEXT_MODEL_CONTEXT_OVERFLOW_STRATEGIES[1]
+            script_settings["text_model_gen_settings"]["chat_context_response_reserve"] = max(script_settings["text_model_gen_settings"]["chat_context_response_reserve"], 0)
+            script_settings["text_model_gen_settings"]["chat_context_trim_ratio"] = clamp_float(script_settings["text_model_gen_settings"]["chat_context_trim_ratio"], 0.1, 1.0)
+            script_settings["text_model_gen_settings"]["chat_context_summary_max_tokens"] = clamp_int(script_settings["text_model_gen_settings"]["chat_context_summary_max_tokens"], 16, 2048)
+            script_settings["text_model_gen_settings"]["chat_slot_id"] = max(script_settings["text_model_gen_settings"]["chat_slot_id"], -1)
+
+            # Validate text_model_backend_settings.
+            script_settings["text_model_backend_settings"]["additional_server_urls"] = [_value.rstrip("/") for _value in script_settings["text_model_backend_settings"]["additional_server_urls"] if isinstance(_value, str) and validators.url(_value, simple_host=True)]
+            if script_settings["text_model_backend_settings"]["routing_strategy"] not in TEXT_MODEL_ROUTING_STRATEGIES:
+                script_settings["text_model_backend_settings"]["routing_strategy"] = TEXT_MODEL_ROUTING_STRATEGIES[0]
+            if script_settings["text_model_backend_settings"]["embedding_server_url"] != "" and not validators.url(script_settings["text_model_backend_settings"]["embedding_server_url"], simple_host=True):
+                script_settings["text_model_backend_settings"]["embedding_server_url"] = ""
+            script_settings["text_model_backend_settings"]["embedding_server_url"] = script_settings["text_model_backend_settings"]["embedding_server_url"].rstrip("/")
 
             # Validate image_model_init_settings.
             script_settings["image_model_init_settings"]["server_port"] = clamp_int(script_settings["image_model_init_settings"]["server_port"], 1000, 9999)
             if script_settings["image_model_init_settings"]["hardware_acceleration"] not in IMAGE_MODEL_HARDWARE_ACCELERATION_OPTIONS:
                 script_settings["image_model_init_settings"]["hardware_acceleration"] = IMAGE_MODEL_HARDWARE_ACCELERATION_OPTIONS[1]
 
-            # TODO: Implement image_model_gen_settings validation.
+            # Validate image_model_gen_settings.
+            script_settings["image_model_gen_settings"]["cfg_scale"] = clamp_float(script_settings["image_model_gen_settings"]["cfg_scale"], 1.0, 30.0)
+            script_settings["image_model_gen_settings"]["steps"] = clamp_int(script_settings["image_model_gen_settings"]["steps"], 1, 150)
+            script_settings["image_model_gen_settings"]["width"] = clamp_int(script_settings["image_model_gen_settings"]["width"], 64, 2048) // 64 * 64
+            script_settings["image_model_gen_settings"]["height"] = clamp_int(script_settings["image_model_gen_settings"]["height"], 64, 2048) // 64 * 64
+            script_settings["image_model_gen_settings"]["seed"] = clamp_int(script_settings["image_model_gen_settings"]["seed"], -1, 4294967295)
+            script_settings["image_model_gen_settings"]["clip_skip"] = clamp_int(script_settings["image_model_gen_settings"]["clip_skip"], -1, 12)
+            if not isinstance(script_settings["image_model_gen_settings"]["sampler_name"], str) or script_settings["image_model_gen_settings"]["sampler_name"].strip() == "":
+                script_settings["image_model_gen_settings"]["sampler_name"] = "Euler a"
+            script_settings["image_model_gen_settings"]["batch_size"] = clamp_int(script_settings["image_model_gen_settings"]["batch_size"], 1, 8)
+            script_settings["image_model_gen_settings"]["n_iter"] = clamp_int(script_settings["image_model_gen_settings"]["n_iter"], 1, 100)
+
+            # Validate http_client_settings.
+            script_settings["http_client_settings"]["pool_connections"] = clamp_int(script_settings["http_client_settings"]["pool_connections"], 1, 64)
+            script_settings["http_client_settings"]["pool_max_size"] = clamp_int(script_settings["http_client_settings"]["pool_max_size"], 1, 64)
+            script_settings["http_client_settings"]["connect_timeout"] = max(script_settings["http_client_settings"]["connect_timeout"], 0.0)
+            script_settings["http_client_settings"]["read_timeout"] = max(script_settings["http_client_settings"]["read_timeout"], 0.0)
+
+            # Validate attachment_settings.
+            script_settings["attachment_settings"]["max_size_mb"] = max(script_settings["attachment_settings"]["max_size_mb"], 1)
+            script_settings["attachment_settings"]["image_max_dimension"] = clamp_int(script_settings["attachment_settings"]["image_max_dimension"], 64, 16384)
+            script_settings["attachment_settings"]["max_directory_files"] = clamp_int(script_settings["attachment_settings"]["max_directory_files"], 1, 10000)
+            script_settings["attachment_settings"]["max_file_tokens"] = max(script_settings["attachment_settings"]["max_file_tokens"], 64)
+            script_settings["attachment_settings"]["max_total_tokens"] = max(script_settings["attachment_settings"]["max_total_tokens"], script_settings["attachment_settings"]["max_file_tokens"])
+            script_settings["attachment_settings"]["directory_read_threads"] = clamp_int(script_settings["attachment_settings"]["directory_read_threads"], 1, 64)
+            script_settings["attachment_settings"]["url_connect_timeout"] = max(script_settings["attachment_settings"]["url_connect_timeout"], 0.1)
+            script_settings["attachment_settings"]["url_read_timeout"] = max(script_settings["attachment_settings"]["url_read_timeout"], 0.1)
+            script_settings["attachment_settings"]["url_total_timeout"] = max(script_settings["attachment_settings"]["url_total_timeout"], script_settings["attachment_settings"]["url_read_timeout"])
+            script_settings["attachment_settings"]["url_max_size_mb"] = max(script_settings["attachment_settings"]["url_max_size_mb"], 1)
+            script_settings["attachment_settings"]["url_max_concurrent_fetches"] = clamp_int(script_settings["attachment_settings"]["url_max_concurrent_fetches"], 1, 32)
+
+            # Validate attachment_cache_settings.
+            if not script_settings["attachment_cache_settings"]["cache_dir"].endswith(("/", "\\")):
+                script_settings["attachment_cache_settings"]["cache_dir"] += "/"
+            script_settings["attachment_cache_settings"]["max_size_mb"] = max(script_settings["attachment_cache_settings"]["max_size_mb"], 1)
+
+            # Validate batch_settings.
+            script_settings["batch_settings"]["max_concurrent_requests"] = clamp_int(script_settings["batch_settings"]["max_concurrent_requests"], 0, 64)
+
+            # Validate retrieval_settings.
+            if script_settings["retrieval_settings"]["enabled"] and numpy is None:
+                new_print("Retrieval requires numpy (pip install numpy), so it stays disabled", PRINT_COLORS["warning"])
+                script_settings["retrieval_settings"]["enabled"] = False
+            if not script_settings["retrieval_settings"]["index_dir"].endswith(("/", "\\")):
+                script_settings["retrieval_settings"]["index_dir"] += "/"
+            script_settings["retrieval_settings"]["min_attachment_size_kb"] = max(script_settings["retrieval_settings"]["min_attachment_size_kb"], 0)
+            script_settings["retrieval_settings"]["chunk_size"] = clamp_int(script_settings["retrieval_settings"]["chunk_size"], 200, 8000)
+            script_settings["retrieval_settings"]["top_k"] = clamp_int(script_settings["retrieval_settings"]["top_k"], 1, 64)
+
+            # Validate response_cache_settings.
+            script_settings["response_cache_settings"]["ttl_hours"] = max(script_settings["response_cache_settings"]["ttl_hours"], 0.0)
+            script_settings["response_cache_settings"]["max_entries"] = max(script_settings["response_cache_settings"]["max_entries"], 1)
+            script_settings["response_cache_settings"]["similarity_threshold"] = clamp_float(script_settings["response_cache_settings"]["similarity_threshold"], 0.5, 1.0)
+
+            # Validate bench_settings.
+            script_settings["bench_settings"]["text_modes"] = [_value for _value in script_settings["bench_settings"]["text_modes"] if _value in SCRIPT_MODES[:2]]
+            script_settings["bench_settings"]["stream_responses"] = [_value for _value in script_settings["bench_settings"]["stream_responses"] if isinstance(_value, bool)]
+            script_settings["bench_settings"]["prompt_lengths"] = [clamp_int(_value, 1, 131072) for _value in script_settings["bench_settings"]["prompt_lengths"] if isinstance(_value, int)]
+            script_settings["bench_settings"]["output_lengths"] = [clamp_int(_value, 1, 16384) for _value in script_settings["bench_settings"]["output_lengths"] if isinstance(_value, int)]
+            script_settings["bench_settings"]["concurrency_levels"] = [clamp_int(_value, 1, 64) for _value in script_settings["bench_settings"]["concurrency_levels"] if isinstance(_value, int)]
+            script_settings["bench_settings"]["repetitions"] = clamp_int(script_settings["bench_settings"]["repetitions"], 1, 100)
+            script_settings["bench_settings"]["image_steps"] = [clamp_int(_value, 1, 100) for _value in script_settings["bench_settings"]["image_steps"] if isinstance(_value, int)]
+            script_settings["bench_settings"]["image_widths"] = [clamp_int(_value, 64, 2048) for _value in script_settings["bench_settings"]["image_widths"] if isinstance(_value, int)]
+            script_settings["bench_settings"]["image_heights"] = [clamp_int(_value, 64, 2048) for _value in script_settings["bench_settings"]["image_heights"] if isinstance(_value, int)]
+            script_settings["bench_settings"]["regression_threshold"] = clamp_float(script_settings["bench_settings"]["regression_threshold"], 0.0, 1.0)
+
+            # Validate session_settings.
+            if not script_settings["session_settings"]["session_dir"].endswith(("/", "\\")):
+                script_settings["session_settings"]["session_dir"] += "/"
+
+            # Validate server_supervisor_settings.
+            script_settings["server_supervisor_settings"]["max_restarts"] = clamp_int(script_settings["server_supervisor_settings"]["max_restarts"], 0, 100)
+            if not script_settings["server_supervisor_settings"]["log_dir"].endswith(("/", "\\")):
+                script_settings["server_supervisor_settings"]["log_dir"] += "/"
+            script_settings["server_supervisor_settings"]["log_max_size_mb"] = max(script_settings["server_supervisor_settings"]["log_max_size_mb"], 1)
+            script_settings["server_supervisor_settings"]["log_backup_count"] = clamp_int(script_settings["server_supervisor_settings"]["log_backup_count"], 0, 100)
 
             # Validate server ports.
             if script_settings["text_model_init_settings"]["server_port"] == script_settings["image_model_init_settings"]["server_port"]:
@@ -688,12 +3757,16 @@ if __name__ == "__main__":
     with open(SCRIPT_SETTINGS_PATH, "wt") as file:
         json.dump(script_settings, file, indent=4)
 
+    # A mode passed on the command line only applies to this run.
+    if len(sys.argv) > 1 and sys.argv[1] in SCRIPT_MODES:
+        script_settings["script_mode"] = sys.argv[1]
+
     # Initialize server URL variables.
     text_model_server_url += str(script_settings["text_model_init_settings"]["server_port"])
     image_model_server_url += str(script_settings["image_model_init_settings"]["server_port"])
 
-    # If the system prompt is specified and the script is running in Chat Mode, add it to the context.
-    if script_settings["script_mode"] == SCRIPT_MODES[0] and os.path.exists(TEXT_MODEL_CHAT_SYSTEM_PROMPT_PATH):
+    # If the system prompt is specified and the script is running in Chat Mode or Batch Mode, add it to the context.
+    if script_settings["script_mode"] in (SCRIPT_MODES[0], SCRIPT_MODES[2]) and os.path.exists(TEXT_MODEL_CHAT_SYSTEM_PROMPT_PATH):
         try:
             with open(TEXT_MODEL_CHAT_SYSTEM_PROMPT_PATH, "rt") as file:
                 file_contents: str = file.read().strip()
@@ -704,25 +3777,35 @@ if __name__ == "__main__":
 
     new_print(f"Script will run in {get_current_script_mode()} Mode\n", PRINT_COLORS["special"])
 
+    # Both servers are started together so that their models load in parallel.
+    text_model_server_command: tuple[str, str] | None = None
+    image_model_server_command: tuple[str, str] | None = None
     try:
-        poll_text_model_server_api()
+        if poll_text_model_server_api():
+            new_print("Text model server is online", PRINT_COLORS["success"])
     except requests.exceptions.ConnectionError:
-        while True:
-            llama_cpp_dir_path: str = strip_leading_and_trailing_quotes(input("Enter the path to llama.cpp: "))
-            llama_server_path: str = f"{llama_cpp_dir_path}{TEXT_MODEL_SERVER_FILENAME}"
-            if os.path.exists(llama_server_path):
-                break
-            new_print(f"Directory is invalid or does not contain {TEXT_MODEL_SERVER_FILENAME}", PRINT_COLORS["error"])
+        # Saved paths are used without prompting so Batch Mode can run unattended.
+        llama_cpp_dir_path: str = script_settings["text_model_init_settings"]["server_dir_path"]
+        llama_server_path: str = f"{llama_cpp_dir_path}{TEXT_MODEL_SERVER_FILENAME}"
+        while not os.path.exists(llama_server_path):
+            if llama_cpp_dir_path != "":
+                new_print(f"Directory is invalid or does not contain {TEXT_MODEL_SERVER_FILENAME}", PRINT_COLORS["error"])
+            llama_cpp_dir_path = strip_leading_and_trailing_quotes(input("Enter the path to llama.cpp: "))
+            llama_server_path = f"{llama_cpp_dir_path}{TEXT_MODEL_SERVER_FILENAME}"
+
+        text_model_path: str = script_settings["text_model_init_settings"]["model_path"]
+        while not os.path.exists(text_model_path) or get_path_extension(text_model_path, False) != TEXT_MODEL_EXTENSION:
+            if text_model_path != "":
+                new_print("File does not exist or is not a text model", PRINT_COLORS["error"])
+            text_model_path = strip_leading_and_trailing_quotes(input("Enter a text model path: "))
 
-        while True:
-            text_model_path: str = strip_leading_and_trailing_quotes(input("Enter a text model path: "))
-            if os.path.exists(text_model_path) and get_path_extension(text_model_path, False) == TEXT_MODEL_EXTENSION:
-                break
-            new_print("File does not exist or is not a text model", PRINT_COLORS["error"])
-
-        new_print("Starting llama.cpp (text model server)", PRINT_COLORS["success"])
         text_model_mmproj_path: str = f"{text_model_path.removesuffix(TEXT_MODEL_EXTENSION)}-mmproj{TEXT_MODEL_EXTENSION}"
         does_text_model_mmproj_exist: bool = os.path.exists(text_model_mmproj_path) if not script_settings["text_model_init_settings"]["disable_mmproj"] else False
+        # A -draft model next to the main model enables speculative decoding.
+        text_model_draft_path: str = f"{text_model_path.removesuffix(TEXT_MODEL_EXTENSION)}-draft{TEXT_MODEL_EXTENSION}"
+        does_text_model_draft_exist: bool = os.path.exists(text_model_draft_path) if not script_settings["text_model_init_settings"]["disable_draft_model"] else False
+        if does_text_model_draft_exist:
+            new_print(f"Using {os.path.basename(text_model_draft_path)} for speculative decoding", PRINT_COLORS["special"])
         arguments: str = construct_arguments([
             f"--port {script_settings["text_model_init_settings"]["server_port"]}",
             f"--prio-batch {script_settings["text_model_init_settings"]["priority"]}",
@@ -739,47 +3822,21 @@ if __name__ == "__main__":
             "--no-context-shift" if not script_settings["text_model_init_settings"]["use_context_shift"] else "",
             f"--model \"{text_model_path}\"",
             f"--mmproj \"{text_model_mmproj_path}\"" if does_text_model_mmproj_exist else "",
+            f"--model-draft \"{text_model_draft_path}\"" if does_text_model_draft_exist else "",
+            f"--gpu-layers-draft {script_settings["text_model_init_settings"]["draft_gpu_layers"]}" if does_text_model_draft_exist else "",
+            f"--draft-max {script_settings["text_model_init_settings"]["draft_max_tokens"]}" if does_text_model_draft_exist else "",
+            f"--draft-min {script_settings["text_model_init_settings"]["draft_min_tokens"]}" if does_text_model_draft_exist else "",
             f"--ctx-size {script_settings["text_model_init_settings"]["context_size"]}",
+            f"--parallel {script_settings["text_model_init_settings"]["parallel_slots"]}",
+            f"--slot-save-path \"{os.path.abspath(script_settings["text_model_init_settings"]["slot_save_path"])}\"" if script_settings["text_model_init_settings"]["slot_save_path"] != "" else "",
             "--keep -1",
         ])
-        if script_settings["server_startup_behavior"] == SERVER_STARTUP_BEHAVIOR_OPTIONS[0]:
-            os.startfile(llama_server_path, arguments=arguments)
-        elif script_settings["server_startup_behavior"] == SERVER_STARTUP_BEHAVIOR_OPTIONS[1]:
-            subprocess.Popen(f"{llama_server_path} {arguments}", stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-    while True:
-        if not text_model_server_active:
-            try:
-                poll_text_model_server_api()
-            except requests.exceptions.ConnectionError:
-                new_print("Text model server was closed", PRINT_COLORS["error"])
-                exit()
-        else:
-            try:
-                text_model_info_response: requests.Response = requests.get(f"{text_model_server_url}/v1/models")
-                text_model_id = text_model_info_response.json()["data"][0]["id"]
-
-                text_model_properties_response: requests.Response = requests.get(f"{text_model_server_url}/props")
-                text_model_properties: dict = text_model_properties_response.json()
-                for key, value in text_model_properties["modalities"].items():
-                    if key in text_model_modalities:
-                        text_model_modalities[key] = value
-                    else:
-                        new_print(f"Text model server supports modality '{key}' but it's not implemented in the script", PRINT_COLORS["warning"])
-
-                text_model_modalities_string: str = ""
-                for key, value in text_model_modalities.items():
-                    text_model_modalities_string += f"{key.capitalize()}: {value}, "
-                text_model_modalities_string = text_model_modalities_string.removesuffix(", ")
-                new_print(f"Running {text_model_id}{f" ({text_model_modalities_string})" if len(text_model_modalities) > 0 else ""}\n", PRINT_COLORS["success"])
-                break
-            except requests.exceptions.ConnectionError:
-                new_print("Text model server was closed", PRINT_COLORS["error"])
-                exit()
-        time.sleep(SERVER_CHECK_INTERVAL)
+        if script_settings["text_model_init_settings"]["slot_save_path"] != "":
+            os.makedirs(script_settings["text_model_init_settings"]["slot_save_path"], exist_ok=True)
+        text_model_server_command = (llama_server_path, arguments)
 
     # NOTE: KoboldCpp is used to allow the script to interface with stable-diffusion.cpp.
-    if script_settings["script_mode"] == SCRIPT_MODES[0] and script_settings["enable_image_model_server_in_chat"]:
+    if script_settings["script_mode"] in (SCRIPT_MODES[0], SCRIPT_MODES[3]) and script_settings["enable_image_model_server_in_chat"]:
         image_model_server_active = is_image_model_server_online()
         if not image_model_server_active:
             while True:
@@ -796,7 +3853,6 @@ if __name__ == "__main__":
                     break
                 new_print("File does not exist or is not an image model", PRINT_COLORS["error"])
 
-            new_print("Starting KoboldCpp (image model server)", PRINT_COLORS["success"])
             arguments: str = construct_arguments([
                 "--skiplauncher",
                 f"--port {script_settings["image_model_init_settings"]["server_port"]}",
@@ -809,199 +3865,97 @@ if __name__ == "__main__":
                 "--sdnotile" if not script_settings["image_model_init_settings"]["use_vae_tiling"] else "",
                 "--sdquant" if image_model_extension == IMAGE_MODEL_EXTENSIONS[0] and script_settings["image_model_init_settings"]["quantize_safetensors_on_server_start"] else "",
             ])
-            if script_settings["server_startup_behavior"] == SERVER_STARTUP_BEHAVIOR_OPTIONS[0]:
-                os.startfile(koboldcpp_path, arguments=arguments)
-            elif script_settings["server_startup_behavior"] == SERVER_STARTUP_BEHAVIOR_OPTIONS[1]:
-                subprocess.Popen(f"{koboldcpp_path} {arguments}", stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-            image_model_server_checks: int = 0
-            while True:
-                if image_model_server_checks > IMAGE_MODEL_MAX_SERVER_CHECKS:
-                    new_print("Image model server was closed or image model took too long to load\n", PRINT_COLORS["error"])
-                    break
-
-                image_model_server_checks += 1
-                image_model_server_active = is_image_model_server_online()
-                if image_model_server_active:
-                    break
-                time.sleep(SERVER_CHECK_INTERVAL)
-
-    while True:
-        if script_settings["script_mode"] == SCRIPT_MODES[0]: # Chat Mode
-            user_message: str = input(f"{PRINT_COLORS["user_prefix"]}USER: {colorama.Style.RESET_ALL}")
-            command: str = user_message.strip()
-
-            if command == COMMAND_IMAGE_ALIAS:
-                if not image_model_server_active:
-                    new_print("Image model server is offline", PRINT_COLORS["error"])
-                    continue
-
-                image_positive_prompt: str = input("Enter a positive prompt: ").strip()
-                if image_positive_prompt == "":
-                    new_print("Cannot generate images with an empty positive prompt", PRINT_COLORS["error"])
-                    continue
-                image_negative_prompt: str = input("Enter a negative prompt (optional): ").strip()
-                new_print("Generating...", PRINT_COLORS["success"])
+            image_model_server_command = (koboldcpp_path, arguments)
+
+    # Servers that were already running are only waited on.
+    server_startup_monitors: list[ServerStartupMonitor] = []
+    text_model_server_supervisor: ServerProcessSupervisor | None = None
+    image_model_server_supervisor: ServerProcessSupervisor | None = None
+    text_model_startup_monitor: ServerStartupMonitor | None = None
+    image_model_startup_monitor: ServerStartupMonitor | None = None
+    if not text_model_server_active:
+        if text_model_server_command is not None:
+            new_print("Starting llama.cpp (text model server)", PRINT_COLORS["success"])
+            text_model_server_supervisor = ServerProcessSupervisor("Text model server", *text_model_server_command, TEXT_MODEL_SERVER_LOG_FILENAME, TEXT_MODEL_SERVER_LOG_STAGES, TEXT_MODEL_SERVER_LOG_READY_PATTERN, poll_text_model_server_api, TEXT_MODEL_SERVER_START_TIMEOUT, replay_text_model_history if script_settings["server_supervisor_settings"]["replay_history_on_restart"] else None)
+            text_model_startup_monitor = text_model_server_supervisor.start()
+        else:
+            text_model_startup_monitor = ServerStartupMonitor("Text model server", None, TEXT_MODEL_SERVER_LOG_STAGES, TEXT_MODEL_SERVER_LOG_READY_PATTERN, poll_text_model_server_api, TEXT_MODEL_SERVER_START_TIMEOUT)
+        server_startup_monitors.append(text_model_startup_monitor)
+    if image_model_server_command is not None:
+        new_print("Starting KoboldCpp (image model server)", PRINT_COLORS["success"])
+        image_model_server_supervisor = ServerProcessSupervisor("Image model server", *image_model_server_command, IMAGE_MODEL_SERVER_LOG_FILENAME, IMAGE_MODEL_SERVER_LOG_STAGES, IMAGE_MODEL_SERVER_LOG_READY_PATTERN, poll_image_model_server_api, IMAGE_MODEL_SERVER_START_TIMEOUT)
+        image_model_startup_monitor = image_model_server_supervisor.start()
+        server_startup_monitors.append(image_model_startup_monitor)
+    if len(server_startup_monitors) > 0:
+        try:
+            asyncio.run(wait_for_server_startup())
+        except KeyboardInterrupt:
+            stop_managed_servers()
+            exit()
 
-                try:
-                    payload: dict = {
-                        "prompt": image_positive_prompt,
-                        "negative_prompt": image_negative_prompt,
-                    }
-                    for key, value in script_settings["image_model_gen_settings"].items():
-                        payload[key] = value
-                    image_generation_start_time: float = time.time()
-                    image_response: requests.Response = requests.post(f"{image_model_server_url}/sdapi/v1/txt2img", json=payload)
+    if text_model_startup_monitor is not None and not text_model_startup_monitor.is_ready:
+        new_print("Text model server was closed", PRINT_COLORS["error"])
+        stop_managed_servers()
+        exit()
 
-                    # Ensure that the image output directory exists.
-                    try:
-                        os.mkdir(IMAGE_MODEL_OUTPUT_DIR_NAME)
-                    except FileExistsError:
-                        pass
-
-                    image_output_path: str = f"{IMAGE_MODEL_OUTPUT_DIR_NAME}{datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")}.png"
-                    with open(image_output_path, "wb") as file:
-                        file.write(base64.b64decode(image_response.json()["images"][0]))
-                    if script_settings["open_image_output_on_gen"]:
-                        os.startfile(os.path.abspath(image_output_path))
-                    model_message: str = f"Generated in {"{:.2f}".format(time.time() - image_generation_start_time)} seconds."
-                    if text_model_modalities["vision"]:
-                        if image_negative_prompt == "":
-                            append_message(TEXT_MODEL_CHAT_ROLES[1], f"**Prompt:** {image_positive_prompt}\n\nGenerate an image using the provided prompt.")
-                        else:
-                            append_message(TEXT_MODEL_CHAT_ROLES[1], f"**Positive Prompt:** {image_positive_prompt}\n**Negative Prompt:** {image_negative_prompt}\n\nGenerate an image using the provided positive prompt and negative prompt.")
-                        if append_message(TEXT_MODEL_CHAT_ROLES[2], model_message, image_output_path):
-                            print(f"\n{PRINT_COLORS["model_prefix"]}MODEL: {colorama.Style.RESET_ALL}{model_message}\n")
-                    else:
-                        print(f"\n{PRINT_COLORS["model_prefix"]}MODEL: {colorama.Style.RESET_ALL}{model_message} This message won't be added to the context as I cannot see images.\n")
-                except requests.exceptions.ConnectionError:
-                    image_model_server_active = False
-                    new_print("Image model server was closed", PRINT_COLORS["error"])
-            elif command == COMMAND_HELP_ALIAS:
-                new_print(f"{COMMAND_IMAGE_ALIAS} - Generate an image (requires the image model server to be online).", PRINT_COLORS["special"])
-                new_print(f"{COMMAND_ATTACH_ALIAS} - Attach a file or URL to your message (command must be at the end of your message).", PRINT_COLORS["special"])
-                new_print(f"{COMMAND_HELP_ALIAS} - Display all commands.", PRINT_COLORS["special"])
-                new_print(f"{COMMAND_EXIT_ALIAS} - Exit the application.", PRINT_COLORS["special"])
-            elif command == COMMAND_EXIT_ALIAS:
-                break
+    try:
+        text_model_info_response: requests.Response = send_http_request(HTTP_CLIENT_BACKENDS[0], "GET", f"{text_model_server_url}/v1/models")
+        text_model_id = text_model_info_response.json()["data"][0]["id"]
+
+        text_model_properties_response: requests.Response = send_http_request(HTTP_CLIENT_BACKENDS[0], "GET", f"{text_model_server_url}/props")
+        text_model_properties: dict = text_model_properties_response.json()
+        text_model_context_size = text_model_properties.get("default_generation_settings", {}).get("n_ctx", script_settings["text_model_init_settings"]["context_size"])
+        for key, value in text_model_properties["modalities"].items():
+            if key in text_model_modalities:
+                text_model_modalities[key] = value
             else:
-                file_path: str = ""
+                new_print(f"Text model server supports modality '{key}' but it's not implemented in the script", PRINT_COLORS["warning"])
 
-                if command.endswith(COMMAND_ATTACH_ALIAS):
-                    file_path = strip_leading_and_trailing_quotes(input("Enter a file path or URL: "))
-                    user_message = user_message.removesuffix(COMMAND_ATTACH_ALIAS).rstrip()
+        text_model_modalities_string: str = ""
+        for key, value in text_model_modalities.items():
+            text_model_modalities_string += f"{key.capitalize()}: {value}, "
+        text_model_modalities_string = text_model_modalities_string.removesuffix(", ")
+        new_print(f"Running {text_model_id}{f" ({text_model_modalities_string})" if len(text_model_modalities) > 0 else ""}\n", PRINT_COLORS["success"])
+    except requests.exceptions.ConnectionError:
+        new_print("Text model server was closed", PRINT_COLORS["error"])
+        stop_managed_servers()
+        exit()
+
+    # The additional servers are expected to run the same model.
+    text_model_backends: list[TextModelBackend] = [TextModelBackend(text_model_server_url)]
+    text_model_backend_affinity: dict[str, TextModelBackend] = {}
+    for _value in script_settings["text_model_backend_settings"]["additional_server_urls"]:
+        text_model_backend: TextModelBackend = TextModelBackend(_value)
+        try:
+            text_model_backend.is_healthy = send_http_request(HTTP_CLIENT_BACKENDS[0], "GET", f"{_value}/health").status_code == 200
+        except requests.exceptions.ConnectionError:
+            text_model_backend.is_healthy = False
+        if text_model_backend.is_healthy:
+            new_print(f"Text model server {_value} is online", PRINT_COLORS["success"])
+        else:
+            text_model_backend.last_failure_time = time.perf_counter()
+            new_print(f"Text model server {_value} is offline, it will be tried again later", PRINT_COLORS["warning"])
+        text_model_backends.append(text_model_backend)
+    if len(text_model_backends) > 1:
+        new_print(f"Routing requests across {len(text_model_backends)} text model servers ({script_settings["text_model_backend_settings"]["routing_strategy"]})\n", PRINT_COLORS["success"])
+
+    if image_model_startup_monitor is not None:
+        image_model_server_active = image_model_startup_monitor.is_ready
+        if not image_model_server_active:
+            new_print("Image model server was closed or image model took too long to load\n", PRINT_COLORS["error"])
 
-                if append_message(TEXT_MODEL_CHAT_ROLES[1], user_message, file_path):
-                    try:
-                        payload: dict = {
-                            "model": text_model_id,
-                            "messages": text_model_message_history,
-                            "stream": script_settings["text_model_gen_settings"]["stream_responses"],
-                        }
-                        for key, value in construct_text_model_gen_parameters().items():
-                            payload[key] = value
-
-                        new_print("\nMODEL: ", PRINT_COLORS["model_prefix"], "")
-                        chat_response: requests.Response = requests.post(f"{text_model_server_url}/v1/chat/completions", json=payload, stream=script_settings["text_model_gen_settings"]["stream_responses"])
-                        if not script_settings["text_model_gen_settings"]["stream_responses"]:
-                            chat_response_data: dict = chat_response.json()
-                            if "error" not in chat_response_data:
-                                model_message: str = chat_response_data["choices"][0]["message"]["content"]
-                                if append_message(TEXT_MODEL_CHAT_ROLES[2], process_text(model_message, script_settings["text_model_gen_settings"]["chat_include_thoughts_in_history"])):
-                                    print(f"{process_text(model_message, script_settings["text_model_gen_settings"]["chat_show_thoughts_in_nonstreaming_mode"])}\n")
-                            else:
-                                match chat_response_data["error"]["message"]:
-                                    case "the request exceeds the available context size. try increasing the context size or enable context shift":
-                                        print("Your message exceeds the available context size. Try increasing the context size or enable Context Shift.", end="")
-                                    case "Failed to load image or audio file":
-                                        print("This file is not encodable.", end="")
-                                    case _:
-                                        print("An error occurred.", end="")
-                                print(" This message won't be added to the context.\n")
-                                text_model_message_history.pop()
-                        else:
-                            model_message_buffer: str = ""
-
-                            # Streaming code based on: https://gist.github.com/ggorlen/7c944d73e27980544e29aa6de1f2ac54
-                            for line in chat_response.iter_lines():
-                                decoded_line: str = line.decode("utf-8")
-                                if decoded_line.startswith("data: ") and not decoded_line.endswith("[DONE]"):
-                                    chunk: str | None = json.loads(line[len("data: "):])["choices"][0]["delta"].get("content", "")
-                                    if chunk is not None:
-                                        model_message_buffer += chunk
-                                        print(chunk, end="", flush=True)
-                                elif decoded_line.startswith("error: "):
-                                    match json.loads(line[len("error: "):])["message"]:
-                                        case "the request exceeds the available context size. try increasing the context size or enable context shift":
-                                            new_print("Your message exceeds the available context size. Try increasing the context size or enable Context Shift.", PRINT_COLORS["error"], "")
-                                        case _:
-                                            new_print("An error occurred.", PRINT_COLORS["error"], "")
-                                    print(" This message won't be added to the context.", end="")
-                                    text_model_message_history.pop()
-                                    break
-                                elif decoded_line.startswith("{\"error\":"):
-                                    match json.loads(decoded_line)["error"]["message"]:
-                                        case "Failed to load image or audio file":
-                                            new_print("This file is not encodable.", PRINT_COLORS["error"], "")
-                                        case _:
-                                            new_print("An error occurred.", PRINT_COLORS["error"], "")
-                                    print(" This message won't be added to the context.", end="")
-                                    text_model_message_history.pop()
-                                    break
-                            if model_message_buffer != "":
-                                append_message(TEXT_MODEL_CHAT_ROLES[2], process_text(model_message_buffer, script_settings["text_model_gen_settings"]["chat_include_thoughts_in_history"]))
-                            print("\n")
-                    except requests.exceptions.ConnectionError:
-                        new_print("Text model server was closed", PRINT_COLORS["error"])
-                        break
-                    except requests.exceptions.ChunkedEncodingError:
-                        new_print("\nText model server was closed", PRINT_COLORS["error"])
-                        break
-                else:
-                    new_print("Cannot send empty messages", PRINT_COLORS["error"])
-        elif script_settings["script_mode"] == SCRIPT_MODES[1]: # Autocomplete Mode
-            prompt: str = input(f"{PRINT_COLORS["user_prefix"]}> {colorama.Style.RESET_ALL}")
-            try:
-                payload: dict = {
-                    "model": text_model_id,
-                    "prompt": prompt,
-                    "stream": script_settings["text_model_gen_settings"]["stream_responses"],
-                    "n_predict": script_settings["text_model_gen_settings"]["autocomplete_max_tokens"],
-                }
-                for key, value in construct_text_model_gen_parameters().items():
-                    payload[key] = value
-
-                text_response: requests.Response = requests.post(f"{text_model_server_url}/completion", json=payload, stream=script_settings["text_model_gen_settings"]["stream_responses"])
-                if not script_settings["text_model_gen_settings"]["stream_responses"]:
-                    text_response_data: dict = text_response.json()
-                    if "error" not in text_response_data:
-                        new_print(f"{prompt}{text_response_data["content"]}\n", PRINT_COLORS["model_prefix"])
-                    else:
-                        match text_response_data["error"]["message"]:
-                            case "the request exceeds the available context size. try increasing the context size or enable context shift":
-                                new_print("Your prompt exceeds the available context size. Try increasing the context size or enable Context Shift.\n", PRINT_COLORS["error"])
-                            case _:
-                                new_print("An error occurred.\n", PRINT_COLORS["error"])
-                else:
-                    was_prompt_printed: bool = False
-                    for line in text_response.iter_lines():
-                        decoded_line: str = line.decode("utf-8")
-                        if decoded_line.startswith("data: "):
-                            if not was_prompt_printed:
-                                was_prompt_printed = True
-                                print(f"{PRINT_COLORS["model_prefix"]}{prompt}", end="")
-                            print(json.loads(line[len("data: "):])["content"], end="", flush=True)
-                        elif decoded_line.startswith("error: "):
-                            match json.loads(line[len("error: "):])["message"]:
-                                case "the request exceeds the available context size. try increasing the context size or enable context shift":
-                                    new_print("Your prompt exceeds the available context size. Try increasing the context size or enable Context Shift.", PRINT_COLORS["error"], "")
-                                case _:
-                                    new_print("An error occurred.", PRINT_COLORS["error"], "")
-                            break
-                    print("\n")
-            except requests.exceptions.ConnectionError:
-                print("Text model server was closed")
-                break
-            except requests.exceptions.ChunkedEncodingError:
-                print("\nText model server was closed")
-                break
\ No newline at end of file
+    # The supervised servers are stopped however the script ends.
+    try:
+        if script_settings["script_mode"] == SCRIPT_MODES[2]: # Batch Mode
+            asyncio.run(run_batch_mode())
+        elif script_settings["script_mode"] == SCRIPT_MODES[3]: # Bench Mode
+            asyncio.run(run_bench_mode())
+        else:
+            asyncio.run(run_main_loop())
+    except KeyboardInterrupt:
+        print()
+    finally:
+        stop_managed_servers()
+        close_http_sessions()
+        if response_cache_connection is not None:
+            response_cache_connection.close()
\ No newline at end of file
@@ -0,0 +1,98 @@
+import argparse
+import threading
+import requests
+import typing
+import time
+import json
+import sys
+import ast
+import io
+
+if __name__ == "__main__":
+    APP_SCRIPT_PATH: str = "app.py"
+    # Loaded from app.py so that the benchmark measures the current code.
+    APP_DEFINITION_NAMES: set[str] = {
+        "SSE_DATA_PREFIX",
+        "SSE_ERROR_PREFIX",
+        "SSE_ERROR_OBJECT_PREFIX",
+        "SSE_DONE_PAYLOAD",
+        "SSE_EVENT_TYPES",
+        "StreamPrinter",
+        "parse_sse_line",
+        "iter_sse_events",
+    }
+    BENCH_DELTA_CONTENT: str = "tokén " # The multi-byte character makes chunk boundaries split UTF-8 sequences.
+
+    argument_parser: argparse.ArgumentParser = argparse.ArgumentParser(description="Compares the old iter_lines() streaming loop with iter_sse_events() and StreamPrinter on synthetic chat deltas. "
+                                                                       "The streamed text goes to stdout and the results to stderr, so pipe stdout or let it go to the console; with stdout "
+                                                                       "redirected to a file or NUL most of the difference, which comes from the per-token flushes, goes away.")
+    argument_parser.add_argument("--deltas", type=int, default=20000, help="number of streamed chat deltas")
+    argument_parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[97, 1024], help="sizes of the byte chunks the response arrives in")
+    argument_parser.add_argument("--flush-interval-ms", type=int, default=33, help="like text_model_gen_settings.stream_flush_interval_ms")
+    argument_parser.add_argument("--flush-size", type=int, default=256, help="like text_model_gen_settings.stream_flush_size")
+    arguments: argparse.Namespace = argument_parser.parse_args()
+
+    app_namespace: dict = {
+        "threading": threading,
+        "requests": requests,
+        "typing": typing,
+        "json": json,
+        "sys": sys,
+        "RequestTelemetry": typing.Any, # Only used in annotations.
+    }
+    with open(APP_SCRIPT_PATH, "r", encoding="utf-8") as app_script_file:
+        app_module: ast.Module = ast.parse(app_script_file.read())
+    for app_node in ast.walk(app_module):
+        if isinstance(app_node, (ast.ClassDef, ast.FunctionDef)) and app_node.name in APP_DEFINITION_NAMES or isinstance(app_node, ast.AnnAssign) and isinstance(app_node.target, ast.Name) and app_node.target.id in APP_DEFINITION_NAMES:
+            exec(compile(ast.Module(body=[app_node], type_ignores=[]), APP_SCRIPT_PATH, "exec"), app_namespace)
+
+    response_body: bytes = b"".join(b"data: " + json.dumps({"choices": [{"delta": {"content": BENCH_DELTA_CONTENT}}]}).encode() + b"\n\n" for _ in range(arguments.deltas)) + b"data: [DONE]\n\n"
+
+    # Delivers the body in chunks of a fixed size.
+    class BenchResponse:
+        def __init__(self, chunk_size: int) -> None:
+            self.chunk_size: int = chunk_size
+
+        def iter_content(self, chunk_size: int | None=None) -> typing.Iterator[bytes]:
+            for chunk_start in range(0, len(response_body), self.chunk_size):
+                yield response_body[chunk_start:chunk_start + self.chunk_size]
+
+        def iter_lines(self) -> typing.Iterator[bytes]:
+            response: requests.Response = requests.Response()
+            response.raw = io.BufferedReader(io.BytesIO(response_body), self.chunk_size)
+            return response.iter_lines(self.chunk_size)
+
+    # The chat loop before iter_sse_events().
+    def run_old_loop(response: BenchResponse) -> str:
+        model_message_buffer: str = ""
+        for line in response.iter_lines():
+            decoded_line: str = line.decode("utf-8")
+            if decoded_line.startswith("data: ") and not decoded_line.endswith("[DONE]"):
+                chunk: str | None = json.loads(line[len("data: "):])["choices"][0]["delta"].get("content", "")
+                if chunk is not None:
+                    model_message_buffer += chunk
+                    print(chunk, end="", flush=True)
+        return model_message_buffer
+
+    def run_new_loop(response: BenchResponse) -> str:
+        model_message_chunks: list[str] = []
+        stream_printer = app_namespace["StreamPrinter"](arguments.flush_interval_ms / 1000.0, arguments.flush_size)
+        for event_type, event_data in app_namespace["iter_sse_events"](response):
+            if event_type == app_namespace["SSE_EVENT_TYPES"][0] and len(event_data.get("choices", [])) > 0:
+                chunk: str | None = event_data["choices"][0]["delta"].get("content", "")
+                if chunk is not None:
+                    model_message_chunks.append(chunk)
+                    stream_printer.write(chunk)
+        stream_printer.close()
+        return "".join(model_message_chunks)
+
+    expected_text: str = BENCH_DELTA_CONTENT * arguments.deltas
+    for chunk_size in arguments.chunk_sizes:
+        for loop_name, run_loop in (("old iter_lines loop", run_old_loop), ("new parser + printer", run_new_loop)):
+            loop_start_time: float = time.perf_counter()
+            streamed_text: str = run_loop(BenchResponse(chunk_size))
+            loop_time: float = time.perf_counter() - loop_start_time
+            if streamed_text != expected_text:
+                sys.stderr.write(f"{loop_name} (chunk size {chunk_size}): the streamed text doesn't match\n")
+                sys.exit(1)
+            sys.stderr.write(f"{loop_name} (chunk size {chunk_size}): {"{:,.0f}".format(arguments.deltas / loop_time)} tok/s\n")
\ No newline at end of file
@@ -0,0 +1,306 @@
+import os
+import subprocess
+import struct
+import json
+
+if __name__ == "__main__":
+    SCRIPT_SETTINGS_PATH: str = "settings.json"
+    TEXT_MODEL_BENCHMARK_FILENAME: str = "llama-bench.exe"
+    TEXT_MODEL_EXTENSION: str = ".gguf"
+    GGUF_MAGIC: bytes = b"GGUF"
+    GGUF_DEFAULT_ALIGNMENT: int = 32
+    # GGUF value type IDs; strings and arrays are handled separately.
+    GGUF_VALUE_FORMATS: dict[int, str] = {
+        0: "<B",
+        1: "<b",
+        2: "<H",
+        3: "<h",
+        4: "<I",
+        5: "<i",
+        6: "<f",
+        7: "<?",
+        10: "<Q",
+        11: "<q",
+        12: "<d",
+    }
+    GGUF_STRING_TYPE: int = 8
+    GGUF_ARRAY_TYPE: int = 9
+    # Bytes per element; quantized types store blocks of 32 elements.
+    TEXT_MODEL_CACHE_TYPE_SIZES: dict[str, float] = {
+        "f32": 4.0,
+        "f16": 2.0,
+        "bf16": 2.0,
+        "q8_0": 34.0 / 32.0,
+        "q4_0": 18.0 / 32.0,
+        "q4_1": 20.0 / 32.0,
+        "iq4_nl": 18.0 / 32.0,
+        "q5_0": 22.0 / 32.0,
+        "q5_1": 24.0 / 32.0,
+    }
+    # Quantized V caches require flash attention.
+    TEXT_MODEL_CACHE_TYPE_PREFERENCE: list[str] = [
+        "f16",
+        "q8_0",
+        "q4_0",
+    ]
+    TEXT_MODEL_PHYSICAL_BATCH_SIZES: list[int] = [
+        2048,
+        1024,
+        512,
+        256,
+    ]
+    TEXT_MODEL_MIN_CONTEXT_SIZE: int = 2048
+    MEMORY_RESERVE_MB: int = 512
+    BENCHMARK_PROMPT_TOKENS: int = 512
+    BENCHMARK_GENERATED_TOKENS: int = 64
+    BENCHMARK_MAX_ATTEMPTS: int = 3
+
+    def read_gguf_value(_file, value_type: int) -> object:
+        if value_type == GGUF_STRING_TYPE:
+            string_length: int = struct.unpack("<Q", _file.read(8))[0]
+            return _file.read(string_length).decode("utf-8", errors="replace")
+        if value_type == GGUF_ARRAY_TYPE:
+            item_type: int = struct.unpack("<I", _file.read(4))[0]
+            item_count: int = struct.unpack("<Q", _file.read(8))[0]
+            # Only the length of large arrays is needed.
+            if item_type in GGUF_VALUE_FORMATS:
+                item_size: int = struct.calcsize(GGUF_VALUE_FORMATS[item_type])
+                if item_count > 64:
+                    _file.seek(item_size * item_count, os.SEEK_CUR)
+                    return item_count
+                return [struct.unpack(GGUF_VALUE_FORMATS[item_type], _file.read(item_size))[0] for _ in range(item_count)]
+            for _ in range(item_count):
+                read_gguf_value(_file, item_type)
+            return item_count
+        value_format: str = GGUF_VALUE_FORMATS[value_type]
+        return struct.unpack(value_format, _file.read(struct.calcsize(value_format)))[0]
+
+    # Tensor sizes come from the data offsets, so no quantization block sizes are needed.
+    def read_gguf_header(path: str) -> tuple[dict, dict[str, int]]:
+        with open(path, "rb") as _file:
+            if _file.read(4) != GGUF_MAGIC:
+                raise ValueError("Not a GGUF file")
+            version: int = struct.unpack("<I", _file.read(4))[0]
+            if version < 2:
+                raise ValueError(f"GGUF version {version} is not supported")
+            tensor_count, kv_count = struct.unpack("<QQ", _file.read(16))
+
+            metadata: dict = {}
+            for _ in range(kv_count):
+                key: str = read_gguf_value(_file, GGUF_STRING_TYPE)
+                value_type: int = struct.unpack("<I", _file.read(4))[0]
+                metadata[key] = read_gguf_value(_file, value_type)
+
+            tensor_offsets: list[tuple[int, str]] = []
+            for _ in range(tensor_count):
+                tensor_name: str = read_gguf_value(_file, GGUF_STRING_TYPE)
+                dimension_count: int = struct.unpack("<I", _file.read(4))[0]
+                _file.seek(8 * dimension_count + 4, os.SEEK_CUR)
+                tensor_offsets.append((struct.unpack("<Q", _file.read(8))[0], tensor_name))
+
+            alignment: int = metadata.get("general.alignment", GGUF_DEFAULT_ALIGNMENT)
+            data_start: int = (_file.tell() + alignment - 1) // alignment * alignment
+        data_size: int = os.path.getsize(path) - data_start
+
+        tensor_offsets.sort()
+        tensor_sizes: dict[str, int] = {}
+        for index, (tensor_offset, tensor_name) in enumerate(tensor_offsets):
+            next_tensor_offset: int = tensor_offsets[index + 1][0] if index + 1 < len(tensor_offsets) else data_size
+            tensor_sizes[tensor_name] = next_tensor_offset - tensor_offset
+        return metadata, tensor_sizes
+
+    def get_model_parameters(metadata: dict, tensor_sizes: dict[str, int]) -> dict:
+        architecture: str = metadata["general.architecture"]
+        layer_count: int = metadata[f"{architecture}.block_count"]
+        embedding_size: int = metadata[f"{architecture}.embedding_length"]
+        head_count: int = metadata[f"{architecture}.attention.head_count"]
+        kv_head_counts: int | list[int] = metadata.get(f"{architecture}.attention.head_count_kv", head_count)
+        # Some architectures store the number of KV heads per layer.
+        kv_head_count: float = sum(kv_head_counts) / len(kv_head_counts) if isinstance(kv_head_counts, list) else kv_head_counts
+        if isinstance(head_count, list):
+            head_count = max(head_count)
+        key_size: int = metadata.get(f"{architecture}.attention.key_length", embedding_size // head_count)
+        value_size: int = metadata.get(f"{architecture}.attention.value_length", key_size)
+        vocabulary_size: int = metadata.get(f"{architecture}.vocab_size", metadata.get("tokenizer.ggml.tokens", 32000))
+
+        layer_weight_size: int = 0
+        for tensor_name, tensor_size in tensor_sizes.items():
+            if tensor_name.startswith("blk."):
+                layer_weight_size += tensor_size
+        return {
+            "architecture": architecture,
+            "layer_count": layer_count,
+            "embedding_size": embedding_size,
+            "head_count": head_count,
+            "kv_head_count": kv_head_count,
+            "key_size": key_size,
+            "value_size": value_size,
+            "vocabulary_size": vocabulary_size,
+            "trained_context_size": metadata.get(f"{architecture}.context_length", 4096),
+            "layer_weight_size": layer_weight_size // layer_count,
+            "shared_weight_size": sum(tensor_sizes.values()) - layer_weight_size,
+        }
+
+    def estimate_layer_kv_cache_size(model_parameters: dict, context_size: int, cache_type_k: str, cache_type_v: str) -> float:
+        kv_elements_per_token: float = model_parameters["kv_head_count"] * (model_parameters["key_size"] * TEXT_MODEL_CACHE_TYPE_SIZES[cache_type_k] + model_parameters["value_size"] * TEXT_MODEL_CACHE_TYPE_SIZES[cache_type_v])
+        return context_size * kv_elements_per_token
+
+    # Rough size of llama.cpp's compute buffer.
+    def estimate_compute_buffer_size(model_parameters: dict, context_size: int, physical_batch_size: int, use_flash_attention: bool) -> float:
+        compute_buffer_size: float = physical_batch_size * (model_parameters["vocabulary_size"] + 8 * model_parameters["embedding_size"]) * 4.0
+        if not use_flash_attention:
+            compute_buffer_size += physical_batch_size * context_size * model_parameters["head_count"] * 4.0
+        return compute_buffer_size
+
+    # A layer's KV cache lives on the same device as the layer.
+    def get_gpu_layer_count(model_parameters: dict, memory_budget: float, extra_weight_size: int, context_size: int, cache_type: str, physical_batch_size: int, use_flash_attention: bool) -> int:
+        available_memory: float = memory_budget - extra_weight_size - model_parameters["shared_weight_size"] - estimate_compute_buffer_size(model_parameters, context_size, physical_batch_size, use_flash_attention)
+        layer_size: float = model_parameters["layer_weight_size"] + estimate_layer_kv_cache_size(model_parameters, context_size, cache_type, cache_type)
+        return max(min(int(available_memory // layer_size), model_parameters["layer_count"]), 0)
+
+    # Full offload first, then context size, cache precision and physical batch size.
+    def choose_init_settings(model_parameters: dict, memory_budget: float, extra_weight_size: int, target_context_size: int, use_flash_attention: bool) -> dict:
+        cache_types: list[str] = TEXT_MODEL_CACHE_TYPE_PREFERENCE if use_flash_attention else TEXT_MODEL_CACHE_TYPE_PREFERENCE[:1]
+        context_size: int = target_context_size
+        while context_size >= TEXT_MODEL_MIN_CONTEXT_SIZE:
+            for cache_type in cache_types:
+                for physical_batch_size in TEXT_MODEL_PHYSICAL_BATCH_SIZES:
+                    if get_gpu_layer_count(model_parameters, memory_budget, extra_weight_size, context_size, cache_type, physical_batch_size, use_flash_attention) == model_parameters["layer_count"]:
+                        return {
+                            "gpu_layers": 99,
+                            "context_size": context_size,
+                            "cache_type_k": cache_type,
+                            "cache_type_v": cache_type,
+                            "logical_max_batch_size": max(physical_batch_size, 2048),
+                            "physical_max_batch_size": physical_batch_size,
+                        }
+            context_size //= 2
+
+        # The model doesn't fit; offload as many layers as possible.
+        return {
+            "gpu_layers": get_gpu_layer_count(model_parameters, memory_budget, extra_weight_size, target_context_size, cache_types[-1], TEXT_MODEL_PHYSICAL_BATCH_SIZES[-2], use_flash_attention),
+            "context_size": target_context_size,
+            "cache_type_k": cache_types[-1],
+            "cache_type_v": cache_types[-1],
+            "logical_max_batch_size": 2048,
+            "physical_max_batch_size": TEXT_MODEL_PHYSICAL_BATCH_SIZES[-2],
+        }
+
+    def get_free_gpu_memory_mb() -> int | None:
+        try:
+            nvidia_smi_output: str = subprocess.run(["nvidia-smi", "--query-gpu=memory.free", "--format=csv,noheader,nounits"], capture_output=True, text=True, timeout=10).stdout
+            return sum(int(line) for line in nvidia_smi_output.split())
+        except (FileNotFoundError, subprocess.TimeoutExpired, ValueError):
+            return None
+
+    # Returns None if llama-bench failed, e.g. out of memory.
+    def run_benchmark(llama_bench_path: str, model_path: str, init_settings: dict, use_flash_attention: bool) -> tuple[float, float] | None:
+        benchmark_process: subprocess.CompletedProcess = subprocess.run([
+            llama_bench_path,
+            "--model", model_path,
+            "--n-gpu-layers", str(init_settings["gpu_layers"]),
+            "--cache-type-k", init_settings["cache_type_k"],
+            "--cache-type-v", init_settings["cache_type_v"],
+            "--batch-size", str(init_settings["logical_max_batch_size"]),
+            "--ubatch-size", str(init_settings["physical_max_batch_size"]),
+            "--flash-attn", "1" if use_flash_attention else "0",
+            "--n-prompt", str(BENCHMARK_PROMPT_TOKENS),
+            "--n-gen", str(BENCHMARK_GENERATED_TOKENS),
+            "--repetitions", "1",
+            "--output", "json",
+        ], capture_output=True, text=True)
+        if benchmark_process.returncode != 0:
+            return None
+        prompt_speed: float = 0.0
+        generation_speed: float = 0.0
+        try:
+            for benchmark_result in json.loads(benchmark_process.stdout):
+                if benchmark_result["n_gen"] == 0:
+                    prompt_speed = benchmark_result["avg_ts"]
+                else:
+                    generation_speed = benchmark_result["avg_ts"]
+        except (json.JSONDecodeError, KeyError, TypeError):
+            return None
+        return prompt_speed, generation_speed
+
+    try:
+        with open(SCRIPT_SETTINGS_PATH, "rt") as file:
+            script_settings: dict = json.load(file)
+            if "text_model_init_settings" not in script_settings:
+                print("Malformed settings file")
+                exit()
+
+        text_model_path: str = script_settings["text_model_init_settings"].get("model_path", "")
+        while not os.path.exists(text_model_path) or os.path.splitext(text_model_path)[1].lower() != TEXT_MODEL_EXTENSION:
+            if text_model_path != "":
+                print("File does not exist or is not a text model")
+            text_model_path = input("Enter a text model path: ").strip().removeprefix("\"").removesuffix("\"")
+
+        model_parameters: dict = get_model_parameters(*read_gguf_header(text_model_path))
+        print(f"\nArchitecture: {model_parameters["architecture"]}, {model_parameters["layer_count"]} layers, embedding size {model_parameters["embedding_size"]}, {model_parameters["head_count"]} heads ({"{:g}".format(model_parameters["kv_head_count"])} KV heads), trained context {model_parameters["trained_context_size"]}")
+        print(f"Weights: {"{:.2f}".format((model_parameters["layer_weight_size"] * model_parameters["layer_count"] + model_parameters["shared_weight_size"]) / 1024 ** 3)} GiB")
+
+        # The projector and the draft model count against the budget too.
+        extra_weight_size: int = 0
+        text_model_mmproj_path: str = f"{text_model_path.removesuffix(TEXT_MODEL_EXTENSION)}-mmproj{TEXT_MODEL_EXTENSION}"
+        if os.path.exists(text_model_mmproj_path) and not script_settings["text_model_init_settings"].get("disable_mmproj", False) and script_settings["text_model_init_settings"].get("use_gpu_for_mmproj", True):
+            extra_weight_size += os.path.getsize(text_model_mmproj_path)
+        text_model_draft_path: str = f"{text_model_path.removesuffix(TEXT_MODEL_EXTENSION)}-draft{TEXT_MODEL_EXTENSION}"
+        if os.path.exists(text_model_draft_path) and not script_settings["text_model_init_settings"].get("disable_draft_model", False):
+            extra_weight_size += os.path.getsize(text_model_draft_path)
+
+        target_context_size: int = min(script_settings["text_model_init_settings"].get("context_size", 8192), model_parameters["trained_context_size"])
+        print(f"\nKV cache at {target_context_size} tokens:")
+        for cache_type, cache_type_size in TEXT_MODEL_CACHE_TYPE_SIZES.items():
+            print(f"  {cache_type}: {"{:.2f}".format(estimate_layer_kv_cache_size(model_parameters, target_context_size, cache_type, cache_type) * model_parameters["layer_count"] / 1024 ** 3)} GiB")
+
+        free_gpu_memory_mb: int | None = get_free_gpu_memory_mb()
+        memory_budget_mb: float = 0.0
+        while memory_budget_mb <= 0.0:
+            memory_budget_string: str = input(f"\nEnter the VRAM budget in MB{f" (detected {free_gpu_memory_mb} MB free)" if free_gpu_memory_mb is not None else ""}: ").strip()
+            if memory_budget_string == "" and free_gpu_memory_mb is not None:
+                memory_budget_string = str(free_gpu_memory_mb)
+            try:
+                memory_budget_mb = float(memory_budget_string)
+            except ValueError:
+                memory_budget_mb = 0.0
+            if not memory_budget_mb > 0.0:
+                memory_budget_mb = 0.0
+                print("VRAM budget must be a positive number")
+        memory_budget: float = (memory_budget_mb - MEMORY_RESERVE_MB) * 1024 ** 2
+
+        use_flash_attention: bool = script_settings["text_model_init_settings"].get("use_flash_attention", True)
+        init_settings: dict = choose_init_settings(model_parameters, memory_budget, extra_weight_size, target_context_size, use_flash_attention)
+
+        llama_bench_path: str = f"{script_settings["text_model_init_settings"].get("server_dir_path", "")}{TEXT_MODEL_BENCHMARK_FILENAME}"
+        if os.path.exists(llama_bench_path) and input(f"\nConfirm with a short {TEXT_MODEL_BENCHMARK_FILENAME} run? (y/n): ").strip().lower() == "y":
+            for attempt_index in range(BENCHMARK_MAX_ATTEMPTS):
+                benchmark_result: tuple[float, float] | None = run_benchmark(llama_bench_path, text_model_path, init_settings, use_flash_attention)
+                if benchmark_result is not None:
+                    print(f"Prompt processing: {"{:.1f}".format(benchmark_result[0])} t/s, generation: {"{:.1f}".format(benchmark_result[1])} t/s")
+                    break
+                # Offload fewer layers and try again.
+                gpu_layer_count: int = init_settings["gpu_layers"] if init_settings["gpu_layers"] != 99 else model_parameters["layer_count"]
+                init_settings["gpu_layers"] = max(gpu_layer_count - max(model_parameters["layer_count"] // 10, 1), 0)
+                if attempt_index < BENCHMARK_MAX_ATTEMPTS - 1:
+                    print(f"{TEXT_MODEL_BENCHMARK_FILENAME} failed, retrying with {init_settings["gpu_layers"]} GPU layers")
+            else:
+                print(f"{TEXT_MODEL_BENCHMARK_FILENAME} failed {BENCHMARK_MAX_ATTEMPTS} times; the settings below ({init_settings["gpu_layers"]} GPU layers) are unverified estimates")
+
+        print()
+        for key, value in init_settings.items():
+            print(f"{key}: {script_settings["text_model_init_settings"].get(key)} -> {value}")
+        if input("\nApply these text_model_init_settings? (y/n): ").strip().lower() == "y":
+            for key, value in init_settings.items():
+                script_settings["text_model_init_settings"][key] = value
+            script_settings["text_model_init_settings"]["model_path"] = text_model_path
+            with open(SCRIPT_SETTINGS_PATH, "wt") as file:
+                json.dump(script_settings, file, indent=4)
+    except FileNotFoundError:
+        print("Settings file not found")
+    except UnicodeDecodeError:
+        print("Settings file is unreadable")
+    except json.JSONDecodeError:
+        print("Malformed settings file")
+    except (ValueError, KeyError, struct.error) as error:
+        print(f"Model file is unreadable ({error})")
\ No newline at end of file
@@ -0,0 +1,383 @@
+import http.server
+import argparse
+import threading
+import random
+import struct
+import base64
+import time
+import zlib
+import json
+import re
+
+if __name__ == "__main__":
+    SCRIPT_SETTINGS_PATH: str = "settings.json"
+    MOCK_TEXT_MODEL_ID: str = "mock-text-model.gguf"
+    MOCK_IMAGE_MODEL_ID: str = "mock-image-model"
+    MOCK_VOCABULARY: list[str] = "the a of and to in is it that was for on are with as be at by this from or have an which one had not but what all were when we there can your more if out so said up about into them some could time no than first other now only its over also new after did way like our even most made".split()
+    MOCK_TOKEN_PATTERN: re.Pattern = re.compile(r"\w+|[^\w\s]")
+    MOCK_VOCABULARY_SIZE: int = 32000
+    MOCK_EMBEDDING_SIZE: int = 64
+    MOCK_DEFAULT_MAX_TOKENS: int = 64
+    # Error messages that app.py matches on.
+    MOCK_CONTEXT_SIZE_ERROR_MESSAGE: str = "the request exceeds the available context size. try increasing the context size or enable context shift"
+    MOCK_INJECTED_ERROR_MESSAGE: str = "Injected error"
+    IMAGE_REFERENCE_PIXEL_COUNT: int = 512 * 512
+
+    argument_parser: argparse.ArgumentParser = argparse.ArgumentParser(description="Deterministic stand-ins for llama-server and KoboldCpp. Nothing is loaded and no GPU is needed.")
+    argument_parser.add_argument("--text-port", type=int, default=None, help="defaults to text_model_init_settings.server_port or 7820")
+    argument_parser.add_argument("--image-port", type=int, default=None, help="defaults to image_model_init_settings.server_port or 7821, 0 disables it")
+    argument_parser.add_argument("--tokens-per-second", type=float, default=50.0, help="generation speed of each slot, 0 for unlimited")
+    argument_parser.add_argument("--prompt-tokens-per-second", type=float, default=2000.0, help="prompt processing speed of each slot, 0 for unlimited")
+    argument_parser.add_argument("--latency-ms", type=float, default=0.0, help="added before every response")
+    argument_parser.add_argument("--image-step-ms", type=float, default=50.0, help="time of one sampling step at 512x512")
+    argument_parser.add_argument("--load-time", type=float, default=0.0, help="seconds during which /health answers 503")
+    argument_parser.add_argument("--parallel", type=int, default=1, help="number of slots; further requests wait for a free slot")
+    argument_parser.add_argument("--context-size", type=int, default=8192)
+    argument_parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of generation requests that fail with an HTTP 500 or an SSE error")
+    argument_parser.add_argument("--disconnect-rate", type=float, default=0.0, help="fraction of streamed responses that are cut off halfway")
+    argument_parser.add_argument("--vision", action="store_true", help="report the vision modality in /props")
+    argument_parser.add_argument("--audio", action="store_true", help="report the audio modality in /props")
+    argument_parser.add_argument("--seed", type=int, default=0, help="seed of the error injection")
+    arguments: argparse.Namespace = argument_parser.parse_args()
+
+    # Same ports as in the settings file.
+    text_model_server_port: int = 7820
+    image_model_server_port: int = 7821
+    try:
+        with open(SCRIPT_SETTINGS_PATH, "rt") as file:
+            script_settings: dict = json.load(file)
+            text_model_server_port = script_settings.get("text_model_init_settings", {}).get("server_port", text_model_server_port)
+            image_model_server_port = script_settings.get("image_model_init_settings", {}).get("server_port", image_model_server_port)
+    except (FileNotFoundError, UnicodeDecodeError, json.JSONDecodeError):
+        pass
+    if arguments.text_port is not None:
+        text_model_server_port = arguments.text_port
+    if arguments.image_port is not None:
+        image_model_server_port = arguments.image_port
+
+    server_start_time: float = time.perf_counter()
+    slot_semaphore: threading.BoundedSemaphore = threading.BoundedSemaphore(max(arguments.parallel, 1))
+    busy_slot_count: int = 0
+    busy_slot_lock: threading.Lock = threading.Lock()
+    error_random: random.Random = random.Random(arguments.seed)
+    error_random_lock: threading.Lock = threading.Lock()
+
+    def tokenize(text: str) -> list[int]:
+        return [zlib.crc32(token.encode()) % MOCK_VOCABULARY_SIZE for token in MOCK_TOKEN_PATTERN.findall(text)]
+
+    # Deterministic: the text only depends on the prompt.
+    def generate_tokens(prompt: str, max_tokens: int) -> list[str]:
+        token_random: random.Random = random.Random(zlib.crc32(prompt.encode()))
+        return [f"{token_random.choice(MOCK_VOCABULARY)} " for _ in range(max_tokens)]
+
+    # Bag-of-words vectors, enough for retrieval and near-duplicate lookups.
+    def embed(text: str) -> list[float]:
+        embedding: list[float] = [0.0] * MOCK_EMBEDDING_SIZE
+        for token in MOCK_TOKEN_PATTERN.findall(text.lower()):
+            embedding[zlib.crc32(token.encode()) % MOCK_EMBEDDING_SIZE] += 1.0
+        return embedding
+
+    def should_inject(rate: float) -> bool:
+        if rate <= 0.0:
+            return False
+        with error_random_lock:
+            return error_random.random() < rate
+
+    def get_message_text(message: dict) -> str:
+        if isinstance(message.get("content"), str):
+            return message["content"]
+        message_text: str = ""
+        for content_part in message.get("content") or []:
+            if content_part.get("type") == "text":
+                message_text += content_part["text"]
+        return message_text
+
+    def create_png(width: int, height: int, color: tuple[int, int, int]) -> bytes:
+        def create_chunk(chunk_type: bytes, chunk_data: bytes) -> bytes:
+            return struct.pack(">I", len(chunk_data)) + chunk_type + chunk_data + struct.pack(">I", zlib.crc32(chunk_type + chunk_data))
+        row: bytes = b"\x00" + bytes(color) * width
+        return b"\x89PNG\r\n\x1a\n" + create_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + create_chunk(b"IDAT", zlib.compress(row * height, 1)) + create_chunk(b"IEND", b"")
+
+    class MockServerRequestHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Small SSE chunks must not wait for Nagle's algorithm.
+        disable_nagle_algorithm = True
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+        def send_json(self, data: dict | list, status_code: int=200) -> None:
+            response_body: bytes = json.dumps(data).encode()
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response_body)))
+            self.end_headers()
+            self.wfile.write(response_body)
+
+        def send_error_json(self, status_code: int, message: str, error_type: str) -> None:
+            self.send_json({
+                "error": {
+                    "code": status_code,
+                    "message": message,
+                    "type": error_type,
+                },
+            }, status_code)
+
+        def write_chunk(self, data: bytes) -> None:
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def read_json_body(self) -> dict:
+            request_body: bytes = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            return json.loads(request_body) if request_body != b"" else {}
+
+    class MockTextModelServerRequestHandler(MockServerRequestHandler):
+        def do_GET(self) -> None:
+            if self.path == "/health":
+                if time.perf_counter() - server_start_time < arguments.load_time:
+                    self.send_error_json(503, "Loading model", "unavailable_error")
+                else:
+                    self.send_json({"status": "ok"})
+            elif self.path == "/v1/models":
+                self.send_json({
+                    "object": "list",
+                    "data": [{
+                        "id": MOCK_TEXT_MODEL_ID,
+                        "object": "model",
+                        "owned_by": "llamacpp",
+                    }],
+                })
+            elif self.path == "/props":
+                self.send_json({
+                    "default_generation_settings": {
+                        "n_ctx": arguments.context_size,
+                    },
+                    "total_slots": arguments.parallel,
+                    "model_path": MOCK_TEXT_MODEL_ID,
+                    "modalities": {
+                        "vision": arguments.vision,
+                        "audio": arguments.audio,
+                    },
+                })
+            elif self.path == "/slots":
+                with busy_slot_lock:
+                    slots: list[dict] = [{
+                        "id": slot_id,
+                        "n_ctx": arguments.context_size,
+                        "is_processing": slot_id < busy_slot_count,
+                    } for slot_id in range(arguments.parallel)]
+                self.send_json(slots)
+            else:
+                self.send_error_json(404, "File Not Found", "not_found_error")
+
+        def do_POST(self) -> None:
+            try:
+                request_data: dict = self.read_json_body()
+            except json.JSONDecodeError:
+                self.send_error_json(400, "Invalid JSON", "invalid_request_error")
+                return
+
+            if self.path == "/tokenize":
+                self.send_json({"tokens": tokenize(request_data.get("content", ""))})
+            elif self.path == "/embedding":
+                content: str | list[str] = request_data.get("content", "")
+                contents: list[str] = content if isinstance(content, list) else [content]
+                time.sleep(arguments.latency_ms / 1000.0)
+                self.send_json([{
+                    "index": index,
+                    "embedding": [embed(_content)],
+                } for index, _content in enumerate(contents)])
+            elif self.path.startswith("/slots/"):
+                self.send_json({
+                    "id_slot": int(self.path.removeprefix("/slots/").split("?")[0]),
+                    "filename": request_data.get("filename", ""),
+                    "n_saved": 0,
+                    "n_restored": 0,
+                })
+            elif self.path == "/v1/chat/completions":
+                prompt: str = "\n".join(get_message_text(message) for message in request_data.get("messages", []))
+                self.generate(request_data, prompt, request_data.get("max_tokens", request_data.get("n_predict", MOCK_DEFAULT_MAX_TOKENS)), True)
+            elif self.path == "/completion":
+                self.generate(request_data, request_data.get("prompt", ""), request_data.get("n_predict", MOCK_DEFAULT_MAX_TOKENS), False)
+            else:
+                self.send_error_json(404, "File Not Found", "not_found_error")
+
+        def generate(self, request_data: dict, prompt: str, max_tokens: int, is_chat: bool) -> None:
+            global busy_slot_count
+            prompt_token_count: int = len(tokenize(prompt))
+            if max_tokens < 0:
+                max_tokens = MOCK_DEFAULT_MAX_TOKENS
+            if prompt_token_count + max_tokens > arguments.context_size:
+                self.send_error_json(400, MOCK_CONTEXT_SIZE_ERROR_MESSAGE, "exceed_context_size_error")
+                return
+            is_stream: bool = request_data.get("stream", False)
+            if should_inject(arguments.error_rate) and not is_stream:
+                self.send_error_json(500, MOCK_INJECTED_ERROR_MESSAGE, "server_error")
+                return
+
+            with slot_semaphore:
+                with busy_slot_lock:
+                    busy_slot_count += 1
+                try:
+                    time.sleep(arguments.latency_ms / 1000.0)
+                    prompt_start_time: float = time.perf_counter()
+                    if arguments.prompt_tokens_per_second > 0.0:
+                        time.sleep(prompt_token_count / arguments.prompt_tokens_per_second)
+                    prompt_time: float = time.perf_counter() - prompt_start_time
+                    tokens: list[str] = generate_tokens(prompt, max_tokens)
+                    generation_start_time: float = time.perf_counter()
+                    if not is_stream:
+                        if arguments.tokens_per_second > 0.0:
+                            time.sleep(len(tokens) / arguments.tokens_per_second)
+                        response_text: str = "".join(tokens)
+                        timings: dict = self.get_timings(prompt_token_count, prompt_time, len(tokens), time.perf_counter() - generation_start_time)
+                        if is_chat:
+                            self.send_json({
+                                "id": "chatcmpl-mock",
+                                "object": "chat.completion",
+                                "model": MOCK_TEXT_MODEL_ID,
+                                "choices": [{
+                                    "index": 0,
+                                    "finish_reason": "length",
+                                    "message": {
+                                        "role": "assistant",
+                                        "content": response_text,
+                                    },
+                                }],
+                                "usage": {
+                                    "prompt_tokens": prompt_token_count,
+                                    "completion_tokens": len(tokens),
+                                    "total_tokens": prompt_token_count + len(tokens),
+                                },
+                                "timings": timings,
+                            })
+                        else:
+                            self.send_json({
+                                "content": response_text,
+                                "stop": True,
+                                "tokens_predicted": len(tokens),
+                                "tokens_evaluated": prompt_token_count,
+                                "timings": timings,
+                            })
+                        return
+
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    # Injected failures happen halfway through the response.
+                    failure_index: int = len(tokens) // 2 if should_inject(arguments.error_rate) else -1
+                    disconnect_index: int = len(tokens) // 2 if should_inject(arguments.disconnect_rate) else -1
+                    for index, token in enumerate(tokens):
+                        if index == disconnect_index:
+                            self.close_connection = True
+                            return
+                        if index == failure_index:
+                            self.write_chunk(f"error: {json.dumps({"code": 500, "message": MOCK_INJECTED_ERROR_MESSAGE, "type": "server_error"})}\n\n".encode())
+                            self.write_chunk(b"")
+                            return
+                        if is_chat:
+                            event_data: dict = {
+                                "object": "chat.completion.chunk",
+                                "model": MOCK_TEXT_MODEL_ID,
+                                "choices": [{
+                                    "index": 0,
+                                    "finish_reason": None,
+                                    "delta": {"content": token},
+                                }],
+                            }
+                        else:
+                            event_data: dict = {
+                                "content": token,
+                                "stop": False,
+                            }
+                        self.write_chunk(f"data: {json.dumps(event_data)}\n\n".encode())
+                        if arguments.tokens_per_second > 0.0:
+                            time.sleep(1.0 / arguments.tokens_per_second)
+
+                    timings: dict = self.get_timings(prompt_token_count, prompt_time, len(tokens), time.perf_counter() - generation_start_time)
+                    if is_chat:
+                        self.write_chunk(f"data: {json.dumps({"object": "chat.completion.chunk", "model": MOCK_TEXT_MODEL_ID, "choices": [{"index": 0, "finish_reason": "length", "delta": {}}], "timings": timings})}\n\n".encode())
+                        self.write_chunk(b"data: [DONE]\n\n")
+                    else:
+                        self.write_chunk(f"data: {json.dumps({"content": "", "stop": True, "timings": timings})}\n\n".encode())
+                    self.write_chunk(b"")
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+                finally:
+                    with busy_slot_lock:
+                        busy_slot_count -= 1
+
+        def get_timings(self, prompt_token_count: int, prompt_time: float, predicted_token_count: int, generation_time: float) -> dict:
+            return {
+                "cache_n": 0,
+                "prompt_n": prompt_token_count,
+                "prompt_ms": prompt_time * 1000.0,
+                "prompt_per_second": prompt_token_count / prompt_time if prompt_time > 0.0 else 0.0,
+                "predicted_n": predicted_token_count,
+                "predicted_ms": generation_time * 1000.0,
+                "predicted_per_second": predicted_token_count / generation_time if generation_time > 0.0 else 0.0,
+            }
+
+    class MockImageModelServerRequestHandler(MockServerRequestHandler):
+        def do_GET(self) -> None:
+            if self.path == "/sdapi/v1/sd-models":
+                self.send_json([{
+                    "title": MOCK_IMAGE_MODEL_ID,
+                    "model_name": MOCK_IMAGE_MODEL_ID,
+                    "filename": MOCK_IMAGE_MODEL_ID,
+                }])
+            else:
+                self.send_error_json(404, "File Not Found", "not_found_error")
+
+        def do_POST(self) -> None:
+            if self.path != "/sdapi/v1/txt2img":
+                self.send_error_json(404, "File Not Found", "not_found_error")
+                return
+            try:
+                request_data: dict = self.read_json_body()
+            except json.JSONDecodeError:
+                self.send_error_json(400, "Invalid JSON", "invalid_request_error")
+                return
+            if should_inject(arguments.error_rate):
+                self.send_error_json(500, MOCK_INJECTED_ERROR_MESSAGE, "server_error")
+                return
+
+            width: int = max(int(request_data.get("width", 512)), 1)
+            height: int = max(int(request_data.get("height", 512)), 1)
+            steps: int = max(int(request_data.get("steps", 20)), 1)
+            image_count: int = max(int(request_data.get("batch_size", 1)), 1) * max(int(request_data.get("n_iter", 1)), 1)
+            # A random seed is derived from the prompt instead.
+            seed: int = int(request_data.get("seed", -1))
+            if seed == -1:
+                seed = zlib.crc32(request_data.get("prompt", "").encode())
+            time.sleep(arguments.latency_ms / 1000.0 + arguments.image_step_ms / 1000.0 * steps * image_count * width * height / IMAGE_REFERENCE_PIXEL_COUNT)
+
+            # Every image is a single color derived from the prompt and its seed.
+            images: list[str] = []
+            for index in range(image_count):
+                color_seed: int = zlib.crc32(f"{request_data.get("prompt", "")}{seed + index}".encode())
+                images.append(base64.b64encode(create_png(width, height, (color_seed & 255, color_seed >> 8 & 255, color_seed >> 16 & 255))).decode())
+            self.send_json({
+                "images": images,
+                "parameters": request_data,
+                "info": json.dumps({
+                    "seed": seed,
+                    "all_seeds": [seed + index for index in range(image_count)],
+                }),
+            })
+
+    text_model_server: http.server.ThreadingHTTPServer = http.server.ThreadingHTTPServer(("127.0.0.1", text_model_server_port), MockTextModelServerRequestHandler)
+    threading.Thread(target=text_model_server.serve_forever, daemon=True).start()
+    # Same wording as llama-server and KoboldCpp for the startup log detection.
+    print(f"main: server is listening on http://127.0.0.1:{text_model_server_port} - starting the main loop", flush=True)
+    if image_model_server_port != 0:
+        image_model_server: http.server.ThreadingHTTPServer = http.server.ThreadingHTTPServer(("127.0.0.1", image_model_server_port), MockImageModelServerRequestHandler)
+        threading.Thread(target=image_model_server.serve_forever, daemon=True).start()
+        print(f"Starting Kobold API on port {image_model_server_port}", flush=True)
+
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
\ No newline at end of file
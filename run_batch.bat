@@ -0,0 +1 @@
+python app.py batch
\ No newline at end of file
@@ -0,0 +1 @@
+python app.py bench
\ No newline at end of file
@@ -0,0 +1 @@
+python app_mock_servers.py
\ No newline at end of file
@@ -0,0 +1,22 @@
+import os
+import ast
+
+APP_SCRIPT_PATH: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+# Everything in app.py is under the main guard, so the tested definitions are executed from its syntax tree.
+def load_app_definitions(names: list[str], namespace: dict) -> dict:
+    with open(APP_SCRIPT_PATH, "r", encoding="utf-8") as app_script_file:
+        app_module: ast.Module = ast.parse(app_script_file.read())
+    app_nodes: dict[str, ast.stmt] = {}
+    for app_node in app_module.body:
+        if isinstance(app_node, (ast.Import, ast.ImportFrom, ast.Try)):
+            exec(compile(ast.Module(body=[app_node], type_ignores=[]), APP_SCRIPT_PATH, "exec"), namespace)
+        elif isinstance(app_node, ast.If):
+            for main_node in app_node.body:
+                if isinstance(main_node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                    app_nodes[main_node.name] = main_node
+                elif isinstance(main_node, ast.AnnAssign) and isinstance(main_node.target, ast.Name):
+                    app_nodes[main_node.target.id] = main_node
+    for name in names:
+        exec(compile(ast.Module(body=[app_nodes[name]], type_ignores=[]), APP_SCRIPT_PATH, "exec"), namespace)
+    return namespace
@@ -0,0 +1,104 @@
+import os
+import pytest
+import app_loader
+
+app: dict = app_loader.load_app_definitions([
+    "TEXT_MODEL_ATTACHMENT_GENERIC_FILENAMES",
+    "TEXT_MODEL_ATTACHMENT_GENERIC_EXTENSIONS",
+    "ATTACHMENT_GLOB_CHARACTERS",
+    "ATTACHMENT_GITIGNORE_FILENAME",
+    "ATTACHMENT_IGNORED_DIR_NAMES",
+    "get_path_extension",
+    "is_text_attachment_path",
+    "is_glob_pattern",
+    "get_gitignore_rules",
+    "is_path_gitignored",
+    "get_directory_attachment_paths",
+], {})
+
+def write_files(root_path, file_texts: dict[str, str]) -> None:
+    for relative_path, text in file_texts.items():
+        file_path = root_path / relative_path
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_text(text, encoding="utf-8")
+
+def is_ignored(root_path, gitignore_text: str, relative_path: str, is_dir: bool=False) -> bool:
+    write_files(root_path, {".gitignore": gitignore_text})
+    return app["is_path_gitignored"](os.path.join(root_path, relative_path), is_dir, app["get_gitignore_rules"](str(root_path)))
+
+@pytest.mark.parametrize("relative_path, expected", [
+    ("debug.log", True),
+    ("src/debug.log", True),
+    ("keep.log", False),
+    ("src/keep.log", False),
+    ("debug.txt", False),
+])
+def test_negated_pattern(tmp_path, relative_path: str, expected: bool) -> None:
+    assert is_ignored(tmp_path, "*.log\n!keep.log\n", relative_path) == expected
+
+def test_negation_order(tmp_path) -> None:
+    assert is_ignored(tmp_path, "!keep.log\n*.log\n", "keep.log")
+
+@pytest.mark.parametrize("relative_path, is_dir, expected", [
+    ("build", True, True),
+    ("src/build", True, True),
+    ("build", False, False),
+    ("src/build", False, False),
+])
+def test_dir_only_pattern(tmp_path, relative_path: str, is_dir: bool, expected: bool) -> None:
+    assert is_ignored(tmp_path, "build/\n", relative_path, is_dir) == expected
+
+@pytest.mark.parametrize("gitignore_text, relative_path, expected", [
+    ("/todo.txt\n", "todo.txt", True),
+    ("/todo.txt\n", "src/todo.txt", False),
+    ("docs/todo.txt\n", "docs/todo.txt", True),
+    ("docs/todo.txt\n", "src/docs/todo.txt", False),
+    ("todo.txt\n", "src/todo.txt", True),
+])
+def test_anchored_pattern(tmp_path, gitignore_text: str, relative_path: str, expected: bool) -> None:
+    assert is_ignored(tmp_path, gitignore_text, relative_path) == expected
+
+@pytest.mark.parametrize("gitignore_text, relative_path, expected", [
+    ("**/cache\n", "cache", True),
+    ("**/cache\n", "a/b/cache", True),
+    ("logs/**\n", "logs/a.txt", True),
+    ("logs/**\n", "logs/a/b.txt", True),
+    ("logs/**\n", "logs", False),
+    ("a/**/b.txt\n", "a/b.txt", True),
+    ("a/**/b.txt\n", "a/x/y/b.txt", True),
+    ("a/**/b.txt\n", "c/a/b.txt", False),
+    ("src/*.txt\n", "src/a/b.txt", False),
+])
+def test_double_star_pattern(tmp_path, gitignore_text: str, relative_path: str, expected: bool) -> None:
+    assert is_ignored(tmp_path, gitignore_text, relative_path) == expected
+
+def test_comments_and_escapes(tmp_path) -> None:
+    gitignore_text: str = "# notes.txt\n\\#notes.txt\n\\!important.txt\n"
+    assert not is_ignored(tmp_path, gitignore_text, "notes.txt")
+    assert is_ignored(tmp_path, gitignore_text, "#notes.txt")
+    assert is_ignored(tmp_path, gitignore_text, "!important.txt")
+
+def test_directory_walk(tmp_path, monkeypatch: pytest.MonkeyPatch) -> None:
+    (tmp_path / ".git").mkdir()
+    write_files(tmp_path, {
+        ".gitignore": "*.md\n!keep.md\nbuild/\n/top.txt\n**/generated/**\n",
+        "top.txt": "",
+        "main.py": "",
+        "keep.md": "",
+        "debug.md": "",
+        "build/out.py": "",
+        "src/top.txt": "",
+        "src/generated/types.py": "",
+        "src/lib/.gitignore": "!debug.md\n/local.py\n",
+        "src/lib/debug.md": "",
+        "src/lib/local.py": "",
+        "src/lib/util.py": "",
+        ".git/config": "",
+    })
+    monkeypatch.chdir(tmp_path / "src")
+    assert [relative_path for file_path, relative_path in app["get_directory_attachment_paths"](".")] == [
+        "top.txt",
+        "lib/.gitignore",
+        "lib/debug.md",
+        "lib/util.py",
+    ]
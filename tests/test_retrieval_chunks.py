@@ -0,0 +1,119 @@
+import pytest
+import app_loader
+
+numpy = pytest.importorskip("numpy")
+
+RETRIEVAL_CHUNK_SIZE: int = 200
+RETRIEVAL_EMBEDDING_SIZE: int = 4
+
+embedded_texts: list[str] = []
+
+# Deterministic unit vectors stand in for the embedding server.
+def get_fake_text_embeddings(texts: list[str]) -> "numpy.ndarray":
+    embedded_texts.extend(texts)
+    embeddings: numpy.ndarray = numpy.stack([numpy.random.default_rng(abs(hash(text))).random(app["RETRIEVAL_EMBEDDING_SIZE"], dtype=numpy.float32) for text in texts])
+    return embeddings / numpy.linalg.norm(embeddings, axis=1, keepdims=True)
+
+app: dict = app_loader.load_app_definitions([
+    "PRINT_COLORS",
+    "RETRIEVAL_INDEX_FILENAME",
+    "RETRIEVAL_VECTORS_FILENAME",
+    "RETRIEVAL_EMBEDDING_BATCH_SIZE",
+    "RETRIEVAL_CHUNK_BOUNDARY_MODULUS",
+    "retrieval_index",
+    "retrieval_vectors",
+    "retrieval_index_lock",
+    "get_retrieval_index",
+    "save_retrieval_index",
+    "split_retrieval_chunks",
+    "create_retrieval_chunk",
+    "index_retrieval_source",
+], {
+    "new_print": lambda *args: None,
+    "get_text_embeddings": get_fake_text_embeddings,
+    "RETRIEVAL_EMBEDDING_SIZE": RETRIEVAL_EMBEDDING_SIZE,
+})
+
+SOURCE_TEXT: str = "\n".join(f"def function_{line_index}():\n    return {line_index * 7919 % 1000}" for line_index in range(200))
+
+@pytest.fixture(autouse=True)
+def retrieval_settings(tmp_path) -> None:
+    app["script_settings"] = {
+        "retrieval_settings": {
+            "index_dir": f"{tmp_path}/",
+            "chunk_size": RETRIEVAL_CHUNK_SIZE,
+        },
+    }
+    app["retrieval_index"] = None
+    app["retrieval_vectors"] = None
+    app["RETRIEVAL_EMBEDDING_SIZE"] = RETRIEVAL_EMBEDDING_SIZE
+    embedded_texts.clear()
+
+def get_chunk_hashes(text: str) -> list[str]:
+    return [chunk["hash"] for chunk in app["split_retrieval_chunks"](text)]
+
+def test_chunks_cover_text() -> None:
+    chunks: list[dict] = app["split_retrieval_chunks"](SOURCE_TEXT)
+    assert "\n".join(chunk["text"] for chunk in chunks) == SOURCE_TEXT
+    assert all(len(chunk["text"]) <= RETRIEVAL_CHUNK_SIZE for chunk in chunks)
+    assert chunks[0]["start_line"] == 1
+    assert chunks[-1]["end_line"] == SOURCE_TEXT.count("\n") + 1
+    for chunk, next_chunk in zip(chunks, chunks[1:]):
+        assert next_chunk["start_line"] == chunk["end_line"] + 1
+
+def test_long_line_is_split() -> None:
+    chunks: list[dict] = app["split_retrieval_chunks"]("short\n" + "x" * (RETRIEVAL_CHUNK_SIZE * 2 + 10) + "\nend")
+    assert [chunk["text"] for chunk in chunks] == ["short", "x" * RETRIEVAL_CHUNK_SIZE, "x" * RETRIEVAL_CHUNK_SIZE, "x" * 10 + "\nend"]
+    assert [(chunk["start_line"], chunk["end_line"]) for chunk in chunks] == [(1, 1), (2, 2), (2, 2), (2, 3)]
+
+def test_blank_chunks_are_dropped() -> None:
+    assert app["split_retrieval_chunks"]("\n" * 1000) == []
+
+def test_edit_only_changes_nearby_chunks() -> None:
+    source_lines: list[str] = SOURCE_TEXT.split("\n")
+    source_lines[200] += "  # edited"
+    original_hashes: list[str] = get_chunk_hashes(SOURCE_TEXT)
+    edited_hashes: list[str] = get_chunk_hashes("\n".join(source_lines))
+    assert len(set(edited_hashes) - set(original_hashes)) <= 2
+    assert len(set(original_hashes) & set(edited_hashes)) >= len(original_hashes) - 2
+
+def test_inserted_line_keeps_later_boundaries() -> None:
+    source_lines: list[str] = SOURCE_TEXT.split("\n")
+    original_hashes: list[str] = get_chunk_hashes(SOURCE_TEXT)
+    inserted_hashes: list[str] = get_chunk_hashes("\n".join(source_lines[:10] + ["# inserted"] + source_lines[10:]))
+    assert inserted_hashes[-len(original_hashes) // 2:] == original_hashes[-len(original_hashes) // 2:]
+
+def test_incremental_reembedding() -> None:
+    first_result: tuple[int, int] = app["index_retrieval_source"]("source", "source.py", SOURCE_TEXT)
+    assert first_result[0] == first_result[1] == len(set(get_chunk_hashes(SOURCE_TEXT)))
+    assert len(app["retrieval_vectors"]) == first_result[1]
+
+    # Reloaded from disk, as in a new session.
+    app["retrieval_index"] = None
+    app["retrieval_vectors"] = None
+    embedded_texts.clear()
+    assert app["index_retrieval_source"]("source", "source.py", SOURCE_TEXT) == (first_result[0], 0)
+    assert embedded_texts == []
+
+    source_lines: list[str] = SOURCE_TEXT.split("\n")
+    source_lines[200] += "  # edited"
+    edited_text: str = "\n".join(source_lines)
+    changed_chunks: list[dict] = [chunk for chunk in app["split_retrieval_chunks"](edited_text) if chunk["hash"] not in get_chunk_hashes(SOURCE_TEXT)]
+    edited_result: tuple[int, int] = app["index_retrieval_source"]("source", "source.py", edited_text)
+    assert edited_result[1] == len(changed_chunks) > 0
+    assert embedded_texts == [chunk["text"] for chunk in changed_chunks]
+
+    # The vectors of the replaced chunks are dropped.
+    retrieval_index: dict = app["retrieval_index"]
+    assert sorted(retrieval_index["hashes"]) == sorted(set(get_chunk_hashes(edited_text)))
+    assert len(app["retrieval_vectors"]) == len(retrieval_index["hashes"])
+    assert set(retrieval_index["chunk_texts"]) == set(retrieval_index["hashes"])
+    for row, chunk_hash in enumerate(retrieval_index["hashes"]):
+        assert numpy.allclose(app["retrieval_vectors"][row], get_fake_text_embeddings([retrieval_index["chunk_texts"][chunk_hash]])[0])
+
+def test_embedding_model_change_rebuilds_index() -> None:
+    app["index_retrieval_source"]("source", "source.py", SOURCE_TEXT)
+    app["RETRIEVAL_EMBEDDING_SIZE"] = RETRIEVAL_EMBEDDING_SIZE + 1
+    app["index_retrieval_source"]("other", "other.py", "def other():\n    return 1")
+    assert list(app["retrieval_index"]["sources"]) == ["other"]
+    assert app["retrieval_vectors"].shape == (1, RETRIEVAL_EMBEDDING_SIZE + 1)
@@ -0,0 +1,75 @@
+import pytest
+import app_loader
+
+app: dict = app_loader.load_app_definitions([
+    "PRINT_COLORS",
+    "TEXT_MODEL_THOUGHT_START_TAG",
+    "TEXT_MODEL_THOUGHT_END_TAG",
+    "TEXT_MODEL_STREAMED_THOUGHTS_MODES",
+    "StreamPrinter",
+    "ThoughtFilter",
+    "filter_thoughts",
+    "write_streamed_segments",
+], {})
+
+RESPONSE_TEXT: str = "<think>reasoning</think>\n\nanswer"
+
+def feed_chunks(thought_filter, chunks: list[str]) -> list[tuple[bool, str]]:
+    segments: list[tuple[bool, str]] = []
+    for chunk in chunks:
+        segments += thought_filter.feed(chunk)
+    return segments + thought_filter.finish()
+
+def stream_chunks(chunks: list[str], streamed_thoughts_mode: str):
+    app["script_settings"] = {"text_model_gen_settings": {"chat_streamed_thoughts_mode": streamed_thoughts_mode}}
+    thought_filter = app["ThoughtFilter"]()
+    stream_printer = app["StreamPrinter"](0.0, 256)
+    for chunk in chunks:
+        app["write_streamed_segments"](stream_printer, thought_filter, thought_filter.feed(chunk))
+    app["write_streamed_segments"](stream_printer, thought_filter, thought_filter.finish(), True)
+    stream_printer.close()
+    return thought_filter
+
+@pytest.mark.parametrize("split_position", range(1, len(RESPONSE_TEXT)))
+def test_tags_split_across_chunks(split_position: int) -> None:
+    thought_filter = app["ThoughtFilter"]()
+    feed_chunks(thought_filter, [RESPONSE_TEXT[:split_position], RESPONSE_TEXT[split_position:]])
+    assert thought_filter.get_text() == "answer"
+    assert thought_filter.get_thoughts() == "reasoning"
+    assert not thought_filter.is_in_thought
+
+def test_tags_split_into_single_characters() -> None:
+    thought_filter = app["ThoughtFilter"]()
+    segments: list[tuple[bool, str]] = feed_chunks(thought_filter, list(RESPONSE_TEXT))
+    assert "".join(text for is_thought, text in segments if not is_thought) == "answer"
+    assert "".join(text for is_thought, text in segments if is_thought) == "reasoning"
+
+def test_leading_end_tag() -> None:
+    thought_filter = app["ThoughtFilter"]()
+    feed_chunks(thought_filter, ["reaso", "ning</th", "ink>\n\nanswer"])
+    assert thought_filter.get_text() == "answer"
+    assert thought_filter.get_thoughts() == "reasoning"
+
+def test_partial_tag_released_at_finish() -> None:
+    thought_filter = app["ThoughtFilter"]()
+    assert thought_filter.feed("a < b <th") == [(False, "a < b ")]
+    assert thought_filter.finish() == [(False, "<th")]
+    assert thought_filter.get_text() == "a < b <th"
+
+def test_stream_ending_inside_thought(capsys: pytest.CaptureFixture) -> None:
+    thought_filter = stream_chunks(["<thi", "nk>reas", "oning"], app["TEXT_MODEL_STREAMED_THOUGHTS_MODES"][2])
+    assert thought_filter.is_in_thought
+    assert thought_filter.get_thoughts() == "reasoning"
+    assert thought_filter.get_text() == ""
+    assert capsys.readouterr().out == f"{app["PRINT_COLORS"]["special"]}[Thinking... 9 characters]{app["colorama"].Style.RESET_ALL}"
+
+def test_collapsed_output(capsys: pytest.CaptureFixture) -> None:
+    stream_chunks(["<think>a", "bc</think>\n\nans", "wer"], app["TEXT_MODEL_STREAMED_THOUGHTS_MODES"][2])
+    assert capsys.readouterr().out == f"{app["PRINT_COLORS"]["special"]}[Thinking... 3 characters]{app["colorama"].Style.RESET_ALL}\n\nanswer"
+
+def test_hidden_output(capsys: pytest.CaptureFixture) -> None:
+    stream_chunks(["<think>a", "bc</think>\n\nans", "wer"], app["TEXT_MODEL_STREAMED_THOUGHTS_MODES"][1])
+    assert capsys.readouterr().out == "answer"
+
+def test_filter_thoughts_without_tags() -> None:
+    assert app["filter_thoughts"]("a <b> c").get_text() == "a <b> c"
@@ -0,0 +1 @@
+python app_lm_init_settings_autotune.py
\ No newline at end of file